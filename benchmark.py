@@ -0,0 +1,903 @@
+"""Micro-benchmark untuk jalur panas Financial AI.
+
+Contoh:
+    python benchmark.py chat-db --messages 100000
+    python benchmark.py vector-load --chunks 10000 100000 1000000
+    python benchmark.py ttft --tokens 1024
+    python benchmark.py pdf-ingest --pages 200 500 1000
+    python benchmark.py tabular-ingest --rows 100000 1000000
+    python benchmark.py summary --wide-cols 500 --tall-rows 5000000
+    python benchmark.py split --pages 2000 --workers 1 2 4
+    python benchmark.py retrieval --companies 60 --k 3 5 7
+    python benchmark.py ann --vectors 200000 --dim 1536
+    python benchmark.py context --companies 40
+    python benchmark.py scheduler --chunks 2000 --quota 4
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter
+from io import BytesIO
+from typing import Dict, List
+
+import faiss
+import numpy as np
+import pandas as pd
+from tabulate import tabulate
+from langchain.schema import Document
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.embeddings import FakeEmbeddings
+from langchain_core.embeddings import Embeddings
+from langchain_community.vectorstores import FAISS
+
+from main import ChatManager, SQLiteConnectionPool, save_vector_store, stream_bedrock_completion
+
+
+def _seed_chat_db(db_path: str, total_messages: int, total_sessions: int) -> list:
+    """Mengisi database chat dengan data sintetis"""
+    manager = ChatManager(db_pool=SQLiteConnectionPool(db_path), enable_s3_sync=False)
+    session_ids = [str(uuid.uuid4()) for _ in range(total_sessions)]
+    with manager.db.connection() as conn:
+        conn.executemany(
+            "INSERT INTO chat_sessions (id, title, user_id) VALUES (?, ?, 'default')",
+            [(sid, f"Chat {i}") for i, sid in enumerate(session_ids)]
+        )
+        conn.executemany(
+            "INSERT INTO chat_messages (session_id, role, content) VALUES (?, ?, ?)",
+            (
+                (session_ids[i % total_sessions], "user" if i % 2 == 0 else "assistant", "x" * 200)
+                for i in range(total_messages)
+            )
+        )
+    manager.db.close_all()
+    return session_ids
+
+
+class LegacyChatStore:
+    """Pola lama: satu sqlite3.connect per operasi, rollback journal"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        conn = sqlite3.connect(db_path)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+
+    def get_all_sessions(self, user_id: str = "default"):
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute(
+            "SELECT id, title, created_at, updated_at FROM chat_sessions WHERE user_id = ? ORDER BY updated_at DESC",
+            (user_id,)
+        ).fetchall()
+        conn.close()
+        return [{'id': r[0], 'title': r[1], 'created_at': r[2], 'updated_at': r[3]} for r in rows]
+
+    def get_session_messages(self, session_id: str):
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute(
+            "SELECT role, content, timestamp FROM chat_messages WHERE session_id = ? ORDER BY timestamp",
+            (session_id,)
+        ).fetchall()
+        conn.close()
+        return [{'role': r[0], 'content': r[1], 'timestamp': r[2]} for r in rows]
+
+    def add_message(self, session_id: str, role: str, content: str):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            "INSERT INTO chat_messages (session_id, role, content) VALUES (?, ?, ?)",
+            (session_id, role, content)
+        )
+        conn.execute("UPDATE chat_sessions SET updated_at = CURRENT_TIMESTAMP WHERE id = ?", (session_id,))
+        conn.commit()
+        conn.close()
+
+
+def _ops_per_second(func, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return iterations / (time.perf_counter() - start)
+
+
+def bench_chat_db(args):
+    """Bandingkan ops/detik ChatManager lama (connect per operasi) vs pool WAL"""
+    rng = random.Random(42)
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.db")
+        pooled_path = os.path.join(tmp, "pooled.db")
+
+        print(f"Seeding {args.messages:,} messages in {args.sessions:,} sessions...")
+        session_ids = _seed_chat_db(legacy_path, args.messages, args.sessions)
+        conn = sqlite3.connect(legacy_path)
+        conn.execute(f"VACUUM INTO '{pooled_path}'")
+        conn.close()
+
+        legacy = LegacyChatStore(legacy_path)
+        pooled = ChatManager(db_pool=SQLiteConnectionPool(pooled_path), enable_s3_sync=False)
+
+        workloads = [
+            ("get_all_sessions", lambda store: lambda: store.get_all_sessions()),
+            ("get_session_messages", lambda store: lambda: store.get_session_messages(rng.choice(session_ids))),
+            ("add_message", lambda store: lambda: store.add_message(rng.choice(session_ids), "user", "y" * 120)),
+        ]
+        for name, make in workloads:
+            before = _ops_per_second(make(legacy), args.iterations)
+            after = _ops_per_second(make(pooled), args.iterations)
+            rows.append([name, f"{before:,.0f}", f"{after:,.0f}", f"{after / before:.1f}x"])
+
+        pooled.db.close_all()
+
+    print(tabulate(rows, headers=["Operation", "Before (ops/s)", "After (ops/s)", "Speedup"], tablefmt="github"))
+
+
+def _rss_mb() -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _build_vector_fixture(folder: str, chunks: int, dim: int):
+    """Buat index flat sintetis dalam dua format: pickle dan mmap"""
+    rng = np.random.default_rng(0)
+    index = faiss.IndexFlatL2(dim)
+    for start in range(0, chunks, 50_000):
+        index.add(rng.random((min(50_000, chunks - start), dim), dtype=np.float32))
+
+    ids = [str(uuid.uuid4()) for _ in range(chunks)]
+    docstore = InMemoryDocstore({
+        doc_id: Document(page_content=f"Chunk {i}: pendapatan kuartal {i % 4 + 1} " * 20, metadata={"page": i})
+        for i, doc_id in enumerate(ids)
+    })
+    vectorstore = FAISS(FakeEmbeddings(size=dim), index, docstore, dict(enumerate(ids)))
+    for store_format in ("pickle", "mmap"):
+        os.makedirs(os.path.join(folder, store_format), exist_ok=True)
+        save_vector_store(vectorstore, os.path.join(folder, store_format), "bench", store_format, keyword_index=False)
+
+
+def _vector_load_child(folder: str, store_format: str, dim: int):
+    """Dijalankan di proses terpisah supaya RSS yang diukur bersih"""
+    from main import load_vector_store_files
+
+    rss_before = _rss_mb()
+    start = time.perf_counter()
+    vectorstore = load_vector_store_files(
+        os.path.join(folder, store_format), "bench", FakeEmbeddings(size=dim), store_format
+    )
+    load_seconds = time.perf_counter() - start
+    rss_loaded = _rss_mb()
+
+    start = time.perf_counter()
+    vectorstore.similarity_search_by_vector(list(np.random.default_rng(1).random(dim)), k=7)
+    query_seconds = time.perf_counter() - start
+    print(json.dumps({
+        'load_seconds': load_seconds,
+        'query_seconds': query_seconds,
+        'rss_loaded_mb': rss_loaded - rss_before,
+        'rss_after_query_mb': _rss_mb() - rss_before
+    }))
+
+
+def bench_vector_load(args):
+    """Bandingkan waktu startup dan RSS index FAISS: pickle (heap) vs mmap"""
+    rows = []
+    for chunks in args.chunks:
+        with tempfile.TemporaryDirectory() as tmp:
+            print(f"Building {chunks:,} chunk fixture (dim={args.dim})...")
+            _build_vector_fixture(tmp, chunks, args.dim)
+            for store_format in ("pickle", "mmap"):
+                result = subprocess.run(
+                    [sys.executable, __file__, "_vector-load-child", tmp, store_format, str(args.dim)],
+                    capture_output=True, text=True, check=True
+                )
+                metrics = json.loads(result.stdout.strip().splitlines()[-1])
+                rows.append([
+                    f"{chunks:,}", store_format,
+                    f"{metrics['load_seconds']:.2f}", f"{metrics['query_seconds'] * 1000:.1f}",
+                    f"{metrics['rss_loaded_mb']:,.0f}", f"{metrics['rss_after_query_mb']:,.0f}"
+                ])
+
+    print(tabulate(
+        rows,
+        headers=["Chunks", "Format", "Startup (s)", "First query (ms)", "RSS loaded (MB)", "RSS after query (MB)"],
+        tablefmt="github"
+    ))
+
+
+def _build_pdf_fixture(path: str, pages: int):
+    """PDF sintetis mirip laporan keuangan: paragraf naratif + tabel angka per halaman"""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
+    rng = random.Random(0)
+    pdf = canvas.Canvas(path, pagesize=A4)
+    width, height = A4
+    for page in range(pages):
+        y = height - 50
+        pdf.setFont("Helvetica", 9)
+        for line in range(60):
+            if line % 3 == 0:
+                text = (f"Catatan {page}.{line}: pendapatan segmen {rng.choice(['ritel', 'korporasi', 'syariah'])} "
+                        f"naik {rng.uniform(1, 30):.1f}% dibanding periode sebelumnya.")
+            else:
+                text = "  ".join(f"{rng.randint(1_000, 9_999_999):>12,}" for _ in range(6))
+            pdf.drawString(40, y, text)
+            y -= 12
+        pdf.showPage()
+    pdf.save()
+
+
+def _pdf_ingest_child(path: str, mode: str):
+    """Dijalankan di proses terpisah supaya peak RSS tiap mode bersih"""
+    import main
+
+    if mode == "streaming" and main.PDF_INGEST_WORKERS > 1:
+        # Di aplikasi pool worker hidup sepanjang proses; ukur kondisi warm
+        import pdf_ingest
+        executor = pdf_ingest.get_executor(main.PDF_INGEST_WORKERS)
+        for future in [executor.submit(time.sleep, 0.5) for _ in range(main.PDF_INGEST_WORKERS)]:
+            future.result()
+
+    rss_baseline = _rss_mb()
+    start = time.perf_counter()
+    first_chunk = None
+    chunks = 0
+    if mode == "legacy":
+        from langchain_community.document_loaders import PyPDFLoader
+        pages = PyPDFLoader(path).load_and_split()
+        chunk_iter = iter(main.FinancialAI.split_documents(None, pages))
+    else:
+        chunk_iter = main.iter_split_documents(main.iter_pdf_documents(path))
+    for _ in chunk_iter:
+        if first_chunk is None:
+            first_chunk = time.perf_counter() - start
+        chunks += 1
+    print(json.dumps({
+        'seconds': time.perf_counter() - start,
+        'first_chunk_seconds': first_chunk,
+        'chunks': chunks,
+        # Peak di atas RSS setelah import (tidak termasuk worker process)
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - rss_baseline
+    }))
+
+
+def bench_pdf_ingest(args):
+    """Bandingkan load_and_split serial (semua halaman di memori) vs pipeline streaming paralel"""
+    rows = []
+    for pages in args.pages:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, f"report_{pages}.pdf")
+            print(f"Building {pages:,} page PDF...")
+            _build_pdf_fixture(path, pages)
+            for mode in ("legacy", "streaming"):
+                result = subprocess.run(
+                    [sys.executable, __file__, "_pdf-ingest-child", path, mode],
+                    capture_output=True, text=True, check=True
+                )
+                metrics = json.loads(result.stdout.strip().splitlines()[-1])
+                rows.append([
+                    f"{pages:,}", mode, f"{metrics['chunks']:,}", f"{metrics['seconds']:.2f}",
+                    f"{metrics['first_chunk_seconds']:.2f}", f"{metrics['peak_rss_mb']:,.0f}"
+                ])
+
+    print(tabulate(
+        rows,
+        headers=["Pages", "Mode", "Chunks", "Total (s)", "First chunk (s)", "Peak RSS delta (MB)"],
+        tablefmt="github"
+    ))
+
+
+def _build_ledger_fixture(path: str, rows: int):
+    """Buku besar sintetis: tanggal, akun, keterangan, pendapatan, biaya"""
+    rng = np.random.default_rng(0)
+    accounts = np.array(["Kas", "Piutang", "Persediaan", "Utang Usaha", "Beban Gaji", "Penjualan"])
+    header = True
+    for start in range(0, rows, 200_000):
+        size = min(200_000, rows - start)
+        frame = pd.DataFrame({
+            "tanggal": (np.datetime64("2023-01-01") + rng.integers(0, 365, size)).astype(str),
+            "akun": accounts[rng.integers(0, len(accounts), size)],
+            "keterangan": [f"Transaksi {start + i}" for i in range(size)],
+            "pendapatan": rng.integers(0, 50_000_000, size),
+            "biaya": rng.integers(0, 20_000_000, size),
+        })
+        frame.to_csv(path, mode="w" if header else "a", header=header, index=False)
+        header = False
+
+
+def _tabular_ingest_child(path: str, mode: str):
+    """Dijalankan di proses terpisah supaya peak RSS tiap mode bersih"""
+    import main
+
+    rss_baseline = _rss_mb()
+    start = time.perf_counter()
+    if mode == "legacy":
+        # Pola lama: seluruh file -> satu Document raksasa -> splitter
+        df = pd.read_csv(path)
+        ai = main.FinancialAI.__new__(main.FinancialAI)
+        document = Document(
+            page_content=f"RINGKASAN KEUANGAN:\n{ai.create_financial_summary(df)}\n\nDATA LENGKAP:\n{df.to_string(index=False)}",
+            metadata={"source": path}
+        )
+        documents = sum(1 for _ in main.iter_split_documents([document]))
+    else:
+        documents = sum(1 for _ in main.iter_tabular_documents(path, "csv"))
+    print(json.dumps({
+        'seconds': time.perf_counter() - start,
+        'documents': documents,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - rss_baseline
+    }))
+
+
+def bench_tabular_ingest(args):
+    """Bandingkan read_csv + to_string + splitter vs pembacaan per blok baris"""
+    rows = []
+    for row_count in args.rows:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, f"ledger_{row_count}.csv")
+            print(f"Building {row_count:,} row ledger...")
+            _build_ledger_fixture(path, row_count)
+            for mode in ("legacy", "chunked"):
+                result = subprocess.run(
+                    [sys.executable, __file__, "_tabular-ingest-child", path, mode],
+                    capture_output=True, text=True, check=True
+                )
+                metrics = json.loads(result.stdout.strip().splitlines()[-1])
+                rows.append([
+                    f"{row_count:,}", mode, f"{metrics['documents']:,}",
+                    f"{metrics['seconds']:.2f}", f"{metrics['peak_rss_mb']:,.0f}"
+                ])
+
+    print(tabulate(rows, headers=["Rows", "Mode", "Documents", "Total (s)", "Peak RSS delta (MB)"], tablefmt="github"))
+
+
+def _legacy_financial_summary(df: pd.DataFrame) -> str:
+    """create_financial_summary versi lama: loop keyword per kolom, sum/mean terpisah, kolom teks uang diabaikan"""
+    summary = []
+    financial_columns = []
+    for col in df.columns:
+        col_lower = col.lower()
+        if any(keyword in col_lower for keyword in
+               ['revenue', 'income', 'profit', 'expense', 'cost', 'sales', 'pendapatan', 'laba', 'biaya',
+                'penjualan']):
+            financial_columns.append(col)
+    summary.append(f"Total baris data: {len(df)}")
+    summary.append(f"Kolom yang terdeteksi: {', '.join(df.columns)}")
+    if financial_columns:
+        summary.append(f"Kolom keuangan utama: {', '.join(financial_columns)}")
+        for col in financial_columns:
+            if pd.api.types.is_numeric_dtype(df[col]):
+                summary.append(f"{col}: Total = {df[col].sum():,.2f}, Rata-rata = {df[col].mean():,.2f}")
+    return "\n".join(summary)
+
+
+def _summary_frames(wide_cols: int, tall_rows: int):
+    rng = np.random.default_rng(0)
+    wide_rows = 10_000
+    wide = {"tanggal": (np.datetime64("2022-01-01") + rng.integers(0, 730, wide_rows)).astype(str)}
+    for i in range(wide_cols - 1):
+        if i % 10 == 0:
+            wide[f"nilai_{i}"] = [f"Rp {v:,}".replace(",", ".") for v in rng.integers(0, 10_000_000, wide_rows)]
+        else:
+            wide[f"{'biaya' if i % 2 else 'pendapatan'}_{i}"] = rng.random(wide_rows) * 1e6
+    tall = pd.DataFrame({
+        "tanggal": (np.datetime64("2022-01-01") + rng.integers(0, 730, tall_rows)).astype(str),
+        "akun": np.array(["Kas", "Piutang", "Beban"])[rng.integers(0, 3, tall_rows)],
+        "pendapatan": rng.integers(0, 50_000_000, tall_rows),
+        "biaya": rng.random(tall_rows) * 1e7,
+        "nilai_kontrak": pd.Series(rng.integers(0, 1_000_000, tall_rows)).map("Rp {:,}".format).str.replace(",", "."),
+    })
+    return [("wide", pd.DataFrame(wide)), ("tall", tall)]
+
+
+def bench_summary(args):
+    """Ringkasan keuangan lama vs profil vektor (cold) vs cache per hash isi file"""
+    from main import FinancialAI, file_content_hash, init_profile_cache
+
+    rows = []
+    for name, frame in _summary_frames(args.wide_cols, args.tall_rows):
+        shape = f"{name} {frame.shape[0]:,}x{frame.shape[1]}"
+        start = time.perf_counter()
+        _legacy_financial_summary(frame)
+        legacy = time.perf_counter() - start
+
+        start = time.perf_counter()
+        FinancialAI.create_financial_summary(None, frame)
+        profile = time.perf_counter() - start
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, f"{name}.csv")
+            frame.to_csv(path, index=False)
+            cache = init_profile_cache()
+            cache.put(file_content_hash(path), {})
+            start = time.perf_counter()
+            cache.get(file_content_hash(path))
+            cached = time.perf_counter() - start
+            size_mb = os.path.getsize(path) / 1024 / 1024
+
+        rows.append([shape, f"{size_mb:,.0f}", f"{legacy:.2f}", f"{profile:.2f}", f"{cached:.3f}"])
+
+    print(tabulate(
+        rows,
+        headers=["Frame", "CSV (MB)", "Legacy sum/mean (s)", "Full profile (s)", "Cached by hash (s)"],
+        tablefmt="github"
+    ))
+    print("Legacy hanya menghitung sum/mean kolom numerik; profil juga mem-parse kolom 'Rp ...' "
+          "dan menghitung min/max/kuartil/pertumbuhan.")
+
+
+def _split_corpus(pages: int) -> list:
+    """Halaman sintetis mirip laporan: paragraf, baris tabel, dan token panjang tanpa spasi"""
+    rng = random.Random(0)
+    words = ["pendapatan", "beban", "laba", "kas", "aset", "liabilitas", "ekuitas", "Rp", "miliar",
+             "2023", "meningkat", "menurun", "konsolidasian", "usaha", "periode", "catatan"]
+    documents = []
+    for page in range(pages):
+        paragraphs = []
+        for _ in range(rng.randint(3, 8)):
+            sentences = [" ".join(rng.choices(words, k=rng.randint(5, 30))) + rng.choice([".", "!", "?", ","])
+                         for _ in range(rng.randint(2, 12))]
+            paragraphs.append(" ".join(sentences))
+        paragraphs.append("\n".join(f"{rng.choice(words)} {rng.randint(0, 10**9):,}" for _ in range(rng.randint(0, 40))))
+        if page % 50 == 0:
+            paragraphs.append("x" * rng.randint(2000, 6000))
+        documents.append(Document(page_content="\n\n".join(paragraphs), metadata={"source": "bench.pdf", "page": page}))
+    return documents
+
+
+def bench_split(args):
+    """Throughput splitter: LangChain split_documents + filter vs generator splitter (serial/paralel)"""
+    import main
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    documents = _split_corpus(args.pages)
+    size_mb = sum(len(document.page_content.encode()) for document in documents) / 1024 / 1024
+
+    def legacy():
+        splitter = RecursiveCharacterTextSplitter(
+            chunk_size=1500, chunk_overlap=300, separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""])
+        chunks = splitter.split_documents(documents)
+        return [doc for doc in chunks if 50 <= len(doc.page_content) <= 4000]
+
+    modes = [("langchain", legacy, None)]
+    for workers in args.workers:
+        modes.append((f"generator x{workers}", lambda workers=workers: list(main.iter_split_documents(documents, workers=workers)), workers))
+
+    reference = None
+    rows = []
+    for name, run, workers in modes:
+        if workers and workers > 1:
+            # Pool hidup sepanjang proses aplikasi; ukur kondisi warm
+            list(main.iter_split_documents(documents[:workers * main.SPLIT_DOCUMENTS_PER_TASK], workers=workers))
+        start = time.perf_counter()
+        chunks = run()
+        seconds = time.perf_counter() - start
+        signature = [(doc.page_content, doc.metadata) for doc in chunks]
+        reference = reference or signature
+        rows.append([name, f"{len(chunks):,}", f"{seconds:.2f}", f"{size_mb / seconds:,.1f}",
+                     "yes" if signature == reference else "NO"])
+
+    print(f"Corpus: {args.pages:,} halaman, {size_mb:,.1f} MB")
+    print(tabulate(rows, headers=["Splitter", "Chunks", "Seconds", "MB/s", "Identical"], tablefmt="github"))
+
+
+class HashingEmbeddings(Embeddings):
+    """Embedding offline pengganti Titan: TF trigram karakter di-hash ke vektor ternormalisasi.
+
+    Seperti model dense, kemiripannya kabur: angka dan kode ticker yang mirip
+    menghasilkan vektor yang berdekatan.
+    """
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        text = f"  {text.lower()}  "
+        for i in range(len(text) - 2):
+            vector[zlib.crc32(text[i:i + 3].encode()) % self.dim] += 1
+        return (vector / (np.linalg.norm(vector) or 1)).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+class _StaticVectorCache:
+    """Pengganti VectorStoreCache untuk satu shard lokal"""
+
+    def __init__(self, entry: Dict):
+        self.entry = entry
+
+    def get(self, index_name):
+        return self.entry
+
+
+def _retrieval_fixture(companies: int):
+    """Chunk laporan per (perusahaan, akun, tahun) + pertanyaan yang jawabannya tepat satu chunk"""
+    rng = random.Random(0)
+    accounts = ["pendapatan usaha", "beban pokok penjualan", "laba bruto", "beban usaha", "laba bersih",
+                "kas dan setara kas", "piutang usaha", "persediaan", "total aset", "utang bank",
+                "total liabilitas", "total ekuitas"]
+    tickers = set()
+    while len(tickers) < companies:
+        tickers.add("".join(rng.choices("ABCDEFGHIJKLMNOPRSTUW", k=4)))
+    texts, queries = [], []
+    for ticker in sorted(tickers):
+        for year in (2020, 2021, 2022, 2023):
+            for account in accounts:
+                value = f"Rp {rng.randint(10**8, 10**12):,}".replace(",", ".")
+                growth = rng.choice(["meningkat", "menurun", "relatif stabil"])
+                texts.append(f"PT {ticker.title()} Sejahtera Tbk ({ticker}). Laporan tahunan {year}: {account} "
+                             f"tercatat {value}, {growth} dibandingkan tahun sebelumnya sejalan dengan "
+                             f"kondisi industri dan strategi manajemen.")
+                relevant = len(texts) - 1
+                queries.append((f"Berapa {account} {ticker} tahun {year}?", relevant, "account"))
+                queries.append((f"Pos apa yang nilainya {value}?", relevant, "number"))
+    rng.shuffle(queries)
+    return texts, queries
+
+
+def bench_retrieval(args):
+    """Recall@k: FAISS saja vs BM25 saja vs hybrid (RRF) pada korpus fixture"""
+    from main import KeywordIndex, ShardedRetriever
+
+    texts, queries = _retrieval_fixture(args.companies)
+    queries = queries[:args.queries]
+    embeddings = HashingEmbeddings()
+    vectorstore = FAISS.from_texts(texts, embeddings, metadatas=[{'chunk': i} for i in range(len(texts))])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        keyword_path = os.path.join(tmp, "bench.bm25.db")
+        start = time.perf_counter()
+        KeywordIndex.write(keyword_path, vectorstore)
+        build_seconds = time.perf_counter() - start
+        keyword_index = KeywordIndex(keyword_path)
+        cache = _StaticVectorCache({'vectorstore': vectorstore, 'keyword_index': keyword_index})
+
+        rows = []
+        max_k = max(args.k)
+        for mode in ("vector", "bm25", "hybrid"):
+            hits = {k: Counter() for k in args.k}
+            start = time.perf_counter()
+            for question, relevant, kind in queries:
+                if mode == "bm25":
+                    ranked = [vectorstore.docstore.search(vectorstore.index_to_docstore_id[pos]).metadata['chunk']
+                              for pos, _ in keyword_index.search(question, max_k)]
+                else:
+                    retriever = ShardedRetriever(cache=cache, embeddings=embeddings, collections=["bench"],
+                                                 executor=None, k=max_k, mode=mode)
+                    ranked = [doc.metadata['chunk'] for doc in retriever.get_relevant_documents(question)]
+                for k in args.k:
+                    if relevant in ranked[:k]:
+                        hits[k][kind] += 1
+                        hits[k]['all'] += 1
+            latency_ms = (time.perf_counter() - start) / len(queries) * 1000
+            totals = Counter(kind for _, _, kind in queries)
+            totals['all'] = len(queries)
+            for k in args.k:
+                rows.append([mode, k] + [f"{hits[k][kind] / totals[kind]:.3f}" for kind in ("account", "number", "all")]
+                            + [f"{latency_ms:.1f}"])
+        keyword_index.close()
+
+    print(f"Korpus: {len(texts):,} chunk, {len(queries):,} pertanyaan; index BM25 dibangun {build_seconds:.2f}s")
+    print(tabulate(rows, headers=["Retriever", "k", "Recall akun", "Recall angka", "Recall total", "ms/query"],
+                   tablefmt="github"))
+
+
+def bench_context(args):
+    """Ukuran prompt dan cakupan jawaban: top-k tanpa packing vs kandidat + rerank + budget token"""
+    import main
+    from main import ContextPacker, KeywordIndex, ShardedRetriever, estimate_tokens
+
+    # Satu halaman per (perusahaan, tahun) berisi semua akun, dipecah splitter produksi (chunk bertumpuk)
+    texts, queries = _retrieval_fixture(args.companies)
+    queries = [query for query in queries if query[2] == "account"][:args.queries]
+    splitter = main.build_text_splitter()
+    pages = [" ".join(texts[start:start + 12]) for start in range(0, len(texts), 12)]
+    chunks, metadatas = [], []
+    for page, text in enumerate(pages):
+        for chunk in splitter.split_text(text):
+            chunks.append(chunk)
+            metadatas.append({'doc_id': f"doc-{page // 4}", 'page': page % 4})
+    embeddings = HashingEmbeddings()
+    vectorstore = FAISS.from_texts(chunks, embeddings, metadatas=metadatas)
+    # Nilai akun = penanda jawaban; dianggap tercakup jika muncul utuh di konteks
+    answers = [texts[relevant].split(" tercatat ")[1].split(",")[0] for _, relevant, _ in queries]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        keyword_path = os.path.join(tmp, "bench.bm25.db")
+        KeywordIndex.write(keyword_path, vectorstore)
+        keyword_index = KeywordIndex(keyword_path)
+        cache = _StaticVectorCache({'vectorstore': vectorstore, 'keyword_index': keyword_index})
+
+        rows = []
+        setups = [("top-k", k, None) for k in args.k]
+        setups += [("packed", main.CONTEXT_CANDIDATES, ContextPacker(token_budget=budget)) for budget in args.budgets]
+        for name, k, packer in setups:
+            retriever = ShardedRetriever(cache=cache, embeddings=embeddings, collections=["bench"],
+                                         executor=None, k=k, packer=packer)
+            tokens = covered = chunk_count = 0
+            start = time.perf_counter()
+            for (question, _, _), answer in zip(queries, answers):
+                context = "\n\n".join(doc.page_content for doc in retriever.get_relevant_documents(question))
+                tokens += estimate_tokens(context)
+                chunk_count += context.count("\n\n") + 1
+                covered += answer in context
+            latency_ms = (time.perf_counter() - start) / len(queries) * 1000
+            label = f"budget {packer.token_budget:,}" if packer else "-"
+            rows.append([name, k, label, f"{tokens / len(queries):,.0f}", f"{chunk_count / len(queries):.1f}",
+                         f"{covered / len(queries):.3f}", f"{latency_ms:.1f}"])
+        keyword_index.close()
+
+    print(f"Korpus: {len(chunks):,} chunk dari {len(pages):,} halaman, {len(queries):,} pertanyaan")
+    print(tabulate(rows, headers=["Konteks", "Kandidat", "Packing", "Token konteks", "Chunk", "Jawaban tercakup",
+                                  "ms/query"], tablefmt="github"))
+
+
+def _clustered_vectors(count: int, dim: int, seed: int = 0, rank: int = 64) -> np.ndarray:
+    """Vektor mirip embedding: klaster topik dengan variasi di subruang berdimensi rendah.
+
+    Embedding teks punya dimensi intrinsik jauh di bawah dim-nya; data uniform/isotropik
+    membuat ANN (terutama PQ) tampak jauh lebih buruk daripada di korpus nyata.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(count // 500, 16), dim)).astype(np.float32)
+    basis = rng.standard_normal((rank, dim)).astype(np.float32) / np.sqrt(rank)
+    vectors = np.empty((count, dim), dtype=np.float32)
+    for start in range(0, count, 50_000):
+        size = min(50_000, count - start)
+        vectors[start:start + size] = centers[rng.integers(0, len(centers), size)]
+        vectors[start:start + size] += rng.standard_normal((size, rank)).astype(np.float32) @ basis
+        vectors[start:start + size] += 0.05 * rng.standard_normal((size, dim)).astype(np.float32)
+    return vectors
+
+
+def bench_ann(args):
+    """Recall@10, latensi per query, dan ukuran index: flat vs HNSW / IVF-Flat / IVF-PQ (+ rerank mmap)"""
+    from main import ANN_PQ_REFINE_FACTOR, build_search_index, with_refine
+
+    flat = faiss.IndexFlatL2(args.dim)
+    flat.add(_clustered_vectors(args.vectors, args.dim))
+    # Query = vektor korpus + noise (bukan vektor yang persis ada di index)
+    rng = np.random.default_rng(1)
+    queries = np.vstack([flat.reconstruct(int(pos)) for pos in rng.choice(args.vectors, args.queries, replace=False)])
+    queries += 0.1 * rng.standard_normal(queries.shape).astype(np.float32)
+    _, truth = flat.search(queries, 10)
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        flat_path = os.path.join(tmp, "bench.flat.faiss")
+        faiss.write_index(flat, flat_path)
+        mmap_flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+        flat_mmap = faiss.read_index(flat_path, mmap_flag | faiss.IO_FLAG_READ_ONLY)
+
+        variants = [(index_type, index_type, False) for index_type in args.types]
+        if "ivf_pq" in args.types and ANN_PQ_REFINE_FACTOR > 0:
+            variants.append((f"ivf_pq + rerank x{ANN_PQ_REFINE_FACTOR} (mmap)", "ivf_pq", True))
+        for name, index_type, refine in variants:
+            start = time.perf_counter()
+            index, params = build_search_index(flat, index_type, refine=refine)
+            build_seconds = time.perf_counter() - start
+            size_mb = faiss.serialize_index(index).nbytes / 1024 / 1024
+            search_index = with_refine(index, flat_mmap) if refine else index
+
+            start = time.perf_counter()
+            found = np.vstack([search_index.search(query[None, :], 10)[1] for query in queries])
+            latency_ms = (time.perf_counter() - start) / len(queries) * 1000
+            recall = np.mean([len(set(row) & set(expected)) / 10 for row, expected in zip(found, truth)])
+            tuned = ", ".join(f"{key}={value}" for key, value in params.items() if key in ("efSearch", "nprobe", "nlist"))
+            rows.append([name, tuned or "-", f"{build_seconds:.1f}", f"{recall:.3f}", f"{latency_ms:.2f}",
+                         f"{size_mb:,.0f}"])
+
+    print(f"{args.vectors:,} vektor x {args.dim} dim, {args.queries} query, 1 query per search")
+    print(tabulate(rows, headers=["Index", "Params", "Build (s)", "Recall@10", "ms/query", "Heap size (MB)"],
+                   tablefmt="github"))
+    print("Rerank IVF-PQ membaca vektor kandidat dari .flat.faiss yang di-mmap (page cache, bukan heap).")
+
+
+class FakeStreamingBedrock:
+    """Bedrock palsu: latensi awal lalu satu event per token, format sama dengan Claude v2"""
+
+    def __init__(self, tokens: int, first_token_delay: float, token_delay: float):
+        self.tokens = tokens
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+
+    def _events(self):
+        time.sleep(self.first_token_delay)
+        for i in range(self.tokens):
+            if i:
+                time.sleep(self.token_delay)
+            yield {"chunk": {"bytes": json.dumps({"completion": f" token{i}"}).encode()}}
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        return {"body": self._events()}
+
+
+def bench_ttft(args):
+    """Waktu sampai teks pertama tampil: jawaban utuh (blocking) vs streaming"""
+    client = FakeStreamingBedrock(args.tokens, args.first_token_ms / 1000, args.token_ms / 1000)
+    rows = []
+    for mode in ("blocking", "streaming"):
+        start = time.perf_counter()
+        first = None
+        chunks = []
+        for text in stream_bedrock_completion(client, "Human: test\n\nAssistant:"):
+            chunks.append(text)
+            if mode == "streaming" and first is None:
+                first = time.perf_counter() - start
+        total = time.perf_counter() - start
+        # Mode blocking baru bisa menampilkan teks setelah completion lengkap
+        first = total if first is None else first
+        rows.append([mode, len(chunks), f"{first * 1000:,.0f}", f"{total * 1000:,.0f}"])
+
+    print(tabulate(rows, headers=["Mode", "Chunks", "Time to first text (ms)", "Total (ms)"], tablefmt="github"))
+
+
+class FakeThrottlingBedrock:
+    """Bedrock palsu dengan kuota request paralel: di atas kuota langsung ThrottlingException"""
+
+    def __init__(self, quota: int, latency: float):
+        self.quota = quota
+        self.latency = latency
+        self.in_flight = 0
+        self.calls = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def invoke_model(self, priority=None, **kwargs):
+        from botocore.exceptions import ClientError
+
+        with self._lock:
+            self.calls += 1
+            if self.in_flight >= self.quota:
+                self.throttled += 1
+                raise ClientError({"Error": {"Code": "ThrottlingException"}}, "InvokeModel")
+            self.in_flight += 1
+        try:
+            time.sleep(self.latency)
+            return {"body": BytesIO(json.dumps({"embedding": [0.0] * 8, "completion": "ok"}).encode())}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+def bench_scheduler(args):
+    """Ingestion massal + pertanyaan chat bersamaan: client langsung vs BedrockScheduler"""
+    from main import BedrockScheduler, ConcurrentBedrockEmbeddings
+
+    rows = []
+    for mode in ("direct", "scheduler"):
+        fake = FakeThrottlingBedrock(args.quota, args.latency_ms / 1000)
+        client = fake if mode == "direct" else BedrockScheduler(
+            fake, rate=args.quota / (args.latency_ms / 1000), burst=args.quota, max_in_flight=args.quota)
+        embeddings = ConcurrentBedrockEmbeddings(client=client)
+        texts = [f"chunk {i} {uuid.uuid4().hex}" for i in range(args.chunks)]
+        ingest = threading.Thread(target=embeddings.embed_documents, args=(texts,))
+        start = time.perf_counter()
+        ingest.start()
+
+        latencies, errors = [], 0
+        while ingest.is_alive():
+            question = f"pertanyaan {uuid.uuid4().hex}"
+            asked = time.perf_counter()
+            try:
+                # Jalur chat: embedding pertanyaan lalu satu panggilan LLM (tanpa retry, seperti LangChain)
+                embeddings.embed_query(question)
+                client.invoke_model(body=json.dumps({"prompt": question}), modelId="llm")
+                latencies.append(time.perf_counter() - asked)
+            except Exception:
+                errors += 1
+            time.sleep(args.chat_interval_ms / 1000)
+        ingest.join()
+        elapsed = time.perf_counter() - start
+
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] * 1000 if latencies else float("nan")
+        p95 = latencies[int(len(latencies) * 0.95)] * 1000 if latencies else float("nan")
+        rows.append([mode, f"{elapsed:.1f}", fake.calls, fake.throttled, len(latencies), errors,
+                     f"{p50:,.0f}", f"{p95:,.0f}"])
+
+    print(f"{args.chunks:,} chunk ingestion, kuota Bedrock {args.quota} paralel @ {args.latency_ms:.0f} ms")
+    print(tabulate(rows, headers=["Client", "Ingestion (s)", "Calls", "Throttled", "Chat OK", "Chat gagal",
+                                  "Chat p50 (ms)", "Chat p95 (ms)"], tablefmt="github"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Financial AI micro-benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    chat_db = subparsers.add_parser("chat-db", help="SQLite ChatManager ops/sec")
+    chat_db.add_argument("--messages", type=int, default=100_000)
+    chat_db.add_argument("--sessions", type=int, default=1_000)
+    chat_db.add_argument("--iterations", type=int, default=500)
+    chat_db.set_defaults(func=bench_chat_db)
+
+    vector_load = subparsers.add_parser("vector-load", help="FAISS startup time and RSS: pickle vs mmap")
+    vector_load.add_argument("--chunks", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    vector_load.add_argument("--dim", type=int, default=1536, help="Titan embed text v1 = 1536")
+    vector_load.set_defaults(func=bench_vector_load)
+
+    ttft = subparsers.add_parser("ttft", help="Time-to-first-token: blocking vs streaming (fake Bedrock)")
+    ttft.add_argument("--tokens", type=int, default=1024)
+    ttft.add_argument("--first-token-ms", type=float, default=400)
+    ttft.add_argument("--token-ms", type=float, default=5)
+    ttft.set_defaults(func=bench_ttft)
+
+    pdf_ingest = subparsers.add_parser("pdf-ingest", help="PDF ingestion: serial load_and_split vs streaming")
+    pdf_ingest.add_argument("--pages", type=int, nargs="+", default=[200, 500, 1000])
+    pdf_ingest.set_defaults(func=bench_pdf_ingest)
+
+    tabular_ingest = subparsers.add_parser("tabular-ingest", help="CSV ingestion: whole-file vs chunked")
+    tabular_ingest.add_argument("--rows", type=int, nargs="+", default=[100_000, 1_000_000])
+    tabular_ingest.set_defaults(func=bench_tabular_ingest)
+
+    summary = subparsers.add_parser("summary", help="Financial summary: legacy vs vectorized profile vs cache")
+    summary.add_argument("--wide-cols", type=int, default=500)
+    summary.add_argument("--tall-rows", type=int, default=5_000_000)
+    summary.set_defaults(func=bench_summary)
+
+    split = subparsers.add_parser("split", help="Text splitter throughput (MB/s): LangChain vs generator")
+    split.add_argument("--pages", type=int, default=2_000)
+    split.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    split.set_defaults(func=bench_split)
+
+    retrieval = subparsers.add_parser("retrieval", help="Recall@k: vector vs BM25 vs hybrid RRF (offline fixture)")
+    retrieval.add_argument("--companies", type=int, default=60)
+    retrieval.add_argument("--queries", type=int, default=2_000)
+    retrieval.add_argument("--k", type=int, nargs="+", default=[3, 5, 7])
+    retrieval.set_defaults(func=bench_retrieval)
+
+    context = subparsers.add_parser("context", help="Context size vs answer coverage: top-k vs token-budget packing")
+    context.add_argument("--companies", type=int, default=40)
+    context.add_argument("--queries", type=int, default=1_000)
+    context.add_argument("--k", type=int, nargs="+", default=[5, 7])
+    context.add_argument("--budgets", type=int, nargs="+", default=[1000, 1500])
+    context.set_defaults(func=bench_context)
+
+    ann = subparsers.add_parser("ann", help="ANN index: recall/latency/size vs flat baseline")
+    ann.add_argument("--vectors", type=int, default=200_000)
+    ann.add_argument("--dim", type=int, default=1536, help="Titan embed text v1 = 1536")
+    ann.add_argument("--queries", type=int, default=500)
+    ann.add_argument("--types", nargs="+", default=["flat", "hnsw", "ivf_flat", "ivf_pq"])
+    ann.set_defaults(func=bench_ann)
+
+    scheduler = subparsers.add_parser("scheduler", help="Bedrock throttling & chat latency: direct vs scheduler")
+    scheduler.add_argument("--chunks", type=int, default=2_000)
+    scheduler.add_argument("--quota", type=int, default=4, help="Request paralel sebelum Bedrock throttling")
+    scheduler.add_argument("--latency-ms", type=float, default=20)
+    scheduler.add_argument("--chat-interval-ms", type=float, default=100)
+    scheduler.set_defaults(func=bench_scheduler)
+
+    if len(sys.argv) == 4 and sys.argv[1] == "_tabular-ingest-child":
+        _tabular_ingest_child(sys.argv[2], sys.argv[3])
+        return
+
+    if len(sys.argv) == 4 and sys.argv[1] == "_pdf-ingest-child":
+        _pdf_ingest_child(sys.argv[2], sys.argv[3])
+        return
+
+    if len(sys.argv) == 5 and sys.argv[1] == "_vector-load-child":
+        _vector_load_child(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        return
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
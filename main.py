@@ -3,329 +3,4177 @@ import streamlit as st
 import os
 import uuid
 import pandas as pd
+import numpy as np
 import json
-from datetime import datetime
-from typing import List, Dict
+import copy
+import atexit
+import hashlib
+import heapq
+import bisect
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import queue
+import threading
+import time
+import math
+import re
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from typing import List, Dict, Iterable, Iterator
+from itertools import islice
+from collections import Counter, OrderedDict, deque
+from collections.abc import Mapping
 import sqlite3
+import faiss
+from openpyxl import load_workbook
 
-from langchain_community.embeddings import BedrockEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFLoader
+from langchain_core.embeddings import Embeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.base import Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain.schema import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain.llms.bedrock import Bedrock
+from langchain_community.llms.bedrock import _human_assistant_format
 from langchain.prompts import PromptTemplate
 from langchain.chains import RetrievalQA
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 from io import BytesIO
+from pdf_ingest import count_pdf_pages, get_executor, iter_pdf_pages
+from text_splitter import RecursiveTextSplitter, split_text_batch
+import metrics
 
 # Konfigurasi AWS
 AWS_REGION = "us-east-1"
 BUCKET_NAME = os.getenv("BUCKET_NAME", "rifai-ai-bucket")
 CHAT_DB_S3_KEY = "db/financial_ai_chats.db"
 
+# Vector store (FAISS) di S3
+VECTOR_INDEX_NAME = "financial_ai_index"
+# Jeda minimum antar pengecekan ETag di S3 untuk index yang sudah di-cache
+VECTOR_VERSION_CHECK_INTERVAL = float(os.getenv("VECTOR_VERSION_CHECK_INTERVAL", "10"))
+# "pickle": format save_local LangChain (.faiss + .pkl, dimuat penuh ke heap)
+# "mmap": .faiss di-mmap read-only + docstore SQLite (.docstore.db), dibaca lazy
+VECTOR_STORE_FORMAT = os.getenv("VECTOR_STORE_FORMAT", "pickle")
+VECTOR_CACHE_DIR = os.getenv("VECTOR_CACHE_DIR", "/tmp/financial_ai_vectors")
+# Koleksi (per user / perusahaan / tahun fiskal) disimpan sebagai shard index terpisah
+DEFAULT_COLLECTION = "default"
+VECTOR_MAX_RESIDENT_INDEXES = int(os.getenv("VECTOR_MAX_RESIDENT_INDEXES", "4"))
+VECTOR_FANOUT_WORKERS = int(os.getenv("VECTOR_FANOUT_WORKERS", "4"))
+# Tipe index pencarian: "auto" memilih menurut jumlah vektor, atau flat / hnsw / ivf_flat / ivf_pq.
+# Saat publish vektor baru ditambahkan ke index ANN yang ada; index dibangun ulang dari salinan flat
+# (.flat.faiss) hanya jika tipenya berubah, HNSW kehilangan vektor, atau list IVF tidak seimbang lagi
+ANN_INDEX_TYPE = os.getenv("ANN_INDEX_TYPE", "auto")
+ANN_HNSW_MIN_VECTORS = int(os.getenv("ANN_HNSW_MIN_VECTORS", "100000"))
+ANN_IVF_PQ_MIN_VECTORS = int(os.getenv("ANN_IVF_PQ_MIN_VECTORS", "1000000"))
+ANN_HNSW_M = int(os.getenv("ANN_HNSW_M", "32"))
+ANN_PQ_BYTES = int(os.getenv("ANN_PQ_BYTES", "0"))  # 0 = dim / 16 (Titan 1536 -> 96 byte per vektor)
+ANN_TRAIN_SAMPLE = int(os.getenv("ANN_TRAIN_SAMPLE", "100000"))
+# IVF-PQ: kandidat k * faktor di-rerank dengan jarak exact dari .flat.faiss yang di-mmap (format mmap saja)
+ANN_PQ_REFINE_FACTOR = int(os.getenv("ANN_PQ_REFINE_FACTOR", "8"))
+# nprobe / efSearch dipilih saat build: nilai terkecil yang mencapai recall@10 target terhadap flat
+ANN_TARGET_RECALL = float(os.getenv("ANN_TARGET_RECALL", "0.95"))
+ANN_TUNE_QUERIES = int(os.getenv("ANN_TUNE_QUERIES", "200"))
+ANN_IVF_MAX_IMBALANCE = float(os.getenv("ANN_IVF_MAX_IMBALANCE", "3"))
+# "append": dokumen baru ditambahkan ke index yang ada (upload ulang = replace per dokumen)
+# "replace": setiap upload membangun index baru dari nol (perilaku lama)
+INGESTION_MODE = os.getenv("INGESTION_MODE", "append")
+# Read-modify-write index diserialisasi antar proses dan pod lewat lock object di S3 (conditional write).
+# Lock diperpanjang selama dipegang; lock milik proses yang mati diambil alih setelah lease habis
+INDEX_LOCK_S3_PREFIX = "locks/"
+INDEX_LOCK_LEASE_SECONDS = float(os.getenv("INDEX_LOCK_LEASE_SECONDS", "60"))
+INDEX_LOCK_TIMEOUT = float(os.getenv("INDEX_LOCK_TIMEOUT", "900"))
+# File index setiap versi di-upload ke prefix sendiri (immutable); manifest <index>.version.json menunjuk
+# versi aktif dan diganti terakhir dengan compare-and-swap. Salinan hasil publish terakhir disimpan lokal
+# supaya ingestion berikutnya di pod yang sama tidak perlu download ulang index
+INDEX_VERSIONS_S3_PREFIX = "index-versions/"
+INDEX_WORK_DIR = os.getenv("INDEX_WORK_DIR", "/tmp/financial_ai_index_work")
+INDEX_PUBLISH_ATTEMPTS = int(os.getenv("INDEX_PUBLISH_ATTEMPTS", "3"))
+
+# LLM jawaban (Claude via Bedrock)
+LLM_MODEL_ID = "anthropic.claude-v2:1"
+LLM_MAX_TOKENS = 1024
+
+# "hybrid": hasil FAISS digabung dengan BM25 (index kata kunci .bm25.db) lewat reciprocal rank fusion
+# "vector": similarity search saja (perilaku lama)
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+HYBRID_FETCH_K = int(os.getenv("HYBRID_FETCH_K", "20"))  # kandidat per retriever per shard
+RRF_K = int(os.getenv("RRF_K", "60"))
+# RetrievalQA: chain dibangun sekali per (koleksi, k, prompt) dan dipakai ulang.
+# Hybrid cukup 5 chunk (recall@5 hybrid > recall@7 vector, lihat `benchmark.py retrieval`)
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "5" if RETRIEVAL_MODE == "hybrid" else "7"))
+QA_CHAIN_CACHE_SIZE = int(os.getenv("QA_CHAIN_CACHE_SIZE", "32"))
+# Context packing: kandidat retrieval di-rerank (leksikal + urutan retrieval), chunk yang overlap
+# digabung, lalu konteks diisi sampai budget token (estimasi ~4 karakter per token)
+CONTEXT_PACKING = os.getenv("CONTEXT_PACKING", "true").lower() == "true"
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", "12"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+CONTEXT_RERANK_WEIGHT = float(os.getenv("CONTEXT_RERANK_WEIGHT", "0.6"))  # 0 = urutan retrieval saja
+CONTEXT_MIN_OVERLAP = 50
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+# Cache jawaban per (versi index, pertanyaan ternormalisasi) + lookup semantik opsional.
+# Semantik nonaktif secara default: "laba Q1 2023" dan "laba Q2 2023" nyaris identik secara embedding;
+# jika diaktifkan, angka/tahun/kuartal kedua pertanyaan tetap harus sama persis
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "512"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_SEMANTIC = os.getenv("ANSWER_CACHE_SEMANTIC", "false").lower() == "true"
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.95"))
+
+# Ingestion streaming: halaman PDF diekstrak paralel di process pool, chunk di-embed per batch
+PDF_INGEST_WORKERS = int(os.getenv("PDF_INGEST_WORKERS", str(min(os.cpu_count() or 1, 4))))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+INGEST_EMBED_BATCH_SIZE = int(os.getenv("INGEST_EMBED_BATCH_SIZE", "64"))
+# Splitting biasanya cukup serial; >1 memakai process pool yang sama dengan ekstraksi PDF
+SPLIT_WORKERS = int(os.getenv("SPLIT_WORKERS", "1"))
+SPLIT_DOCUMENTS_PER_TASK = int(os.getenv("SPLIT_DOCUMENTS_PER_TASK", "16"))
+
+# Deduplikasi chunk sebelum embedding: boilerplate (header, footer, disclaimer) yang berulang tiap halaman
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() == "true"
+DEDUP_SIMILARITY_THRESHOLD = float(os.getenv("DEDUP_SIMILARITY_THRESHOLD", "0.9"))  # estimasi Jaccard MinHash
+DEDUP_NUM_PERM = int(os.getenv("DEDUP_NUM_PERM", "128"))
+DEDUP_BANDS = int(os.getenv("DEDUP_BANDS", "32"))  # LSH: DEDUP_NUM_PERM / DEDUP_BANDS baris per band
+DEDUP_SHINGLE_WORDS = int(os.getenv("DEDUP_SHINGLE_WORDS", "5"))
+
+# Ingestion CSV/XLSX: dibaca per blok baris, setiap dokumen berisi header + beberapa baris
+TABULAR_READ_CHUNK_ROWS = int(os.getenv("TABULAR_READ_CHUNK_ROWS", "50000"))
+TABULAR_ROWS_PER_DOCUMENT = int(os.getenv("TABULAR_ROWS_PER_DOCUMENT", "25"))
+TABULAR_MAX_CHARS = int(os.getenv("TABULAR_MAX_CHARS", "1500"))  # sama dengan chunk_size text splitter
+FINANCIAL_COLUMN_KEYWORDS = ['revenue', 'income', 'profit', 'expense', 'cost', 'sales', 'pendapatan', 'laba', 'biaya',
+                             'penjualan']
+FINANCIAL_COLUMN_PATTERN = "|".join(map(re.escape, FINANCIAL_COLUMN_KEYWORDS))
+# Nilai uang berformat teks: "Rp 1.234.567", "(1,234.50)", "$ 1,000", "-2.500,75"
+MONEY_VALUE_PATTERN = r"^\(?\s*-?\s*(?:rp\.?|idr|usd|us\$|\$)?\s*-?\s*\d[\d.,\s]*\)?$"
+MONEY_MARKER_PATTERN = r"rp|idr|usd|\$|\d[.,]\d{3}(?:[.,]|$)"
+# Kuantil file multi-blok dihitung dari sampel baris proporsional sebesar ini
+PROFILE_SAMPLE_ROWS = int(os.getenv("PROFILE_SAMPLE_ROWS", "100000"))
+PROFILE_CACHE_MAX_ENTRIES = int(os.getenv("PROFILE_CACHE_MAX_ENTRIES", "64"))
+
+# Tabel CSV/XLSX disimpan ke SQLite per koleksi untuk pertanyaan numerik (agregasi lokal)
+TABLE_STORE_DIR = os.getenv("TABLE_STORE_DIR", "/tmp/financial_ai_tables")
+TABLE_FILTER_MAX_VALUES = int(os.getenv("TABLE_FILTER_MAX_VALUES", "200"))
+NUMERIC_QUERY_MAX_GROUPS = int(os.getenv("NUMERIC_QUERY_MAX_GROUPS", "50"))
+# "direct": hasil agregasi langsung jadi jawaban; "llm": hasil kecil dikirim ke LLM untuk dinarasikan
+NUMERIC_ANSWER_MODE = os.getenv("NUMERIC_ANSWER_MODE", "direct")
+DATE_COLUMN_PATTERN = re.compile(r"tanggal|tgl|date|periode|period|waktu|time")
+
+# Embedding Bedrock: worker pool terbatas + backoff adaptif saat throttling
+EMBEDDING_MODEL_ID = "amazon.titan-embed-text-v1"
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "8"))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "6"))
+EMBEDDING_BACKOFF_BASE = 0.5
+EMBEDDING_BACKOFF_MAX = 20.0
+# Cache embedding content-addressed: SQLite lokal (LRU) + tier S3 opsional
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "/tmp/financial_ai_embeddings.db")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+EMBEDDING_CACHE_S3_PREFIX = os.getenv("EMBEDDING_CACHE_S3_PREFIX", "")  # kosong = tier S3 nonaktif
+# last_access (LRU) hanya diperbarui jika lebih tua dari ini: cache hit tidak selalu menulis ke SQLite
+EMBEDDING_CACHE_TOUCH_SECONDS = float(os.getenv("EMBEDDING_CACHE_TOUCH_SECONDS", "3600"))
+THROTTLING_ERROR_CODES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException",
+}
+
+# Scheduler Bedrock per proses: semua sesi (chat + embedding ingestion) lewat satu token bucket dan batas
+# request paralel; chat didahulukan dari embedding massal, request identik yang sedang berjalan digabung
+BEDROCK_REQUESTS_PER_SECOND = float(os.getenv("BEDROCK_REQUESTS_PER_SECOND", "10"))
+BEDROCK_BURST = int(os.getenv("BEDROCK_BURST", "20"))
+BEDROCK_MAX_IN_FLIGHT = int(os.getenv("BEDROCK_MAX_IN_FLIGHT", "8"))
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+QUEUE_WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Antrian ingestion: UI hanya enqueue, worker process terpisah (`python main.py --ingest-worker`) memproses.
+# File upload + manifest job disimpan di S3 sehingga job bisa dilanjutkan setelah pod restart
+INGEST_JOBS_DB = os.getenv("INGEST_JOBS_DB", "financial_ai_jobs.db")
+INGEST_SPOOL_DIR = os.getenv("INGEST_SPOOL_DIR", "/tmp/financial_ai_ingest")
+INGEST_JOBS_S3_PREFIX = "ingest-jobs/"
+# Heartbeat per pod: job milik pod yang heartbeat-nya basi (pod sudah hilang) diambil alih pod lain
+INGEST_PODS_S3_PREFIX = "ingest-pods/"
+# Backlog bersama (jumlah manifest job aktif di S3) untuk metric HPA; list S3 paling sering sekali per interval ini
+INGEST_BACKLOG_REFRESH = float(os.getenv("INGEST_BACKLOG_REFRESH", "30"))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "1"))
+INGEST_WORKER_NICE = int(os.getenv("INGEST_WORKER_NICE", "10"))  # chat tetap responsif di pod 1 CPU
+INGEST_JOB_LEASE_SECONDS = float(os.getenv("INGEST_JOB_LEASE_SECONDS", "120"))
+INGEST_JOB_MAX_ATTEMPTS = int(os.getenv("INGEST_JOB_MAX_ATTEMPTS", "3"))
+INGEST_POLL_INTERVAL = float(os.getenv("INGEST_POLL_INTERVAL", "2"))
+
 # Database untuk menyimpan chat history
 DB_PATH = "financial_ai_chats.db"
 
+# Ukuran halaman untuk sidebar sessions dan jendela pesan chat
+SESSION_PAGE_SIZE = 10
+MESSAGE_PAGE_SIZE = 30
+
+# Tuning koneksi SQLite (WAL + pragma untuk beban baca/tulis kecil yang sering)
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "8"))
+SQLITE_POOL_TIMEOUT = float(os.getenv("SQLITE_POOL_TIMEOUT", "30"))
+SQLITE_STATEMENT_CACHE_SIZE = 256
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 268435456,  # 256 MB
+    "cache_size": -65536,  # 64 MB (nilai negatif = KiB)
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,
+}
+
+# Sync database ke S3 di background: upload digabung per interval atau
+# begitu perubahan yang tertunda melewati ambang ukuran
+S3_SYNC_INTERVAL = float(os.getenv("S3_SYNC_INTERVAL", "30"))
+S3_SYNC_MAX_PENDING_BYTES = int(os.getenv("S3_SYNC_MAX_PENDING_BYTES", str(256 * 1024)))
+
+# Observability: endpoint Prometheus (/metrics) di port terpisah dari Streamlit; span per tahap pipeline
+# ditulis ke TRACE_FILE (JSON lines) jika diisi
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))  # 0 = endpoint nonaktif
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+SQLITE_SECONDS = metrics.histogram(
+    "financial_ai_sqlite_seconds", "Durasi pinjam koneksi SQLite (tunggu pool + query + commit)", ("db",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0, 5.0)
+)
+EXTERNAL_CALL_SECONDS = metrics.histogram(
+    "financial_ai_external_call_seconds", "Durasi panggilan AWS (termasuk retry botocore)", ("service", "operation")
+)
+EXTERNAL_CALL_ERRORS = metrics.counter(
+    "financial_ai_external_call_errors_total", "Panggilan AWS yang gagal", ("service", "operation", "code")
+)
+QA_STAGE_SECONDS = metrics.histogram("financial_ai_qa_seconds", "Latensi jawaban QA per tahap", ("stage",))
+QA_PROMPT_TOKENS = metrics.histogram(
+    "financial_ai_qa_prompt_tokens", "Estimasi token prompt QA",
+    buckets=(250, 500, 1000, 1500, 2000, 3000, 4000, 8000)
+)
+
+# Replikasi chat history: changelog append-only (segment JSONL) + snapshot berkala
+POD_ID = os.getenv("HOSTNAME") or uuid.uuid4().hex[:12]
+CHAT_CHANGELOG_PREFIX = "db/changelog/"
+CHAT_SEGMENTS_PREFIX = "db/segments/"  # format lama, hanya dibaca selama rolling upgrade
+CHAT_SNAPSHOTS_PREFIX = "db/snapshots/"
+CHAT_SNAPSHOT_MANIFEST_KEY = "db/snapshots/LATEST.json"
+CHAT_SNAPSHOT_EVERY_SEGMENTS = int(os.getenv("CHAT_SNAPSHOT_EVERY_SEGMENTS", "50"))
+CHAT_SEGMENT_MAX_EVENTS = 1000
+# Toleransi clock skew / upload lambat antar pod saat membaca segment format lama
+CHAT_REPLICATION_GRACE_SECONDS = int(os.getenv("CHAT_REPLICATION_GRACE_SECONDS", "300"))
+CHAT_SEGMENT_RETENTION_SECONDS = int(os.getenv("CHAT_SEGMENT_RETENTION_SECONDS", str(24 * 3600)))
+# Tombstone session yang dihapus harus hidup lebih lama dari event terlambat pod lain (changelog yang
+# belum ter-upload + retensi segment)
+CHAT_TOMBSTONE_RETENTION_SECONDS = int(os.getenv("CHAT_TOMBSTONE_RETENTION_SECONDS", str(7 * 24 * 3600)))
+
+
+class SQLiteConnectionPool:
+    """Pool koneksi SQLite persisten (WAL mode) yang aman dipakai lintas thread"""
+
+    def __init__(self, db_path: str = DB_PATH, max_connections: int = SQLITE_POOL_SIZE):
+        self.db_path = db_path
+        self.max_connections = max_connections
+        self._pool = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._bootstrap_lock = threading.Lock()
+        self._bootstrapped = False
+
+    def _open_connection(self) -> sqlite3.Connection:
+        """Membuka koneksi baru dengan pragma yang sudah di-tuning"""
+        # cached_statements: sqlite3 menyimpan prepared statement per koneksi,
+        # sehingga query yang sama tidak di-parse ulang selama koneksi hidup
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=SQLITE_POOL_TIMEOUT,
+            check_same_thread=False,
+            cached_statements=SQLITE_STATEMENT_CACHE_SIZE
+        )
+        for pragma, value in SQLITE_PRAGMAS.items():
+            conn.execute(f"PRAGMA {pragma}={value}")
+        return conn
+
+    def _checkout(self) -> sqlite3.Connection:
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.max_connections
+            if can_create:
+                self._created += 1
+
+        if can_create:
+            try:
+                return self._open_connection()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        return self._pool.get(timeout=SQLITE_POOL_TIMEOUT)
+
+    @contextmanager
+    def connection(self):
+        """Pinjam koneksi dari pool; commit jika sukses, rollback jika error"""
+        start = time.perf_counter()
+        conn = self._checkout()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._pool.put(conn)
+            SQLITE_SECONDS.observe(time.perf_counter() - start, db=os.path.basename(self.db_path))
+
+    def bootstrap_once(self, func):
+        """Menjalankan func satu kali sebelum koneksi pertama dibuka (mis. download dari S3)"""
+        with self._bootstrap_lock:
+            if not self._bootstrapped:
+                func()
+                self._bootstrapped = True
+
+    def backup_to(self, target_path: str):
+        """Salin snapshot konsisten database (termasuk isi WAL) ke file lain"""
+        with self.connection() as conn:
+            target = sqlite3.connect(target_path)
+            try:
+                conn.backup(target)
+            finally:
+                target.close()
+
+    def close_all(self):
+        """Tutup semua koneksi yang sedang idle di pool"""
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+@st.cache_resource
+def init_db_pool():
+    return SQLiteConnectionPool(DB_PATH)
+
+
+class S3SyncWorker:
+    """Worker background yang menggabungkan perubahan dan meng-upload database ke S3"""
+
+    def __init__(self, upload_func, interval: float = S3_SYNC_INTERVAL,
+                 max_pending_bytes: int = S3_SYNC_MAX_PENDING_BYTES, poll_func=None):
+        self.upload_func = upload_func
+        self.poll_func = poll_func
+        self.interval = interval
+        self.max_pending_bytes = max_pending_bytes
+        self._last_poll = time.monotonic()
+
+        self._cond = threading.Condition()
+        self._upload_lock = threading.Lock()
+        self._pending_marks = 0
+        self._pending_bytes = 0
+        self._dirty_since = None
+        self._stopped = False
+
+        # Metrics
+        self.uploads = 0
+        self.failures = 0
+        self.bytes_uploaded = 0
+        self.last_success_at = None
+        self.last_duration = None
+        self.last_error = None
+
+        self._thread = threading.Thread(target=self._run, name="s3-sync-worker", daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)
+
+    def mark_dirty(self, nbytes: int = 0):
+        """Tandai ada perubahan; tidak pernah menunggu S3"""
+        with self._cond:
+            self._pending_marks += 1
+            self._pending_bytes += nbytes
+            if self._dirty_since is None:
+                # Bangunkan worker supaya mulai menghitung interval
+                self._dirty_since = time.monotonic()
+                self._cond.notify()
+            elif self._pending_bytes >= self.max_pending_bytes:
+                self._cond.notify()
+
+    def _is_due(self) -> bool:
+        if not self._pending_marks:
+            return False
+        return (
+                self._stopped or
+                self._pending_bytes >= self.max_pending_bytes or
+                time.monotonic() - self._dirty_since >= self.interval
+        )
+
+    def _is_poll_due(self) -> bool:
+        return bool(self.poll_func) and time.monotonic() - self._last_poll >= self.interval
+
+    def _next_timeout(self):
+        timeouts = []
+        if self._dirty_since is not None:
+            timeouts.append(self.interval - (time.monotonic() - self._dirty_since))
+        if self.poll_func:
+            timeouts.append(self.interval - (time.monotonic() - self._last_poll))
+        return max(0.0, min(timeouts)) if timeouts else None
+
+    def _poll(self):
+        # Tarik perubahan dari pod lain saat tidak ada yang perlu di-upload
+        with self._upload_lock:
+            try:
+                self.poll_func()
+            except Exception as e:
+                print(f"❌ Failed to pull changes from S3: {e}")
+            self._last_poll = time.monotonic()
+
+    def _take_pending(self):
+        marks, nbytes = self._pending_marks, self._pending_bytes
+        self._pending_marks, self._pending_bytes, self._dirty_since = 0, 0, None
+        return marks, nbytes
+
+    def _restore_pending(self, marks: int, nbytes: int):
+        # Upload gagal: kembalikan tanda dirty supaya dicoba lagi di interval berikutnya
+        with self._cond:
+            self._pending_marks += marks
+            self._pending_bytes += nbytes
+            self._dirty_since = time.monotonic()
+
+    @metrics.traced("chat.s3_upload")
+    def _upload(self) -> bool:
+        started = time.monotonic()
+        try:
+            size = self.upload_func()
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e)
+            print(f"❌ Failed to sync to S3: {e}")
+            return False
+
+        self.uploads += 1
+        self.bytes_uploaded += size
+        self._last_poll = time.monotonic()
+        self.last_success_at = datetime.now()
+        self.last_duration = time.monotonic() - started
+        self.last_error = None
+        print(f"✅ Database synced to S3 ({size:,} bytes)")
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._is_due() and not self._is_poll_due():
+                    if self._stopped:
+                        return
+                    self._cond.wait(self._next_timeout())
+                if not self._is_due():
+                    marks = None
+                else:
+                    marks, nbytes = self._take_pending()
+
+            if marks is None:
+                self._poll()
+                continue
+
+            with self._upload_lock:
+                if not self._upload():
+                    self._restore_pending(marks, nbytes)
+
+            if self._stopped:
+                return
+
+    def flush(self) -> bool:
+        """Upload sekarang juga (dipakai untuk sync manual dan saat shutdown)"""
+        with self._cond:
+            marks, nbytes = self._take_pending()
+        with self._upload_lock:
+            success = self._upload()
+        if not success:
+            self._restore_pending(marks, nbytes)
+        return success
+
+    def shutdown(self, timeout: float = 30):
+        """Hentikan worker dan upload perubahan terakhir"""
+        with self._cond:
+            if self._stopped:
+                return
+            self._stopped = True
+            has_pending = self._pending_marks > 0
+            self._cond.notify()
+        self._thread.join(timeout)
+        if has_pending and self._pending_marks:
+            self.flush()
+
+    def stats(self) -> Dict:
+        """Metrics sync: antrean perubahan, sync terakhir, total byte"""
+        with self._cond:
+            queue_depth = self._pending_marks
+            pending_bytes = self._pending_bytes
+        return {
+            'queue_depth': queue_depth,
+            'pending_bytes': pending_bytes,
+            'uploads': self.uploads,
+            'failures': self.failures,
+            'bytes_uploaded': self.bytes_uploaded,
+            'last_success_at': self.last_success_at.isoformat() if self.last_success_at else None,
+            'last_duration': self.last_duration,
+            'last_error': self.last_error
+        }
+
+
+def utc_timestamp() -> str:
+    """Timestamp UTC dengan format yang sama seperti CURRENT_TIMESTAMP SQLite"""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def segment_time_ms(key: str) -> int:
+    """Waktu (ms) di awal nama file segment/snapshot; -1 untuk key lain (mis. LATEST.json)"""
+    prefix = key.rsplit("/", 1)[-1].split("-", 1)[0]
+    return int(prefix) if prefix.isdigit() else -1
+
+
+def apply_chat_change(cursor, op: str, payload: Dict):
+    """Terapkan satu perubahan chat secara idempotent (tulis lokal maupun replay segment).
+
+    Session yang sudah dihapus meninggalkan tombstone: event dari pod lain yang datang
+    terlambat (pesan baru, ganti judul) tidak menghidupkannya kembali.
+    """
+    session_id = payload.get('session_id', payload.get('id'))
+    if op != "delete_session" and cursor.execute(
+            "SELECT 1 FROM chat_session_tombstones WHERE id = ?", (session_id,)
+    ).fetchone():
+        return
+    if op == "create_session":
+        cursor.execute(
+            "INSERT OR IGNORE INTO chat_sessions (id, title, user_id, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (payload['id'], payload['title'], payload['user_id'], payload['timestamp'], payload['timestamp'])
+        )
+    elif op == "add_message":
+        cursor.execute(
+            "INSERT OR IGNORE INTO chat_messages (uid, session_id, role, content, timestamp) VALUES (?, ?, ?, ?, ?)",
+            (payload['uid'], payload['session_id'], payload['role'], payload['content'], payload['timestamp'])
+        )
+        cursor.execute(
+            "UPDATE chat_sessions SET updated_at = MAX(COALESCE(updated_at, ''), ?) WHERE id = ?",
+            (payload['timestamp'], payload['session_id'])
+        )
+    elif op == "delete_session":
+        cursor.execute("DELETE FROM chat_messages WHERE session_id = ?", (payload['id'],))
+        cursor.execute("DELETE FROM chat_sessions WHERE id = ?", (payload['id'],))
+        cursor.execute(
+            "INSERT OR IGNORE INTO chat_session_tombstones (id, deleted_at) VALUES (?, ?)",
+            (payload['id'], payload.get('timestamp') or utc_timestamp())
+        )
+    elif op == "update_session_title":
+        cursor.execute(
+            "UPDATE chat_sessions SET title = ?, updated_at = MAX(COALESCE(updated_at, ''), ?) WHERE id = ?",
+            (payload['title'], payload['timestamp'], payload['id'])
+        )
+    else:
+        raise ValueError(f"Unknown chat change: {op}")
+
+
+class ChatReplicator:
+    """Replikasi chat history ke S3 sebagai changelog append-only + snapshot berkala
+
+    Layout di bucket:
+      db/changelog/<pod>/<ts_ms>-<seq>.jsonl  batch perubahan dari satu pod
+      db/snapshots/<ts_ms>-<pod>.db           snapshot database hasil compaction
+      db/snapshots/LATEST.json                manifest snapshot terbaru
+      db/segments/<ts_ms>-<pod>-<seq>.jsonl   format segment lama, hanya dibaca
+
+    Snapshot ikut membawa watermark per pod milik pembuatnya, jadi pod yang bootstrap
+    melanjutkan replay tepat dari segment yang belum ada di snapshot.
+    """
+
+    def __init__(self, db_pool: SQLiteConnectionPool, s3_client, bucket: str = BUCKET_NAME,
+                 pod_id: str = POD_ID):
+        self.db = db_pool
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.pod_id = pod_id
+        self._lock = threading.RLock()
+        self._segments_since_snapshot = 0
+
+        # Metrics
+        self.segments_pushed = 0
+        self.segments_applied = 0
+        self.snapshots_written = 0
+
+    @staticmethod
+    def _now_ms() -> int:
+        return int(time.time() * 1000)
+
+    @staticmethod
+    def _get_state(conn, key: str, default=None):
+        row = conn.execute("SELECT value FROM chat_replication_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    @staticmethod
+    def _set_state(conn, key: str, value):
+        conn.execute(
+            "INSERT OR REPLACE INTO chat_replication_state (key, value) VALUES (?, ?)",
+            (key, str(value))
+        )
+
+    def bootstrap(self):
+        """Download snapshot terbaru ke file database lokal.
+
+        Harus dipanggil sebelum koneksi pertama dibuka. Mengembalikan waktu
+        snapshot (ms) sebagai titik awal replay segment.
+        """
+        try:
+            manifest = json.loads(
+                self.s3_client.get_object(Bucket=self.bucket, Key=CHAT_SNAPSHOT_MANIFEST_KEY)["Body"].read()
+            )
+        except Exception:
+            manifest = None
+
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(self.db.db_path + suffix):
+                os.remove(self.db.db_path + suffix)
+
+        if manifest:
+            self.s3_client.download_file(self.bucket, manifest['snapshot_key'], self.db.db_path)
+            return int(manifest['created_at_ms'])
+
+        # Migrasi dari format lama: seluruh file database di satu key
+        self.s3_client.download_file(self.bucket, CHAT_DB_S3_KEY, self.db.db_path)
+        return 0
+
+    def reset_local_state(self, watermark_ms: int):
+        """Buang changelog milik pod pembuat snapshot dan set titik awal replay"""
+        with self.db.connection() as conn:
+            conn.execute("DELETE FROM chat_changelog")
+            self._set_state(conn, "pull_watermark_ms", watermark_ms)
+
+    def push_segment(self) -> int:
+        """Upload perubahan lokal yang belum terkirim sebagai satu segment JSONL"""
+        with self._lock:
+            with self.db.connection() as conn:
+                rows = conn.execute(
+                    "SELECT seq, op, payload FROM chat_changelog ORDER BY seq LIMIT ?",
+                    (CHAT_SEGMENT_MAX_EVENTS,)
+                ).fetchall()
+                last_key = conn.execute(
+                    "SELECT segment_key FROM chat_pod_watermarks WHERE pod_id = ?", (self.pod_id,)
+                ).fetchone()
+            if not rows:
+                return 0
+
+            body = "\n".join(
+                json.dumps({'op': op, 'payload': json.loads(payload)}) for _, op, payload in rows
+            ).encode("utf-8")
+            # Key segment satu pod harus naik terus (pembaca memakai StartAfter), juga jika clock mundur
+            created_at_ms = self._now_ms()
+            if last_key:
+                created_at_ms = max(created_at_ms, segment_time_ms(last_key[0]) + 1)
+            key = f"{CHAT_CHANGELOG_PREFIX}{self.pod_id}/{created_at_ms:013d}-{rows[0][0]:012d}.jsonl"
+            self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=body)
+
+            with self.db.connection() as conn:
+                conn.execute("DELETE FROM chat_changelog WHERE seq <= ?", (rows[-1][0],))
+                self._set_pod_watermark(conn, self.pod_id, key)
+
+            self.segments_pushed += 1
+            self._segments_since_snapshot += 1
+            return len(body)
+
+    @staticmethod
+    def _set_pod_watermark(conn, pod_id: str, segment_key: str):
+        conn.execute(
+            "INSERT OR REPLACE INTO chat_pod_watermarks (pod_id, segment_key) VALUES (?, ?)", (pod_id, segment_key)
+        )
+
+    def _apply_segment(self, key: str, pod_id: str = None):
+        """Replay satu segment; watermark pod ikut diperbarui dalam transaksi yang sama"""
+        body = self.s3_client.get_object(Bucket=self.bucket, Key=key)["Body"].read().decode("utf-8")
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            for line in body.splitlines():
+                if line.strip():
+                    event = json.loads(line)
+                    apply_chat_change(cursor, event['op'], event['payload'])
+            if pod_id is None:
+                cursor.execute("INSERT OR IGNORE INTO chat_applied_segments (segment_key) VALUES (?)", (key,))
+            else:
+                self._set_pod_watermark(cursor, pod_id, key)
+
+    def pull_segments(self) -> int:
+        """Replay segment dari pod lain yang belum diterapkan secara lokal.
+
+        Segment disimpan per pod (`db/changelog/<pod>/`) dan satu pod meng-upload segment-nya
+        berurutan, jadi cukup dibaca mulai setelah segment terakhir yang sudah diterapkan dari
+        pod itu: segment yang terlambat terlihat tidak pernah terlewat, berapapun selisih clock antar pod.
+        """
+        with self._lock:
+            with self.db.connection() as conn:
+                watermarks = dict(conn.execute("SELECT pod_id, segment_key FROM chat_pod_watermarks").fetchall())
+
+            applied = 0
+            paginator = self.s3_client.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=CHAT_CHANGELOG_PREFIX, Delimiter="/"):
+                for prefix in page.get("CommonPrefixes", []):
+                    pod_prefix = prefix["Prefix"]
+                    pod_id = pod_prefix[len(CHAT_CHANGELOG_PREFIX):-1]
+                    start = {'StartAfter': watermarks[pod_id]} if pod_id in watermarks else {}
+                    for pod_page in paginator.paginate(Bucket=self.bucket, Prefix=pod_prefix, **start):
+                        for obj in pod_page.get("Contents", []):
+                            self._apply_segment(obj["Key"], pod_id)
+                            applied += 1
+
+            applied += self._pull_legacy_segments()
+            with self.db.connection() as conn:
+                conn.execute(
+                    "DELETE FROM chat_session_tombstones WHERE deleted_at < ?",
+                    (datetime.fromtimestamp(time.time() - CHAT_TOMBSTONE_RETENTION_SECONDS, timezone.utc)
+                     .strftime("%Y-%m-%d %H:%M:%S"),)
+                )
+            self.segments_applied += applied
+            return applied
+
+    def _pull_legacy_segments(self) -> int:
+        """Segment format lama (`db/segments/<ts>-<pod>-<seq>.jsonl`) dari pod versi sebelumnya.
+
+        Hanya untuk masa rolling upgrade: dibaca dengan watermark global dikurangi grace,
+        dan hilang sendiri setelah masa retensi.
+        """
+        grace_ms = CHAT_REPLICATION_GRACE_SECONDS * 1000
+        with self.db.connection() as conn:
+            watermark = int(self._get_state(conn, "pull_watermark_ms", 0))
+
+        applied = 0
+        newest = watermark
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        pages = paginator.paginate(
+            Bucket=self.bucket,
+            Prefix=CHAT_SEGMENTS_PREFIX,
+            StartAfter=f"{CHAT_SEGMENTS_PREFIX}{max(0, watermark - grace_ms):013d}"
+        )
+        for page in pages:
+            for obj in page.get("Contents", []):
+                key = obj["Key"]
+                newest = max(newest, segment_time_ms(key))
+
+                with self.db.connection() as conn:
+                    if conn.execute(
+                            "SELECT 1 FROM chat_applied_segments WHERE segment_key = ?", (key,)
+                    ).fetchone():
+                        continue
+                self._apply_segment(key)
+                applied += 1
+
+        with self.db.connection() as conn:
+            self._set_state(conn, "pull_watermark_ms", newest)
+            # Daftar segment yang sudah diterapkan cukup disimpan selama jendela grace
+            conn.execute(
+                "DELETE FROM chat_applied_segments WHERE segment_key < ?",
+                (f"{CHAT_SEGMENTS_PREFIX}{max(0, newest - 2 * grace_ms):013d}",)
+            )
+        return applied
+
+    def write_snapshot(self) -> int:
+        """Compaction: upload snapshot database penuh dan perbarui manifest"""
+        with self._lock:
+            created_at_ms = self._now_ms()
+            key = f"{CHAT_SNAPSHOTS_PREFIX}{created_at_ms:013d}-{self.pod_id}.db"
+            snapshot_path = f"{self.db.db_path}.snapshot"
+            self.db.backup_to(snapshot_path)
+            try:
+                size = os.path.getsize(snapshot_path)
+                self.s3_client.upload_file(snapshot_path, self.bucket, key)
+            finally:
+                if os.path.exists(snapshot_path):
+                    os.remove(snapshot_path)
+
+            manifest = {'snapshot_key': key, 'created_at_ms': created_at_ms, 'pod_id': self.pod_id}
+            self.s3_client.put_object(
+                Bucket=self.bucket, Key=CHAT_SNAPSHOT_MANIFEST_KEY, Body=json.dumps(manifest).encode("utf-8")
+            )
+            self.snapshots_written += 1
+            self._segments_since_snapshot = 0
+            self.prune(created_at_ms - CHAT_SEGMENT_RETENTION_SECONDS * 1000, keep_key=key)
+            return size
+
+    def prune(self, before_ms: int, keep_key: str = None):
+        """Hapus segment dan snapshot yang lebih tua dari masa retensi"""
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for prefix in (CHAT_CHANGELOG_PREFIX, CHAT_SEGMENTS_PREFIX, CHAT_SNAPSHOTS_PREFIX):
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+                stale = [
+                    {'Key': obj["Key"]} for obj in page.get("Contents", [])
+                    if obj["Key"] not in (keep_key, CHAT_SNAPSHOT_MANIFEST_KEY) and segment_time_ms(obj["Key"]) < before_ms
+                ]
+                if stale:
+                    self.s3_client.delete_objects(Bucket=self.bucket, Delete={'Objects': stale})
+
+        # Pod yang semua segment-nya sudah terhapus (pod lama) tidak perlu watermark lagi
+        with self.db.connection() as conn:
+            watermarks = conn.execute("SELECT pod_id, segment_key FROM chat_pod_watermarks").fetchall()
+            conn.executemany(
+                "DELETE FROM chat_pod_watermarks WHERE pod_id = ?",
+                [(pod_id,) for pod_id, key in watermarks if pod_id != self.pod_id and segment_time_ms(key) < before_ms]
+            )
+
+    def sync(self) -> int:
+        """Satu siklus replikasi: push perubahan lokal, tarik perubahan pod lain, compaction"""
+        with self._lock:
+            uploaded = self.push_segment()
+            self.pull_segments()
+            if self._segments_since_snapshot >= CHAT_SNAPSHOT_EVERY_SEGMENTS:
+                uploaded += self.write_snapshot()
+            return uploaded
+
+    def stats(self) -> Dict:
+        with self.db.connection() as conn:
+            changelog_depth = conn.execute("SELECT COUNT(*) FROM chat_changelog").fetchone()[0]
+        return {
+            'changelog_depth': changelog_depth,
+            'segments_pushed': self.segments_pushed,
+            'segments_applied': self.segments_applied,
+            'snapshots_written': self.snapshots_written
+        }
+
+
+@st.cache_resource
+def init_replicator():
+    return ChatReplicator(init_db_pool(), instrument_aws_client(boto3.client("s3")))
+
+
+@st.cache_resource
+def init_sync_worker():
+    replicator = init_replicator()
+    return S3SyncWorker(replicator.sync, poll_func=replicator.pull_segments)
+
+
+class ChatManager:
+    """Mengelola chat sessions dan persistensi dengan S3 sync"""
+
+    def __init__(self, db_pool: SQLiteConnectionPool = None, enable_s3_sync: bool = True):
+        self.db = db_pool or init_db_pool()
+        self.enable_s3_sync = enable_s3_sync
+        self.replicator = None
+        self.sync_worker = None
+        # Bootstrap dari S3 hanya sekali per proses: menimpa file database
+        # yang sedang dipakai koneksi lain (WAL) bisa merusak data
+        if enable_s3_sync:
+            self.replicator = init_replicator()
+            self.db.bootstrap_once(self.sync_from_s3)
+            self.sync_worker = init_sync_worker()
+        self.init_database()
+
+    def sync_from_s3(self):
+        """Bootstrap database dari snapshot S3 terbaru lalu replay segment setelahnya"""
+        try:
+            watermark = self.replicator.bootstrap()
+            print("✅ Database snapshot downloaded from S3")
+        except Exception as e:
+            watermark = None
+            print(f"ℹ️ No existing database in S3 or error: {e}")
+
+        self.init_database()
+        if watermark is not None:
+            self.replicator.reset_local_state(watermark)
+
+        try:
+            applied = self.replicator.pull_segments()
+            print(f"✅ Replayed {applied} changelog segments from S3")
+        except Exception as e:
+            print(f"❌ Failed to replay changelog from S3: {e}")
+
+    @metrics.traced("chat.sync_to_s3")
+    def sync_to_s3(self):
+        """Upload database ke S3 sekarang (melewati antrean background)"""
+        if not self.sync_worker:
+            return False
+        return self.sync_worker.flush()
+
+    def mark_dirty(self, nbytes: int = 0):
+        """Jadwalkan sync ke S3 di background"""
+        if self.sync_worker:
+            self.sync_worker.mark_dirty(nbytes)
+
+    def get_sync_status(self) -> Dict:
+        """Metrics worker sync dan replikasi S3"""
+        if not self.sync_worker:
+            return {}
+        return {**self.sync_worker.stats(), **self.replicator.stats()}
+
+    def _write_change(self, op: str, payload: Dict):
+        """Terapkan perubahan lokal dan catat di changelog untuk replikasi"""
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            apply_chat_change(cursor, op, payload)
+            if self.replicator:
+                cursor.execute(
+                    "INSERT INTO chat_changelog (op, payload) VALUES (?, ?)",
+                    (op, json.dumps(payload))
+                )
+
+    def init_database(self):
+        """Inisialisasi database SQLite"""
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                           CREATE TABLE IF NOT EXISTS chat_sessions
+                           (
+                               id
+                               TEXT
+                               PRIMARY
+                               KEY,
+                               title
+                               TEXT
+                               NOT
+                               NULL,
+                               created_at
+                               TIMESTAMP
+                               DEFAULT
+                               CURRENT_TIMESTAMP,
+                               updated_at
+                               TIMESTAMP
+                               DEFAULT
+                               CURRENT_TIMESTAMP,
+                               user_id
+                               TEXT
+                               DEFAULT
+                               'default'
+                           )
+                           ''')
+
+            cursor.execute('''
+                           CREATE TABLE IF NOT EXISTS chat_messages
+                           (
+                               id
+                               INTEGER
+                               PRIMARY
+                               KEY
+                               AUTOINCREMENT,
+                               session_id
+                               TEXT
+                               NOT
+                               NULL,
+                               role
+                               TEXT
+                               NOT
+                               NULL,
+                               content
+                               TEXT
+                               NOT
+                               NULL,
+                               timestamp
+                               TIMESTAMP
+                               DEFAULT
+                               CURRENT_TIMESTAMP,
+                               FOREIGN
+                               KEY
+                           (
+                               session_id
+                           ) REFERENCES chat_sessions
+                           (
+                               id
+                           )
+                               )
+                           ''')
+
+            # Index untuk performa
+            cursor.execute('''
+                           CREATE INDEX IF NOT EXISTS idx_session_messages
+                               ON chat_messages(session_id, timestamp)
+                           ''')
+            # Index untuk keyset pagination (updated_at, id) dan (session_id, id)
+            cursor.execute("DROP INDEX IF EXISTS idx_user_sessions")
+            cursor.execute('''
+                           CREATE INDEX IF NOT EXISTS idx_user_sessions_page
+                               ON chat_sessions(user_id, updated_at, id)
+                           ''')
+            cursor.execute('''
+                           CREATE INDEX IF NOT EXISTS idx_session_message_ids
+                               ON chat_messages(session_id, id)
+                           ''')
+
+            # Id global pesan supaya replay changelog dari pod lain idempotent
+            columns = {row[1] for row in cursor.execute("PRAGMA table_info(chat_messages)")}
+            if 'uid' not in columns:
+                cursor.execute("ALTER TABLE chat_messages ADD COLUMN uid TEXT")
+            cursor.execute('''
+                           CREATE UNIQUE INDEX IF NOT EXISTS idx_message_uid
+                               ON chat_messages(uid)
+                           ''')
+
+            # Tabel replikasi ke S3
+            cursor.execute('''
+                           CREATE TABLE IF NOT EXISTS chat_changelog
+                           (
+                               seq     INTEGER PRIMARY KEY AUTOINCREMENT,
+                               op      TEXT NOT NULL,
+                               payload TEXT NOT NULL
+                           )
+                           ''')
+            cursor.execute('''
+                           CREATE TABLE IF NOT EXISTS chat_applied_segments
+                           (
+                               segment_key TEXT PRIMARY KEY
+                           )
+                           ''')
+            cursor.execute('''
+                           CREATE TABLE IF NOT EXISTS chat_pod_watermarks
+                           (
+                               pod_id      TEXT PRIMARY KEY,
+                               segment_key TEXT NOT NULL
+                           )
+                           ''')
+            cursor.execute('''
+                           CREATE TABLE IF NOT EXISTS chat_session_tombstones
+                           (
+                               id         TEXT PRIMARY KEY,
+                               deleted_at TIMESTAMP NOT NULL
+                           )
+                           ''')
+            cursor.execute('''
+                           CREATE TABLE IF NOT EXISTS chat_replication_state
+                           (
+                               key   TEXT PRIMARY KEY,
+                               value TEXT
+                           )
+                           ''')
+
+    def create_new_session(self, title: str = None, user_id: str = "default") -> str:
+        """Membuat session chat baru"""
+        session_id = str(uuid.uuid4())
+        if not title:
+            title = f"Chat {datetime.now().strftime('%d/%m %H:%M')}"
+
+        self._write_change("create_session", {
+            'id': session_id,
+            'title': title,
+            'user_id': user_id,
+            'timestamp': utc_timestamp()
+        })
+
+        # Sync ke S3 di background setelah perubahan
+        self.mark_dirty(len(title))
+        return session_id
+
+    def get_all_sessions(self, user_id: str = "default") -> List[Dict]:
+        """Mendapatkan semua chat sessions untuk user tertentu"""
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT id, title, created_at, updated_at FROM chat_sessions WHERE user_id = ? ORDER BY updated_at DESC",
+                (user_id,)
+            )
+            sessions = []
+            for row in cursor.fetchall():
+                sessions.append({
+                    'id': row[0],
+                    'title': row[1],
+                    'created_at': row[2],
+                    'updated_at': row[3]
+                })
+        return sessions
+
+    def get_sessions_page(self, user_id: str = "default", limit: int = SESSION_PAGE_SIZE,
+                          cursor: tuple = None) -> Dict:
+        """Keyset pagination sessions (terbaru dulu); cursor = (updated_at, id) dari halaman sebelumnya"""
+        query = "SELECT id, title, created_at, updated_at FROM chat_sessions WHERE user_id = ?"
+        params = [user_id]
+        if cursor:
+            query += " AND (updated_at, id) < (?, ?)"
+            params.extend(cursor)
+        query += " ORDER BY updated_at DESC, id DESC LIMIT ?"
+        params.append(limit + 1)
+
+        with self.db.connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+
+        sessions = [
+            {'id': row[0], 'title': row[1], 'created_at': row[2], 'updated_at': row[3]}
+            for row in rows[:limit]
+        ]
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = (sessions[-1]['updated_at'], sessions[-1]['id'])
+        return {'sessions': sessions, 'next_cursor': next_cursor}
+
+    def get_session_messages(self, session_id: str) -> List[Dict]:
+        """Mendapatkan pesan dalam session"""
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT id, role, content, timestamp FROM chat_messages WHERE session_id = ? ORDER BY timestamp, id",
+                (session_id,)
+            )
+            messages = []
+            for row in cursor.fetchall():
+                messages.append({
+                    'id': row[0],
+                    'role': row[1],
+                    'content': row[2],
+                    'timestamp': row[3]
+                })
+        return messages
+
+    def get_messages_page(self, session_id: str, limit: int = MESSAGE_PAGE_SIZE,
+                          before_id: int = None) -> Dict:
+        """Mengambil `limit` pesan terakhir sebelum pesan before_id (urutan kronologis).
+
+        Urutan (timestamp, id), sama dengan urutan tampilan: pesan hasil replikasi dari pod lain
+        bisa mendapat id lokal lebih besar dari pesan yang lebih baru.
+        """
+        query = "SELECT id, role, content, timestamp FROM chat_messages WHERE session_id = ?"
+        params = [session_id]
+        if before_id is not None:
+            query += " AND (timestamp, id) < (SELECT timestamp, id FROM chat_messages WHERE id = ?)"
+            params.append(before_id)
+        query += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+        params.append(limit + 1)
+
+        with self.db.connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+
+        messages = [
+            {'id': row[0], 'role': row[1], 'content': row[2], 'timestamp': row[3]}
+            for row in reversed(rows[:limit])
+        ]
+        next_before_id = messages[0]['id'] if len(rows) > limit else None
+        return {'messages': messages, 'next_before_id': next_before_id}
+
+    def get_messages_since(self, session_id: str, since_id: int) -> List[Dict]:
+        """Semua pesan mulai dari pesan since_id (inklusif) sampai yang terbaru, urutan (timestamp, id)"""
+        with self.db.connection() as conn:
+            rows = conn.execute(
+                "SELECT id, role, content, timestamp FROM chat_messages WHERE session_id = ? "
+                "AND (timestamp, id) >= (SELECT timestamp, id FROM chat_messages WHERE id = ?) "
+                "ORDER BY timestamp, id",
+                (session_id, since_id)
+            ).fetchall()
+        return [{'id': row[0], 'role': row[1], 'content': row[2], 'timestamp': row[3]} for row in rows]
+
+    def add_message(self, session_id: str, role: str, content: str):
+        """Menambah pesan ke session"""
+        # Insert pesan sekaligus update timestamp session
+        self._write_change("add_message", {
+            'uid': uuid.uuid4().hex,
+            'session_id': session_id,
+            'role': role,
+            'content': content,
+            'timestamp': utc_timestamp()
+        })
+
+        # Sync ke S3 di background; perubahan digabung oleh worker
+        self.mark_dirty(len(content.encode("utf-8")))
+
+    def delete_session(self, session_id: str):
+        """Menghapus session dan semua pesannya"""
+        self._write_change("delete_session", {'id': session_id, 'timestamp': utc_timestamp()})
+
+        # Sync ke S3 di background setelah delete
+        self.mark_dirty()
+
+    def update_session_title(self, session_id: str, title: str):
+        """Update judul session"""
+        self._write_change("update_session_title", {
+            'id': session_id,
+            'title': title,
+            'timestamp': utc_timestamp()
+        })
+
+        # Sync ke S3 di background setelah update
+        self.mark_dirty(len(title))
+
+    def force_sync(self):
+        """Paksa sync database ke S3"""
+        return self.sync_to_s3()
+
+    def export_chat_history(self, session_id: str = None) -> Dict:
+        """Export chat history untuk backup"""
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+
+            if session_id:
+                # Export session tertentu
+                cursor.execute("SELECT * FROM chat_sessions WHERE id = ?", (session_id,))
+                sessions = cursor.fetchall()
+                cursor.execute("SELECT * FROM chat_messages WHERE session_id = ?", (session_id,))
+                messages = cursor.fetchall()
+            else:
+                # Export semua
+                cursor.execute("SELECT * FROM chat_sessions")
+                sessions = cursor.fetchall()
+                cursor.execute("SELECT * FROM chat_messages")
+                messages = cursor.fetchall()
+
+        return {
+            'sessions': sessions,
+            'messages': messages,
+            'exported_at': datetime.now().isoformat()
+        }
+
+    def get_chat_statistics(self, user_id: str = "default") -> Dict:
+        """Statistik penggunaan chat"""
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+
+            # Total sessions
+            cursor.execute("SELECT COUNT(*) FROM chat_sessions WHERE user_id = ?", (user_id,))
+            total_sessions = cursor.fetchone()[0]
+
+            # Total messages
+            cursor.execute("""
+                           SELECT COUNT(*)
+                           FROM chat_messages cm
+                                    JOIN chat_sessions cs ON cm.session_id = cs.id
+                           WHERE cs.user_id = ?
+                           """, (user_id,))
+            total_messages = cursor.fetchone()[0]
+
+            # Messages by role
+            cursor.execute("""
+                           SELECT role, COUNT(*)
+                           FROM chat_messages cm
+                                    JOIN chat_sessions cs ON cm.session_id = cs.id
+                           WHERE cs.user_id = ?
+                           GROUP BY role
+                           """, (user_id,))
+            messages_by_role = dict(cursor.fetchall())
+
+        return {
+            'total_sessions': total_sessions,
+            'total_messages': total_messages,
+            'messages_by_role': messages_by_role,
+            'user_id': user_id
+        }
+
+
+class _SharedEventStream:
+    """Event stream Bedrock yang dibaca bersama oleh beberapa pemanggil (single-flight streaming).
+
+    Tidak ada thread tambahan: pembaca yang tertinggal membaca dari buffer, pembaca terdepan
+    menarik event berikutnya dari stream asli. on_close dipanggil sekali ketika stream habis,
+    error, atau semua pembaca berhenti.
+
+    Pembaca dihitung sejak subscribe() (bukan sejak mulai iterasi), jadi follower yang baru
+    bergabung tidak ikut dibatalkan ketika pembaca lain berhenti lebih dulu.
+    """
+
+    def __init__(self, response: Dict, on_close):
+        self.response = {key: value for key, value in response.items() if key != 'body'}
+        self._body = response['body']
+        self._source = iter(self._body)
+        self._events = []
+        self._error = None
+        self._done = False
+        self._readers = 0
+        self._cancelled = False
+        # RLock: _StreamSubscription.__del__ bisa jalan di thread yang sedang memegang lock ini
+        self._lock = threading.RLock()
+        self._on_close = on_close
+
+    def _next(self, position: int):
+        with self._lock:
+            if position < len(self._events):
+                return self._events[position]
+            if self._error is not None:
+                raise self._error
+            if self._done:
+                raise StopIteration
+            try:
+                event = next(self._source)
+            except StopIteration:
+                self._close()
+                raise
+            except Exception as e:
+                self._error = e
+                self._close()
+                raise
+            self._events.append(event)
+            return event
+
+    def _close(self):
+        # Dipanggil dengan _lock terkunci
+        if not self._done:
+            self._done = True
+            self._on_close()
+
+    def subscribe(self):
+        """Iterator pembaca baru; None jika stream sudah dibatalkan (semua pembaca sebelumnya berhenti)"""
+        with self._lock:
+            if self._cancelled:
+                return None
+            self._readers += 1
+        return _StreamSubscription(self)
+
+    def _leave(self):
+        with self._lock:
+            self._readers -= 1
+            if self._readers == 0 and not self._done:
+                # Semua pembaca berhenti sebelum stream habis: tutup koneksi dan lepas slot
+                getattr(self._body, 'close', lambda: None)()
+                self._cancelled = True
+                self._error = RuntimeError("Bedrock stream dibatalkan")
+                self._close()
+
+
+class _StreamSubscription:
+    """Satu pembaca _SharedEventStream. Slot pembaca dilepas sekali: saat stream habis/error,
+    close(), atau saat object di-GC, termasuk jika tidak pernah diiterasi sama sekali."""
+
+    def __init__(self, stream: _SharedEventStream):
+        self._stream = stream
+        self._position = 0
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._closed:
+            raise StopIteration
+        try:
+            event = self._stream._next(self._position)
+        except BaseException:
+            self.close()
+            raise
+        self._position += 1
+        return event
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._stream._leave()
+
+    def __del__(self):
+        self.close()
+
+
+class BedrockScheduler:
+    """Proxy bedrock-runtime bersama: token bucket, batas in-flight, prioritas, dan single-flight.
+
+    Dipakai persis seperti client boto3 (`invoke_model`, `invoke_model_with_response_stream`);
+    argumen tambahan `priority` (PRIORITY_INTERACTIVE/PRIORITY_BULK) menentukan urutan antrian.
+    Atribut lain diteruskan ke client asli.
+    """
+
+    def __init__(self, client, rate: float = BEDROCK_REQUESTS_PER_SECOND, burst: int = BEDROCK_BURST,
+                 max_in_flight: int = BEDROCK_MAX_IN_FLIGHT):
+        self.client = client
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.tokens = float(burst)
+        self.in_flight = 0
+        self._refilled_at = time.monotonic()
+        self._waiters = []  # heap (priority, urutan)
+        self._sequence = 0
+        self._cond = threading.Condition()
+        self._flights = {}
+        self._streams = {}
+        self._flights_lock = threading.Lock()
+
+        # Metrics
+        self.requests = 0
+        self.coalesced = 0
+        self.throttled = 0
+        self.errors = 0
+        self.wait_count = dict.fromkeys((PRIORITY_INTERACTIVE, PRIORITY_BULK), 0)
+        self.wait_total = dict.fromkeys((PRIORITY_INTERACTIVE, PRIORITY_BULK), 0.0)
+        self.wait_max = dict.fromkeys((PRIORITY_INTERACTIVE, PRIORITY_BULK), 0.0)
+        self.wait_buckets = {
+            priority: [0] * (len(QUEUE_WAIT_BUCKETS) + 1) for priority in (PRIORITY_INTERACTIVE, PRIORITY_BULK)
+        }
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def acquire(self, priority: int = PRIORITY_INTERACTIVE):
+        """Tunggu giliran: paling depan di antrian prioritas, ada slot in-flight, dan ada token"""
+        start = time.monotonic()
+        with self._cond:
+            self._sequence += 1
+            ticket = (priority, self._sequence)
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    timeout = None
+                    if self._waiters[0] == ticket and self.in_flight < self.max_in_flight:
+                        self._refill(time.monotonic())
+                        if self.tokens >= 1:
+                            break
+                        timeout = (1 - self.tokens) / self.rate
+                    self._cond.wait(timeout)
+                self.tokens -= 1
+                self.in_flight += 1
+            finally:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+            self._record_wait(priority, time.monotonic() - start)
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def _record_wait(self, priority: int, seconds: float):
+        # Dipanggil dengan _cond terkunci
+        self.requests += 1
+        self.wait_count[priority] += 1
+        self.wait_total[priority] += seconds
+        self.wait_max[priority] = max(self.wait_max[priority], seconds)
+        self.wait_buckets[priority][bisect.bisect_left(QUEUE_WAIT_BUCKETS, seconds)] += 1
+
+    def _record_error(self, error: Exception):
+        with self._cond:
+            self.errors += 1
+            if is_throttling_error(error):
+                self.throttled += 1
+
+    @staticmethod
+    def _flight_key(operation: str, kwargs: Dict) -> str:
+        body = kwargs.get('body', b'')
+        body = body if isinstance(body, bytes) else str(body).encode("utf-8")
+        params = json.dumps({key: value for key, value in kwargs.items() if key != 'body'}, sort_keys=True)
+        return hashlib.sha256(b"\0".join((operation.encode(), params.encode(), body))).hexdigest()
+
+    def _single_flight(self, key: str, call):
+        """Request identik yang sedang berjalan menunggu hasil request pertama, bukan mengirim ulang"""
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = {'done': threading.Event(), 'result': None, 'error': None}
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight['done'].wait()
+            if flight['error'] is not None:
+                raise flight['error']
+            return flight['result']
+        try:
+            flight['result'] = call()
+            return flight['result']
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+            flight['done'].set()
+
+    def invoke_model(self, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+        def call():
+            self.acquire(priority)
+            try:
+                response = self.client.invoke_model(**kwargs)
+                # Body dibaca sekali lalu dibagikan; tiap pemanggil mendapat stream sendiri
+                return {**response, 'body': response['body'].read()}
+            except Exception as e:
+                self._record_error(e)
+                raise
+            finally:
+                self.release()
+
+        response = self._single_flight(self._flight_key("invoke_model", kwargs), call)
+        return {**response, 'body': BytesIO(response['body'])}
+
+    def invoke_model_with_response_stream(self, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+        key = self._flight_key("invoke_model_with_response_stream", kwargs)
+
+        def close(key=key):
+            with self._flights_lock:
+                self._streams.pop(key, None)
+            self.release()
+
+        def call():
+            self.acquire(priority)
+            try:
+                response = self.client.invoke_model_with_response_stream(**kwargs)
+            except Exception as e:
+                self._record_error(e)
+                self.release()
+                raise
+            # Slot in-flight dipegang sampai stream selesai; selama itu pertanyaan identik ikut membaca stream ini
+            shared = _SharedEventStream(response, close)
+            with self._flights_lock:
+                self._streams[key] = shared
+            return shared
+
+        while True:
+            with self._flights_lock:
+                shared = self._streams.get(key)
+                if shared is not None:
+                    self.coalesced += 1
+            if shared is None:
+                shared = self._single_flight(key, call)
+            body = shared.subscribe()
+            if body is not None:
+                return {**shared.response, 'body': body}
+            # Stream yang diikuti baru saja dibatalkan semua pembacanya: kirim request baru
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                'requests': self.requests,
+                'coalesced': self.coalesced,
+                'throttled': self.throttled,
+                'errors': self.errors,
+                'in_flight': self.in_flight,
+                'queued': len(self._waiters),
+                'tokens': self.tokens,
+                'wait': {
+                    name: {
+                        'count': self.wait_count[priority],
+                        'avg_seconds': self.wait_total[priority] / self.wait_count[priority]
+                        if self.wait_count[priority] else None,
+                        'max_seconds': self.wait_max[priority],
+                        'sum_seconds': self.wait_total[priority],
+                        'buckets': list(self.wait_buckets[priority])
+                    }
+                    for name, priority in (('interactive', PRIORITY_INTERACTIVE), ('bulk', PRIORITY_BULK))
+                }
+            }
+
+
+def instrument_aws_client(client):
+    """Latensi dan error setiap panggilan client boto3 lewat event hook botocore"""
+    def before_call(model, context, **kwargs):
+        context['metrics'] = (time.perf_counter(), model.service_model.service_name, model.name)
+
+    def after_call(context, http_response=None, parsed=None, exception=None, **kwargs):
+        # after-call-error: gagal di level koneksi; after-call: respons HTTP (termasuk error dari AWS)
+        if 'metrics' not in context:
+            return
+        start, service, operation = context.pop('metrics')
+        EXTERNAL_CALL_SECONDS.observe(time.perf_counter() - start, service=service, operation=operation)
+        if exception is not None:
+            code = type(exception).__name__
+        elif http_response is not None and http_response.status_code >= 400:
+            code = (parsed or {}).get("Error", {}).get("Code") or http_response.status_code
+        else:
+            return
+        EXTERNAL_CALL_ERRORS.inc(service=service, operation=operation, code=code)
+
+    client.meta.events.register("before-call", before_call)
+    client.meta.events.register("after-call", after_call)
+    client.meta.events.register("after-call-error", after_call)
+    return client
+
+
+# Initialize AWS clients
+@st.cache_resource
+def init_aws_clients():
+    return {
+        's3': instrument_aws_client(boto3.client("s3")),
+        'bedrock': BedrockScheduler(
+            instrument_aws_client(boto3.client(service_name="bedrock-runtime", region_name=AWS_REGION))
+        )
+    }
+
+
+def is_throttling_error(error: Exception) -> bool:
+    """Cek apakah error dari Bedrock adalah throttling / kapasitas penuh"""
+    code = getattr(error, "response", {}).get("Error", {}).get("Code")
+    return code in THROTTLING_ERROR_CODES
+
+
+class AdaptiveConcurrencyLimiter:
+    """Batas request paralel AIMD: dibagi dua saat throttling, naik satu per batch sukses"""
+
+    def __init__(self, max_limit: int):
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_flight -= 1
+                self._cond.notify_all()
+
+    def on_success(self):
+        with self._cond:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_limit:
+                # Setelah dibagi dua batas bisa pecahan: jangan melewati max_limit
+                self.limit = min(float(self.max_limit), self.limit + 1)
+                self._successes = 0
+                self._cond.notify_all()
+
+    def on_throttle(self):
+        with self._cond:
+            self.limit = max(1.0, self.limit / 2)
+            self._successes = 0
+
+
+class EmbeddingCache:
+    """Cache embedding yang dikunci hash (model id + teks chunk), dengan eviction LRU"""
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES,
+                 s3_client=None, s3_prefix: str = EMBEDDING_CACHE_S3_PREFIX, bucket: str = BUCKET_NAME):
+        self.db = SQLiteConnectionPool(path)
+        self.max_entries = max_entries
+        self.s3_client = s3_client if s3_prefix else None
+        self.s3_prefix = s3_prefix
+        self.bucket = bucket
+        self._lock = threading.Lock()
+        self._s3_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="embedding-s3") \
+            if self.s3_client else None
+
+        with self.db.connection() as conn:
+            conn.execute('''
+                         CREATE TABLE IF NOT EXISTS embedding_cache
+                         (
+                             key         TEXT PRIMARY KEY,
+                             vector      BLOB NOT NULL,
+                             last_access REAL NOT NULL
+                         )
+                         ''')
+            conn.execute('''
+                         CREATE INDEX IF NOT EXISTS idx_embedding_cache_lru
+                             ON embedding_cache(last_access)
+                         ''')
+            self.entries = conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+
+        # Metrics
+        self.hits = 0
+        self.s3_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def cache_key(model_id: str, text: str) -> str:
+        return hashlib.sha256(f"{model_id}\0{text}".encode("utf-8")).hexdigest()
+
+    def _s3_key(self, key: str) -> str:
+        return f"{self.s3_prefix}{key}.f32"
+
+    def _get_from_s3(self, key: str):
+        try:
+            body = self.s3_client.get_object(Bucket=self.bucket, Key=self._s3_key(key))["Body"].read()
+            return np.frombuffer(body, dtype=np.float32).tolist()
+        except Exception:
+            return None
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """Ambil embedding yang sudah ada; key yang tidak ditemukan tidak ada di hasil"""
+        found = {}
+        stale = []
+        unique_keys = list(dict.fromkeys(keys))
+        now = time.time()
+        with self.db.connection() as conn:
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                for key, blob, last_access in conn.execute(
+                        f"SELECT key, vector, last_access FROM embedding_cache WHERE key IN ({placeholders})", batch
+                ):
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+                    if now - last_access >= EMBEDDING_CACHE_TOUCH_SECONDS:
+                        stale.append((now, key))
+            # Satu batch update untuk entri yang last_access-nya sudah basi (cukup untuk urutan LRU)
+            if stale:
+                conn.executemany("UPDATE embedding_cache SET last_access = ? WHERE key = ?", stale)
+        local_hits = len(found)
+
+        if self.s3_client:
+            missing = [key for key in unique_keys if key not in found]
+            for key, vector in zip(missing, self._s3_executor.map(self._get_from_s3, missing)):
+                if vector is not None:
+                    found[key] = vector
+            s3_found = {key: found[key] for key in missing if key in found}
+            if s3_found:
+                self.put_many(s3_found, upload=False)
+            self.s3_hits += len(s3_found)
+
+        with self._lock:
+            self.hits += local_hits
+            self.misses += len(unique_keys) - len(found)
+        return found
+
+    def put_many(self, vectors: Dict[str, List[float]], upload: bool = True):
+        """Simpan embedding baru lalu evict entri yang paling lama tidak dipakai"""
+        if not vectors:
+            return
+        now = time.time()
+        blobs = {key: np.asarray(vector, dtype=np.float32).tobytes() for key, vector in vectors.items()}
+        with self._lock, self.db.connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (key, vector, last_access) VALUES (?, ?, ?)",
+                [(key, blob, now) for key, blob in blobs.items()]
+            )
+            self.entries = conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+            excess = self.entries - self.max_entries
+            if excess > 0:
+                conn.execute(
+                    "DELETE FROM embedding_cache WHERE key IN "
+                    "(SELECT key FROM embedding_cache ORDER BY last_access LIMIT ?)",
+                    (excess,)
+                )
+                self.entries -= excess
+                self.evictions += excess
+
+        if upload and self.s3_client:
+            list(self._s3_executor.map(
+                lambda item: self.s3_client.put_object(
+                    Bucket=self.bucket, Key=self._s3_key(item[0]), Body=item[1]
+                ),
+                blobs.items()
+            ))
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.s3_hits + self.misses
+        return {
+            'entries': self.entries,
+            'hits': self.hits,
+            's3_hits': self.s3_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': (self.hits + self.s3_hits) / lookups if lookups else 0.0
+        }
+
+
+@st.cache_resource
+def init_embedding_cache():
+    return EmbeddingCache(s3_client=init_aws_clients()['s3'])
+
+
+class ConcurrentBedrockEmbeddings(Embeddings):
+    """Embedding Titan lewat Bedrock dengan worker pool terbatas dan retry adaptif.
+
+    Body request sama dengan BedrockEmbeddings LangChain, sehingga vektor yang
+    dihasilkan kompatibel dengan index yang sudah ada.
+    """
+
+    def __init__(self, client, model_id: str = EMBEDDING_MODEL_ID, concurrency: int = EMBEDDING_CONCURRENCY,
+                 max_retries: int = EMBEDDING_MAX_RETRIES, backoff_base: float = EMBEDDING_BACKOFF_BASE,
+                 backoff_max: float = EMBEDDING_BACKOFF_MAX, cache: EmbeddingCache = None):
+        self.client = client
+        self.cache = cache
+        self.model_id = model_id
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.limiter = AdaptiveConcurrencyLimiter(concurrency)
+        # Satu pool untuk semua pemanggil (bukan dibuat per batch); jumlah request paralel
+        # tetap dibatasi limiter dan scheduler Bedrock
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="embedding")
+
+        # Metrics
+        self.requests = 0
+        self.throttled = 0
+
+    def _invoke(self, text: str, priority: int) -> List[float]:
+        # Newline diganti spasi, sama seperti BedrockEmbeddings
+        body = json.dumps({"inputText": text.replace(os.linesep, " ")})
+        response = self.client.invoke_model(
+            priority=priority,
+            body=body,
+            modelId=self.model_id,
+            accept="application/json",
+            contentType="application/json"
+        )
+        return json.loads(response.get("body").read()).get("embedding")
+
+    def _embed_with_retry(self, text: str, priority: int) -> List[float]:
+        for attempt in range(self.max_retries + 1):
+            # Limiter AIMD hanya untuk embedding massal; slotnya bisa habis dipegang thread ingestion
+            # yang sedang antre di scheduler, dan pertanyaan chat tidak boleh ikut menunggu di situ.
+            # Sinyal AIMD juga hanya dari request yang memegang slot
+            bulk = priority == PRIORITY_BULK
+            with self.limiter.slot() if bulk else nullcontext():
+                try:
+                    self.requests += 1
+                    vector = self._invoke(text, priority)
+                    if bulk:
+                        self.limiter.on_success()
+                    return vector
+                except Exception as e:
+                    if not is_throttling_error(e) or attempt == self.max_retries:
+                        raise
+                    self.throttled += 1
+                    if bulk:
+                        self.limiter.on_throttle()
+            # Exponential backoff dengan jitter, di luar slot supaya tidak menahan kuota
+            delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+            time.sleep(random.uniform(delay / 2, delay))
+
+    def embed_documents(self, texts: List[str], progress_callback=None,
+                        priority: int = PRIORITY_BULK) -> List[List[float]]:
+        """Embed banyak teks secara paralel; progress_callback(selesai, total) dipanggil di thread pemanggil.
+
+        Chunk yang sudah ada di cache (atau duplikat dalam batch yang sama) tidak dikirim ke Bedrock.
+        """
+        if not texts:
+            return []
+
+        keys = [EmbeddingCache.cache_key(self.model_id, text) for text in texts]
+        vectors = self.cache.get_many(keys) if self.cache else {}
+        pending = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        occurrences = Counter(keys)
+        completed = len(texts) - sum(occurrences[key] for key in pending)
+        if progress_callback and completed:
+            progress_callback(completed, len(texts))
+
+        new_vectors = {}
+        if len(pending) == 1:
+            # Satu teks (mis. pertanyaan chat) dijalankan di thread pemanggil: tidak antre di belakang
+            # batch ingestion yang sedang memenuhi pool
+            (key, text), = pending.items()
+            new_vectors[key] = self._embed_with_retry(text, priority)
+            completed += occurrences[key]
+            if progress_callback:
+                progress_callback(completed, len(texts))
+        else:
+            futures = {self._executor.submit(self._embed_with_retry, text, priority): key
+                       for key, text in pending.items()}
+            try:
+                for future in as_completed(futures):
+                    key = futures[future]
+                    new_vectors[key] = future.result()
+                    completed += occurrences[key]
+                    if progress_callback:
+                        progress_callback(completed, len(texts))
+            finally:
+                # Gagal di tengah jalan: sisa chunk batch ini tidak perlu dikirim lagi
+                for future in futures:
+                    future.cancel()
+
+        if self.cache:
+            self.cache.put_many(new_vectors)
+        vectors.update(new_vectors)
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        # Embedding pertanyaan ada di jalur chat: didahulukan dari embedding ingestion
+        return self.embed_documents([text], priority=PRIORITY_INTERACTIVE)[0]
+
+    def stats(self) -> Dict:
+        return {
+            'requests': self.requests,
+            'throttled': self.throttled,
+            'concurrency_limit': int(self.limiter.limit),
+            'cache': self.cache.stats() if self.cache else {}
+        }
+
+
+@st.cache_resource
+def init_embeddings():
+    clients = init_aws_clients()
+    return ConcurrentBedrockEmbeddings(client=clients['bedrock'], cache=init_embedding_cache())
+
+
+@st.cache_resource
+def init_llm():
+    clients = init_aws_clients()
+    return Bedrock(
+        model_id=LLM_MODEL_ID,
+        client=clients['bedrock'],
+        model_kwargs={'max_tokens_to_sample': LLM_MAX_TOKENS}
+    )
+
+
+def stream_bedrock_completion(client, prompt: str, model_id: str = LLM_MODEL_ID,
+                              max_tokens: int = LLM_MAX_TOKENS):
+    """Generator potongan teks completion Claude dari invoke_model_with_response_stream"""
+    response = client.invoke_model_with_response_stream(
+        modelId=model_id,
+        body=json.dumps({
+            # Format prompt sama dengan jalur non-streaming (LangChain Bedrock)
+            'prompt': _human_assistant_format(prompt),
+            'max_tokens_to_sample': max_tokens
+        }),
+        contentType="application/json",
+        accept="application/json"
+    )
+    for event in response["body"]:
+        if "chunk" not in event:
+            # Event error dari stream (throttlingException, modelStreamErrorException, ...)
+            raise RuntimeError(f"Bedrock stream error: {event}")
+        text = json.loads(event["chunk"]["bytes"]).get("completion", "")
+        if text:
+            yield text
+
+
+FINANCIAL_PROMPT_TEMPLATE = """
+        Human: Anda adalah asisten AI yang ahli dalam analisis keuangan. Gunakan konteks yang diberikan untuk menjawab pertanyaan tentang laporan keuangan dengan akurat dan profesional.
+
+        Jika pertanyaan meminta:
+        - Angka/nilai: Berikan nilai yang tepat dengan format yang jelas
+        - Analisis: Berikan interpretasi yang mendalam
+        - Perbandingan: Tunjukkan perbedaan dan tren
+        - Rekomendasi: Berikan saran berdasarkan data
+
+        Jika tidak tahu jawabannya, katakan dengan jujur bahwa informasi tidak tersedia dalam dokumen.
+
+        <context>
+        {context}
+        </context>
+
+        Pertanyaan: {question}
+
+        Assistant:"""
+
+FINANCIAL_PROMPT = PromptTemplate(
+    template=FINANCIAL_PROMPT_TEMPLATE,
+    input_variables=["context", "question"]
+)
+
+
+class SQLiteDocstore(Docstore):
+    """Docstore read-only berbasis SQLite (pengganti pickle) untuk index yang di-mmap"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(f"file:{path}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def write(path: str, vectorstore: FAISS):
+        """Tulis chunk text + metadata dari vector store LangChain ke file SQLite"""
+        conn = sqlite3.connect(path)
+        conn.execute('''
+                     CREATE TABLE chunks
+                     (
+                         pos      INTEGER PRIMARY KEY,
+                         doc_id   TEXT NOT NULL UNIQUE,
+                         content  TEXT NOT NULL,
+                         metadata TEXT NOT NULL
+                     )
+                     ''')
+        rows = (
+            (int(pos), doc_id, doc.page_content, json.dumps(doc.metadata, default=str))
+            for pos, doc_id in vectorstore.index_to_docstore_id.items()
+            for doc in [vectorstore.docstore.search(doc_id)]
+        )
+        conn.executemany("INSERT INTO chunks (pos, doc_id, content, metadata) VALUES (?, ?, ?, ?)", rows)
+        conn.commit()
+        conn.close()
+
+    def search(self, search: str):
+        with self._lock:
+            row = self._conn.execute("SELECT content, metadata FROM chunks WHERE doc_id = ?", (search,)).fetchone()
+        if not row:
+            return f"ID {search} not found."
+        return Document(page_content=row[0], metadata=json.loads(row[1]))
+
+    def all_documents(self):
+        """Semua chunk berurutan posisi vektor: (pos, doc_id, Document)"""
+        with self._lock:
+            rows = self._conn.execute("SELECT pos, doc_id, content, metadata FROM chunks ORDER BY pos").fetchall()
+        return [(pos, doc_id, Document(page_content=content, metadata=json.loads(metadata)))
+                for pos, doc_id, content, metadata in rows]
+
+    def close(self):
+        self._conn.close()
+
+
+class SQLiteIndexMapping(Mapping):
+    """Mapping posisi vektor FAISS -> doc_id yang dibaca langsung dari docstore SQLite"""
+
+    def __init__(self, docstore: SQLiteDocstore):
+        self.docstore = docstore
+
+    def __getitem__(self, pos):
+        with self.docstore._lock:
+            row = self.docstore._conn.execute("SELECT doc_id FROM chunks WHERE pos = ?", (int(pos),)).fetchone()
+        if row is None:
+            raise KeyError(pos)
+        return row[0]
+
+    def __iter__(self):
+        with self.docstore._lock:
+            positions = [row[0] for row in self.docstore._conn.execute("SELECT pos FROM chunks ORDER BY pos")]
+        return iter(positions)
+
+    def __len__(self):
+        with self.docstore._lock:
+            return self.docstore._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+
+def tokenize_keywords(text: str) -> List[str]:
+    """Token BM25: kode akun/ticker ("BBCA.JK", "1-1100") dan angka ("1.234.567") tetap utuh.
+
+    Token bersambung juga dipecah per bagian, dan angka berpemisah juga disimpan
+    tanpa pemisah supaya "1.234.567", "1,234,567,00" dan "1234567" cocok satu sama lain.
+    """
+    tokens = []
+    for token in re.findall(r"\w+(?:[.,/-]\w+)*", text.lower()):
+        tokens.append(token)
+        parts = re.split(r"[.,/-]", token)
+        if len(parts) > 1:
+            if all(part.isdigit() for part in parts):
+                # Desimal 1-2 digit ("1.234.567,00") dibuang supaya cocok dengan penulisan tanpa sen
+                tokens.append("".join(parts[:-1] if len(parts[-1]) <= 2 else parts))
+            else:
+                tokens.extend(parts)
+    return tokens
+
+
+def keyword_index_file(index_name: str) -> str:
+    return f"{index_name}.bm25.db"
+
+
+class KeywordIndex:
+    """Inverted index BM25 read-only (SQLite) dengan posisi yang sama dengan vektor FAISS.
+
+    Posting disimpan per chunk id internal (cid) yang stabil, bukan per posisi vektor:
+    saat publish hanya chunk baru yang di-tokenize, chunk yang dihapus dibuang beserta
+    posting-nya, dan posisi chunk yang bergeser cukup diperbarui di tabel chunks.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE terms (term TEXT PRIMARY KEY, df INTEGER NOT NULL) WITHOUT ROWID;
+        CREATE TABLE chunks (cid INTEGER PRIMARY KEY, doc_id TEXT NOT NULL UNIQUE, pos INTEGER NOT NULL,
+                             length INTEGER NOT NULL);
+        CREATE TABLE postings (term TEXT NOT NULL, cid INTEGER NOT NULL, tf INTEGER NOT NULL,
+                               PRIMARY KEY (term, cid)) WITHOUT ROWID;
+        CREATE INDEX idx_postings_cid ON postings (cid);
+    '''
+
+    def __init__(self, path: str, in_memory: bool = False):
+        source = sqlite3.connect(f"file:{path}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+        if in_memory:
+            # Format pickle: file sementara dihapus setelah load, jadi isi index disalin ke memori
+            self._conn = sqlite3.connect(":memory:", check_same_thread=False)
+            source.backup(self._conn)
+            source.close()
+        else:
+            self._conn = source
+        self._lock = threading.Lock()
+        meta = dict(self._conn.execute("SELECT key, value FROM meta"))
+        self.doc_count = int(meta['doc_count'])
+        self.avg_length = float(meta['avg_length']) or 1.0
+        # Index lama (posting per posisi + tabel lengths) tetap bisa dibaca sampai publish berikutnya
+        if self._has_chunks_table(self._conn):
+            self._join, self._pos = "JOIN chunks l ON l.cid = p.cid", "l.pos"
+        else:
+            self._join, self._pos = "JOIN lengths l ON l.pos = p.pos", "p.pos"
+
+    @staticmethod
+    def _has_chunks_table(conn: sqlite3.Connection) -> bool:
+        return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chunks'").fetchone() is not None
+
+    @staticmethod
+    def write(path: str, vectorstore: FAISS, previous_path: str = None):
+        """Tulis index untuk semua chunk vector store ke path.
+
+        previous_path: index versi sebelumnya; disalin lalu diperbarui secara inkremental
+        (index format lama dibangun ulang dari nol).
+        """
+        if os.path.exists(path):
+            os.remove(path)
+        if previous_path and os.path.exists(previous_path):
+            shutil.copyfile(previous_path, path)
+            conn = sqlite3.connect(path)
+            try:
+                if KeywordIndex._has_chunks_table(conn):
+                    KeywordIndex._sync(conn, vectorstore)
+                    return
+            finally:
+                conn.close()
+            os.remove(path)
+        conn = sqlite3.connect(path)
+        try:
+            conn.executescript(KeywordIndex.SCHEMA)
+            KeywordIndex._sync(conn, vectorstore)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _sync(conn: sqlite3.Connection, vectorstore: FAISS):
+        """Samakan isi index dengan vector store: hapus chunk yang hilang, tambah chunk baru, geser posisi"""
+        indexed = dict(conn.execute("SELECT doc_id, pos FROM chunks"))
+        current = {doc_id: int(pos) for pos, doc_id in vectorstore.index_to_docstore_id.items()}
+
+        for batch in iter_batches([doc_id for doc_id in indexed if doc_id not in current], 500):
+            cids = f"SELECT cid FROM chunks WHERE doc_id IN ({','.join('?' * len(batch))})"
+            removed_df = conn.execute(
+                f"SELECT term, COUNT(*) FROM postings WHERE cid IN ({cids}) GROUP BY term", batch).fetchall()
+            conn.executemany("UPDATE terms SET df = df - ? WHERE term = ?", [(n, term) for term, n in removed_df])
+            conn.execute(f"DELETE FROM postings WHERE cid IN ({cids})", batch)
+            conn.execute(f"DELETE FROM chunks WHERE doc_id IN ({','.join('?' * len(batch))})", batch)
+        conn.execute("DELETE FROM terms WHERE df <= 0")
+        conn.executemany("UPDATE chunks SET pos = ? WHERE doc_id = ?", [
+            (pos, doc_id) for doc_id, pos in current.items() if doc_id in indexed and indexed[doc_id] != pos
+        ])
+
+        next_cid = (conn.execute("SELECT MAX(cid) FROM chunks").fetchone()[0] or 0) + 1
+        added = ((doc_id, pos) for doc_id, pos in current.items() if doc_id not in indexed)
+        for batch in iter_batches(added, 5000):
+            chunks, postings = [], []
+            document_frequency = Counter()
+            for doc_id, pos in batch:
+                counts = Counter(tokenize_keywords(vectorstore.docstore.search(doc_id).page_content))
+                chunks.append((next_cid, doc_id, pos, sum(counts.values())))
+                document_frequency.update(counts.keys())
+                postings.extend((term, next_cid, tf) for term, tf in counts.items())
+                next_cid += 1
+            conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)", chunks)
+            conn.executemany("INSERT INTO postings VALUES (?, ?, ?)", sorted(postings))
+            conn.executemany(
+                "INSERT INTO terms VALUES (?, ?) ON CONFLICT (term) DO UPDATE SET df = df + excluded.df",
+                document_frequency.items()
+            )
+
+        doc_count, total_length = conn.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks").fetchone()
+        conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [
+            ('doc_count', str(doc_count)),
+            ('avg_length', str(total_length / max(doc_count, 1))),
+        ])
+        conn.commit()
+
+    def search(self, query: str, k: int, k1: float = BM25_K1, b: float = BM25_B) -> List[tuple]:
+        """Top-k (posisi vektor, skor BM25), skor terbesar dulu"""
+        terms = list(dict.fromkeys(tokenize_keywords(query)))
+        if not terms:
+            return []
+        placeholders = ",".join("?" * len(terms))
+        with self._lock:
+            frequencies = self._conn.execute(
+                f"SELECT term, df FROM terms WHERE term IN ({placeholders})", terms).fetchall()
+            if not frequencies:
+                return []
+            # idf dihitung di Python, akumulasi skor per posting dilakukan SQLite
+            weights = [(term, math.log1p((self.doc_count - df + 0.5) / (df + 0.5))) for term, df in frequencies]
+            values = ",".join("(?, ?)" for _ in weights)
+            return self._conn.execute(f'''
+                WITH query_terms(term, idf) AS (VALUES {values})
+                SELECT {self._pos}, SUM(q.idf * p.tf * (? + 1) / (p.tf + ? * (1 - ? + ? * l.length / ?))) AS score
+                FROM query_terms q
+                JOIN postings p ON p.term = q.term
+                {self._join}
+                GROUP BY {self._pos}
+                ORDER BY score DESC, {self._pos}
+                LIMIT ?
+            ''', [*(item for weight in weights for item in weight), k1, k1, b, b, self.avg_length, k]).fetchall()
+
+    def close(self):
+        self._conn.close()
+
+
+def select_index_type(ntotal: int, index_type: str = ANN_INDEX_TYPE) -> str:
+    if index_type != "auto":
+        return index_type
+    if ntotal >= ANN_IVF_PQ_MIN_VECTORS:
+        return "ivf_pq"
+    if ntotal >= ANN_HNSW_MIN_VECTORS:
+        return "hnsw"
+    return "flat"
+
+
+def is_flat_index(index) -> bool:
+    return isinstance(index, faiss.IndexFlat)
+
+
+def iter_flat_vectors(flat_index, start: int = 0, batch_size: int = 65536) -> Iterator[np.ndarray]:
+    for offset in range(start, flat_index.ntotal, batch_size):
+        yield flat_index.reconstruct_n(offset, min(batch_size, flat_index.ntotal - offset))
+
+
+def ivf_nlist(ntotal: int) -> int:
+    return max(1, min(int(4 * np.sqrt(ntotal)), ntotal // 39))
+
+
+def describe_index(index) -> Dict:
+    """Tipe index + parameter pencarian yang tersimpan di file .faiss"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexRefine):
+        return {**describe_index(index.base_index), 'refine_k_factor': index.k_factor}
+    if isinstance(index, faiss.IndexHNSW):
+        return {'type': "hnsw", 'efSearch': index.hnsw.efSearch}
+    if isinstance(index, faiss.IndexIVFPQ):
+        return {'type': "ivf_pq", 'nprobe': index.nprobe, 'nlist': index.nlist}
+    if isinstance(index, faiss.IndexIVF):
+        return {'type': "ivf_flat", 'nprobe': index.nprobe, 'nlist': index.nlist}
+    return {'type': "flat"}
+
+
+def with_refine(index, flat_index, k_factor: int = ANN_PQ_REFINE_FACTOR):
+    """Bungkus index PQ dengan rerank exact; flat_index boleh hasil mmap (hanya kandidat yang dibaca)"""
+    refined = faiss.IndexRefine(index, flat_index)
+    refined.k_factor = k_factor
+    return refined
+
+
+def tune_search_index(index, flat_index, k: int = 10, target: float = ANN_TARGET_RECALL,
+                      queries: int = ANN_TUNE_QUERIES, search_index=None) -> Dict:
+    """Naikkan nprobe / efSearch sampai recall@k terhadap flat >= target; nilainya ikut tersimpan di index
+
+    search_index (mis. index + rerank) dipakai untuk mengukur recall jika diberikan.
+    """
+    rng = np.random.default_rng(0)
+    sample = np.sort(rng.choice(flat_index.ntotal, min(queries, flat_index.ntotal), replace=False))
+    query_vectors = np.vstack([flat_index.reconstruct(int(pos)) for pos in sample])
+    k = min(k, flat_index.ntotal)
+    _, truth = flat_index.search(query_vectors, k)
+
+    if isinstance(index, faiss.IndexHNSW):
+        param, candidates = "efSearch", [16, 32, 64, 128, 256, 512]
+        apply = lambda value: setattr(index.hnsw, "efSearch", value)
+    else:
+        param, candidates = "nprobe", [n for n in (1, 2, 4, 8, 16, 32, 64, 128, 256) if n <= index.nlist]
+        apply = lambda value: setattr(index, "nprobe", value)
+
+    best_value, best_recall = candidates[0], 0.0
+    for value in candidates:
+        apply(value)
+        _, found = (search_index or index).search(query_vectors, k)
+        recall = np.mean([len(set(row) & set(expected)) / k for row, expected in zip(found, truth)])
+        if recall < best_recall + 0.005:
+            # Recall sudah mentok (mis. dibatasi kompresi PQ): menaikkan parameter hanya menambah latensi
+            break
+        best_value, best_recall = value, recall
+        if recall >= target:
+            break
+    apply(best_value)
+    return {param: best_value, 'recall_at_10': round(float(best_recall), 4)}
+
+
+def build_search_index(flat_index, index_type: str = ANN_INDEX_TYPE, refine: bool = None):
+    """Bangun index pencarian dari vektor flat; index flat dikembalikan apa adanya
+
+    refine: tuning IVF-PQ diukur dengan rerank exact (default: aktif untuk format mmap).
+    """
+    index_type = select_index_type(flat_index.ntotal, index_type)
+    if index_type == "flat" or flat_index.ntotal == 0:
+        return flat_index, {'type': "flat"}
+
+    dim = flat_index.d
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, ANN_HNSW_M)
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        nlist = ivf_nlist(flat_index.ntotal)
+        quantizer = faiss.IndexFlatL2(dim)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        else:
+            pq_bytes = ANN_PQ_BYTES or max(1, dim // 16)
+            while dim % pq_bytes:
+                pq_bytes -= 1
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_bytes, 8)
+        # Training (k-means) hanya pada sampel acak, bukan seluruh korpus
+        rng = np.random.default_rng(0)
+        train_size = min(flat_index.ntotal, max(ANN_TRAIN_SAMPLE, 39 * nlist))
+        positions = np.sort(rng.choice(flat_index.ntotal, train_size, replace=False))
+        index.train(np.vstack([flat_index.reconstruct(int(pos)) for pos in positions]))
+    else:
+        raise ValueError(f"ANN_INDEX_TYPE tidak dikenal: {index_type}")
+
+    for vectors in iter_flat_vectors(flat_index):
+        index.add(vectors)
+    if refine is None:
+        refine = ANN_PQ_REFINE_FACTOR > 0 and VECTOR_STORE_FORMAT == "mmap"
+    refine = refine and index_type == "ivf_pq"
+    params = tune_search_index(index, flat_index, search_index=with_refine(index, flat_index) if refine else None)
+    return index, {**describe_index(index), **params}
+
+
+def extend_search_index(index, flat_index, start: int):
+    """Perbarui index ANN yang sudah ada tanpa training/tuning ulang; None jika harus dibangun ulang.
+
+    Vektor flat [0, start) dianggap sudah ada di index dengan posisi yang sama; sisanya
+    (dokumen baru, atau semua vektor setelah posisi chunk pertama yang dihapus) ditambahkan.
+    """
+    index_type = describe_index(index)['type']
+    if index_type == "flat" or select_index_type(flat_index.ntotal) != index_type:
+        return None
+    if start < index.ntotal:
+        if not isinstance(index, faiss.IndexIVF):
+            # HNSW tidak mendukung penghapusan vektor
+            return None
+        index.remove_ids(faiss.IDSelectorRange(start, index.ntotal))
+    imbalance = index.invlists.imbalance_factor() if isinstance(index, faiss.IndexIVF) else None
+    for vectors in iter_flat_vectors(flat_index, start):
+        index.add(vectors)
+    if imbalance is not None:
+        # Centroid dilatih untuk korpus lama: latih ulang jika korpus sudah jauh lebih besar/kecil,
+        # atau vektor baru menumpuk di sebagian kecil list
+        nlist = ivf_nlist(flat_index.ntotal)
+        drifted = index.invlists.imbalance_factor() > max(ANN_IVF_MAX_IMBALANCE, imbalance)
+        if drifted or not nlist / 2 <= index.nlist <= nlist * 2:
+            return None
+    return index
+
+
+def flat_index_file(index_name: str) -> str:
+    return f"{index_name}.flat.faiss"
+
+
+def vector_store_files(index_name: str, store_format: str = VECTOR_STORE_FORMAT) -> List[str]:
+    """Nama file index sesuai format penyimpanan"""
+    sidecar = "docstore.db" if store_format == "mmap" else "pkl"
+    return [f"{index_name}.faiss", f"{index_name}.{sidecar}"]
+
+
+def save_vector_store(vectorstore: FAISS, folder_path: str, index_name: str,
+                      store_format: str = VECTOR_STORE_FORMAT, keyword_index: bool = True,
+                      search_index: bool = True, previous_index=None, unchanged: int = 0,
+                      previous_keyword_index: str = None) -> List[str]:
+    """Simpan vector store ke folder lokal, mengembalikan path file yang ditulis
+
+    Index BM25 dan salinan flat ada di urutan pertama supaya ter-upload sebelum .faiss
+    (penentu versi index). previous_index: index ANN versi sebelumnya yang sudah berisi
+    `unchanged` vektor pertama; diperbarui di tempat jika bisa (lihat extend_search_index).
+    previous_keyword_index: path index BM25 versi sebelumnya untuk update inkremental.
+    """
+    paths = [os.path.join(folder_path, name) for name in vector_store_files(index_name, store_format)]
+    extra_paths = []
+    if keyword_index:
+        keyword_path = os.path.join(folder_path, keyword_index_file(index_name))
+        KeywordIndex.write(keyword_path, vectorstore, previous_path=previous_keyword_index)
+        extra_paths.append(keyword_path)
+    if store_format == "mmap":
+        faiss.write_index(vectorstore.index, paths[0])
+        if os.path.exists(paths[1]):
+            os.remove(paths[1])
+        SQLiteDocstore.write(paths[1], vectorstore)
+    else:
+        vectorstore.save_local(folder_path=folder_path, index_name=index_name)
+
+    if search_index and is_flat_index(vectorstore.index):
+        index = None
+        if previous_index is not None:
+            index = extend_search_index(previous_index, vectorstore.index, unchanged)
+        if index is None:
+            index, _ = build_search_index(vectorstore.index)
+        if index is not vectorstore.index:
+            # .faiss berisi index ANN untuk query; salinan flat dipakai ingestion (merge/delete) berikutnya
+            flat_path = os.path.join(folder_path, flat_index_file(index_name))
+            os.replace(paths[0], flat_path)
+            faiss.write_index(index, paths[0])
+            extra_paths.append(flat_path)
+    return [*extra_paths, *paths]
+
+
+def load_vector_store_files(folder_path: str, index_name: str, embeddings,
+                            store_format: str = VECTOR_STORE_FORMAT, writable: bool = False) -> FAISS:
+    """Muat vector store dari folder lokal.
+
+    Format mmap membutuhkan file tetap ada selama dipakai, kecuali writable=True
+    (index dan docstore dibaca penuh ke memori supaya bisa ditambah/dihapus).
+    """
+    if store_format != "mmap":
+        return FAISS.load_local(
+            folder_path=folder_path,
+            index_name=index_name,
+            embeddings=embeddings,
+            allow_dangerous_deserialization=True
+        )
+
+    faiss_path, docstore_path = [os.path.join(folder_path, name) for name in vector_store_files(index_name, "mmap")]
+    if writable:
+        sqlite_docstore = SQLiteDocstore(docstore_path)
+        chunks = sqlite_docstore.all_documents()
+        sqlite_docstore.close()
+        return FAISS(
+            embedding_function=embeddings,
+            index=faiss.read_index(faiss_path),
+            docstore=InMemoryDocstore({doc_id: doc for _, doc_id, doc in chunks}),
+            index_to_docstore_id={pos: doc_id for pos, doc_id, _ in chunks}
+        )
+
+    # IO_FLAG_MMAP_IFC me-mmap kode vektor IndexFlat (faiss >= 1.8); versi lama pakai IO_FLAG_MMAP
+    mmap_flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+    index = faiss.read_index(faiss_path, mmap_flag | faiss.IO_FLAG_READ_ONLY)
+    docstore = SQLiteDocstore(docstore_path)
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=SQLiteIndexMapping(docstore)
+    )
+
+
+class VectorStoreCache:
+    """Cache FAISS index read-only yang dibagi semua session Streamlit dalam satu proses.
+
+    Index hanya di-download ulang jika manifest versi di S3 berubah; file yang di-download
+    persis file yang didaftar manifest itu, jadi satu entry tidak pernah mencampur dua versi.
+    """
+
+    def __init__(self, s3_client, embeddings, bucket: str = BUCKET_NAME,
+                 check_interval: float = VECTOR_VERSION_CHECK_INTERVAL,
+                 max_resident: int = VECTOR_MAX_RESIDENT_INDEXES):
+        self.s3_client = s3_client
+        self.embeddings = embeddings
+        self.bucket = bucket
+        self.check_interval = check_interval
+        self.max_resident = max_resident
+        # LRU: index yang paling lama tidak dipakai ada di depan
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._index_locks = {}
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _index_lock(self, index_name: str) -> threading.Lock:
+        with self._lock:
+            return self._index_locks.setdefault(index_name, threading.Lock())
+
+    def _remote_version(self, index_name: str):
+        """(versi, nama file -> key S3) dari manifest aktif"""
+        manifest, _ = read_index_manifest(self.s3_client, index_name, self.bucket)
+        files = index_manifest_files(manifest, index_name)
+        if manifest and 'files' in manifest:
+            return manifest['version'], files
+        # Index format lama: file di root bucket, versi dari ETag masing-masing file
+        etags = []
+        for file_name in vector_store_files(index_name):
+            head = self.s3_client.head_object(Bucket=self.bucket, Key=file_name)
+            etags.append(head.get("VersionId") or head["ETag"].strip('"'))
+        return ":".join(etags), files
+
+    def _download(self, files: Dict[str, str], folder_path: str, file_name: str) -> str:
+        local_file = os.path.join(folder_path, file_name)
+        if not os.path.exists(local_file):
+            if file_name not in files:
+                raise FileNotFoundError(file_name)
+            self.s3_client.download_file(self.bucket, files[file_name], local_file + ".part")
+            os.replace(local_file + ".part", local_file)
+        return local_file
+
+    @metrics.traced("vector_store.load")
+    def _load(self, index_name: str, version: str, files: Dict[str, str]) -> Dict:
+        mmap = VECTOR_STORE_FORMAT == "mmap"
+        if mmap:
+            # File harus tetap ada selama index di-mmap; satu folder per versi
+            folder_path = os.path.join(VECTOR_CACHE_DIR, index_name, uuid.uuid5(uuid.NAMESPACE_URL, version).hex)
+            os.makedirs(folder_path, exist_ok=True)
+        else:
+            folder_path = tempfile.mkdtemp(prefix="financial_ai_index_")
+
+        try:
+            nbytes = 0
+            for file_name in vector_store_files(index_name):
+                nbytes += os.path.getsize(self._download(files, folder_path, file_name))
+
+            vectorstore = load_vector_store_files(folder_path, index_name, self.embeddings)
+            keyword_index = self._load_keyword_index(folder_path, index_name, files, in_memory=not mmap)
+            if mmap and ANN_PQ_REFINE_FACTOR > 0 and isinstance(vectorstore.index, faiss.IndexIVFPQ):
+                nbytes += self._attach_refine(vectorstore, folder_path, index_name, files)
+        except Exception:
+            if mmap:
+                # Jangan tinggalkan folder versi yang setengah ter-download
+                shutil.rmtree(folder_path, ignore_errors=True)
+            raise
+        finally:
+            if not mmap:
+                shutil.rmtree(folder_path, ignore_errors=True)
+
+        return {
+            'vectorstore': vectorstore,
+            'keyword_index': keyword_index,
+            'index': describe_index(vectorstore.index),
+            'version': version,
+            'bytes': nbytes,
+            'mmap': mmap,
+            'folder_path': folder_path if mmap else None,
+            'ntotal': vectorstore.index.ntotal,
+            'loaded_at': datetime.now(),
+            'checked_at': time.monotonic()
+        }
+
+    def _attach_refine(self, vectorstore: FAISS, folder_path: str, index_name: str, files: Dict[str, str]) -> int:
+        """Rerank kandidat IVF-PQ dengan vektor full precision dari .flat.faiss (di-mmap, bukan heap)"""
+        local_file = self._download(files, folder_path, flat_index_file(index_name))
+        mmap_flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+        flat_index = faiss.read_index(local_file, mmap_flag | faiss.IO_FLAG_READ_ONLY)
+        vectorstore.index = with_refine(vectorstore.index, flat_index)
+        return os.path.getsize(local_file)
+
+    def _load_keyword_index(self, folder_path: str, index_name: str, files: Dict[str, str], in_memory: bool):
+        """Index BM25 opsional: index lama (sebelum hybrid retrieval) belum punya file .bm25.db"""
+        file_name = keyword_index_file(index_name)
+        try:
+            local_file = self._download(files, folder_path, file_name)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            # Format lama (mapping identitas ke root) tidak tahu apakah file-nya ada
+            if is_missing_object_error(e) and files.get(file_name) == file_name:
+                return None
+            raise
+        return KeywordIndex(local_file, in_memory=in_memory)
+
+    def get(self, index_name: str = VECTOR_INDEX_NAME) -> Dict:
+        """Ambil index dari cache, download ulang hanya jika versi di S3 berubah"""
+        with self._index_lock(index_name):
+            entry = self._entries.get(index_name)
+            if entry and time.monotonic() - entry['checked_at'] < self.check_interval:
+                self._touch(index_name)
+                self.hits += 1
+                return entry
+
+            version, files = self._remote_version(index_name)
+            if entry and entry['version'] == version:
+                entry['checked_at'] = time.monotonic()
+                self._touch(index_name)
+                self.hits += 1
+                return entry
+
+            self.misses += 1
+            previous = entry
+            try:
+                entry = self._load(index_name, version, files)
+            except Exception as e:
+                if not is_missing_object_error(e):
+                    raise
+                # Versi ini sudah diganti dan dibersihkan di tengah download: ulang dari manifest terbaru
+                version, files = self._remote_version(index_name)
+                entry = self._load(index_name, version, files)
+            with self._lock:
+                self._entries[index_name] = entry
+                self._entries.move_to_end(index_name)
+            if previous and previous['folder_path'] and previous['folder_path'] != entry['folder_path']:
+                # Session yang masih memegang index lama tetap aman: file yang
+                # sudah di-mmap baru benar-benar hilang setelah di-unmap
+                shutil.rmtree(previous['folder_path'], ignore_errors=True)
+            self._evict(keep=index_name)
+            return entry
+
+    def _touch(self, index_name: str):
+        with self._lock:
+            if index_name in self._entries:
+                self._entries.move_to_end(index_name)
+
+    def _evict(self, keep: str):
+        """Buang index paling lama tidak dipakai sampai jumlah resident <= max_resident"""
+        evicted = []
+        with self._lock:
+            while len(self._entries) > max(self.max_resident, 1):
+                name = next(iter(self._entries))
+                if name == keep:
+                    break
+                evicted.append(self._entries.pop(name))
+                self.evictions += 1
+        for entry in evicted:
+            if entry['folder_path']:
+                shutil.rmtree(entry['folder_path'], ignore_errors=True)
+
+    def invalidate(self, index_name: str = VECTOR_INDEX_NAME):
+        """Paksa pengecekan versi pada akses berikutnya (mis. setelah upload index baru)"""
+        with self._index_lock(index_name):
+            entry = self._entries.get(index_name)
+            if entry:
+                entry['checked_at'] = float("-inf")
+
+    def stats(self) -> Dict:
+        """Memory accounting index yang sedang di-cache"""
+        indexes = {
+            name: {
+                'version': entry['version'],
+                'ntotal': entry['ntotal'],
+                'index': entry['index'],
+                'bytes': entry['bytes'],
+                'mmap': entry['mmap']
+            }
+            for name, entry in list(self._entries.items())
+        }
+        return {
+            'indexes': indexes,
+            # Index mmap tinggal di page cache OS, bukan di heap proses
+            'total_bytes': sum(index['bytes'] for index in indexes.values() if not index['mmap']),
+            'mmap_bytes': sum(index['bytes'] for index in indexes.values() if index['mmap']),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'max_resident': self.max_resident
+        }
+
+
+@st.cache_resource
+def init_vector_store_cache():
+    return VectorStoreCache(init_aws_clients()['s3'], init_embeddings())
+
+
+@st.cache_resource
+def init_index_write_lock():
+    # Serialisasi antar thread dalam satu proses; antar proses/pod lewat S3Lock (lihat index_write_lock)
+    return threading.Lock()
+
+
+def is_missing_object_error(error: Exception) -> bool:
+    code = getattr(error, "response", {}).get("Error", {}).get("Code")
+    return code in ("NoSuchKey", "404", "NotFound")
+
+
+def index_version_key(index_name: str) -> str:
+    return f"{index_name}.version.json"
+
+
+def registry_file(index_name: str) -> str:
+    return f"{index_name}.documents.json"
+
+
+def read_index_manifest(s3_client, index_name: str, bucket: str = BUCKET_NAME):
+    """Manifest versi index yang aktif: (manifest, ETag), atau (None, None) jika belum ada.
+
+    Manifest mendaftar key S3 semua file satu versi; pembaca dan penulis hanya memakai
+    file dari manifest yang sama, jadi tidak pernah mencampur file dua versi.
+    """
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=index_version_key(index_name))
+    except Exception as e:
+        if is_missing_object_error(e):
+            return None, None
+        raise
+    return json.loads(response["Body"].read()), response["ETag"]
+
+
+def index_manifest_files(manifest, index_name: str) -> Dict[str, str]:
+    """Nama file -> key S3 versi manifest. Index format lama (tanpa daftar file) ada di root bucket"""
+    if manifest and 'files' in manifest:
+        return manifest['files']
+    names = [*vector_store_files(index_name), keyword_index_file(index_name), flat_index_file(index_name),
+             registry_file(index_name)]
+    return {name: name for name in names}
+
+
+def read_text_file(path: str):
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+class IndexVersionConflict(Exception):
+    """Index di S3 sudah dipublish proses lain sejak dibaca; read-modify-write harus diulang"""
+
+
+def is_precondition_error(error: Exception) -> bool:
+    """Conditional write (IfMatch / IfNoneMatch) ditolak karena object sudah berubah"""
+    code = getattr(error, "response", {}).get("Error", {}).get("Code")
+    return code in ("PreconditionFailed", "412", "ConditionalRequestConflict", "409")
+
+
+class S3Lock:
+    """Lock lintas proses dan pod berbasis object S3 dengan lease.
+
+    Acquire = put_object(IfNoneMatch="*"); lock yang lease-nya habis (pemilik mati) diambil
+    alih dengan put_object(IfMatch=<etag lama>) sehingga hanya satu pengambil yang menang.
+    Selama dipegang, lease diperpanjang thread terpisah; jika perpanjangan ditolak (lock sudah
+    diambil alih) `lost` diset dan check() melempar error sebelum hasil dipublish.
+    """
+
+    def __init__(self, s3_client, key: str, bucket: str = BUCKET_NAME,
+                 lease_seconds: float = INDEX_LOCK_LEASE_SECONDS, timeout: float = INDEX_LOCK_TIMEOUT):
+        self.s3_client = s3_client
+        self.key = key
+        self.bucket = bucket
+        self.lease_seconds = lease_seconds
+        self.timeout = timeout
+        self.owner = f"{POD_ID}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lost = False
+        self._etag = None
+        self._stop = threading.Event()
+        self._renewer = None
+
+    def _put(self, **condition) -> str:
+        body = json.dumps({'owner': self.owner, 'expires_at': time.time() + self.lease_seconds}).encode()
+        return self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=body, **condition)['ETag']
+
+    def _try_acquire(self) -> bool:
+        try:
+            self._etag = self._put(IfNoneMatch="*")
+            return True
+        except Exception as e:
+            if not is_precondition_error(e):
+                raise
+        try:
+            current = self.s3_client.get_object(Bucket=self.bucket, Key=self.key)
+        except Exception as e:
+            # Lock baru saja dilepas: coba lagi di putaran berikutnya
+            if is_missing_object_error(e):
+                return False
+            raise
+        if json.loads(current['Body'].read()).get('expires_at', 0) > time.time():
+            return False
+        try:
+            self._etag = self._put(IfMatch=current['ETag'])
+            return True
+        except Exception as e:
+            if is_precondition_error(e) or is_missing_object_error(e):
+                return False
+            raise
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        delay = 0.2
+        while not self._try_acquire():
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Lock {self.key} masih dipegang proses lain")
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, 5.0)
+        self._stop.clear()
+        self._renewer = threading.Thread(target=self._renew, daemon=True, name="s3-lock-renew")
+        self._renewer.start()
+
+    def _renew(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                self._etag = self._put(IfMatch=self._etag)
+            except Exception as e:
+                if is_precondition_error(e) or is_missing_object_error(e):
+                    self.lost = True
+                    return
+                # Gangguan sementara: dicoba lagi sebelum lease habis
+                print(f"S3 lock renew error ({self.key}): {e}")
+
+    def check(self):
+        """Pastikan lock masih dipegang sebelum menulis hasil"""
+        if self.lost:
+            raise RuntimeError(f"Lock {self.key} diambil alih proses lain (lease habis)")
+
+    def release(self):
+        self._stop.set()
+        if self._renewer is not None:
+            self._renewer.join()
+            self._renewer = None
+        if self.lost:
+            return
+        try:
+            self.s3_client.delete_object(Bucket=self.bucket, Key=self.key, IfMatch=self._etag)
+        except Exception as e:
+            # Lock sudah diambil alih: biarkan milik pemegang baru
+            if not (is_precondition_error(e) or is_missing_object_error(e)):
+                raise
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+@contextmanager
+def index_write_lock(index_name: str):
+    """Lock read-modify-write satu index: thread lokal dulu, lalu lock S3 antar proses/pod"""
+    with init_index_write_lock(), S3Lock(init_aws_clients()['s3'], f"{INDEX_LOCK_S3_PREFIX}{index_name}.lock") as lock:
+        yield lock
+
+
+def normalize_collection_name(name: str) -> str:
+    return re.sub(r"[^a-z0-9_-]+", "-", (name or "").strip().lower()).strip("-") or DEFAULT_COLLECTION
+
+
+def collection_index_name(collection: str) -> str:
+    """Nama index (prefix object S3) untuk satu koleksi; koleksi default memakai index lama"""
+    collection = normalize_collection_name(collection)
+    if collection == DEFAULT_COLLECTION:
+        return VECTOR_INDEX_NAME
+    return f"{VECTOR_INDEX_NAME}__{collection}"
+
+
+@st.cache_resource
+def init_retrieval_executor():
+    return ThreadPoolExecutor(max_workers=VECTOR_FANOUT_WORKERS, thread_name_prefix="vector-fanout")
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimasi kasar ~4 karakter per token (tanpa tokenizer model)"""
+    return (len(text) + 3) // 4
+
+
+def merge_overlapping(first: str, second: str, min_overlap: int = CONTEXT_MIN_OVERLAP):
+    """Gabungkan dua chunk jika akhir first = awal second (overlap splitter); None jika tidak bertumpuk"""
+    if second in first:
+        return first
+    if first in second:
+        return second
+    head = second[:min_overlap]
+    start = first.find(head, max(0, len(first) - len(second)))
+    while start != -1:
+        if second.startswith(first[start:]):
+            return first + second[len(first) - start:]
+        start = first.find(head, start + 1)
+    return None
+
+
+class ContextPacker:
+    """Rerank kandidat chunk, gabungkan chunk bertumpuk dari halaman yang sama, isi sampai budget token"""
+
+    def __init__(self, token_budget: int = CONTEXT_TOKEN_BUDGET, rerank_weight: float = CONTEXT_RERANK_WEIGHT):
+        self.token_budget = token_budget
+        self.rerank_weight = rerank_weight
+
+    def rerank(self, question: str, documents: List[Document]) -> List[Document]:
+        """Skor = bobot * cakupan term pertanyaan (idf dalam kandidat) + sisa bobot * urutan retrieval"""
+        if len(documents) <= 1:
+            return list(documents)
+        terms = set(tokenize_keywords(question))
+        doc_terms = [terms.intersection(tokenize_keywords(doc.page_content)) for doc in documents]
+        df = Counter(term for found in doc_terms for term in found)
+        idf = {term: math.log1p(len(documents) / df[term]) for term in df}
+        total = sum(idf.values())
+        scores = []
+        for rank, found in enumerate(doc_terms):
+            lexical = sum(idf[term] for term in found) / total if total else 0.0
+            prior = 1 - rank / len(documents)
+            scores.append(self.rerank_weight * lexical + (1 - self.rerank_weight) * prior)
+        order = sorted(range(len(documents)), key=lambda i: scores[i], reverse=True)
+        return [documents[i] for i in order]
+
+    @staticmethod
+    def _source_key(document: Document):
+        metadata = document.metadata
+        return metadata.get('collection'), metadata.get('doc_id') or metadata.get('source'), metadata.get('page')
+
+    def pack(self, question: str, documents: List[Document]) -> List[Document]:
+        packed = []
+        used = 0
+        for document in self.rerank(question, documents):
+            key = self._source_key(document)
+            merged = False
+            for i, existing in enumerate(packed):
+                if key[1] is None or self._source_key(existing) != key:
+                    continue
+                text = (merge_overlapping(existing.page_content, document.page_content)
+                        or merge_overlapping(document.page_content, existing.page_content))
+                if text is None:
+                    continue
+                # Hanya bagian yang belum ada yang menambah token
+                extra = estimate_tokens(text) - estimate_tokens(existing.page_content)
+                if used + extra <= self.token_budget:
+                    packed[i] = Document(page_content=text, metadata=existing.metadata)
+                    used += extra
+                merged = True
+                break
+            if merged:
+                continue
+
+            cost = estimate_tokens(document.page_content)
+            if used + cost <= self.token_budget:
+                packed.append(document)
+                used += cost
+            elif not packed:
+                # Chunk paling relevan selalu masuk, dipotong sesuai budget
+                packed.append(Document(page_content=document.page_content[:self.token_budget * 4],
+                                       metadata=document.metadata))
+                used = self.token_budget
+        return packed
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = RRF_K) -> Dict[str, float]:
+    """Skor RRF: sum 1 / (k + rank) untuk setiap daftar di mana item muncul"""
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return scores
+
+
+class ShardedRetriever(BaseRetriever):
+    """Retriever yang query satu atau beberapa shard koleksi secara paralel lalu merge top-k.
+
+    Query di-embed sekali; shard dimuat lazy lewat VectorStoreCache (LRU). Pada mode
+    hybrid, kandidat FAISS dan BM25 per shard digabung dengan reciprocal rank fusion.
+    """
+
+    cache: object
+    embeddings: object
+    collections: List[str]
+    executor: object
+    k: int = 7
+    mode: str = RETRIEVAL_MODE
+    fetch_k: int = HYBRID_FETCH_K
+    packer: object = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _search_shard(self, collection: str, vector: List[float], query: str):
+        entry = self.cache.get(collection_index_name(collection))
+        vectorstore = entry['vectorstore']
+        if self.mode == "hybrid":
+            results = self._hybrid_search(vectorstore, entry.get('keyword_index'), vector, query)
+        else:
+            # Skor FAISS = jarak L2, makin kecil makin relevan; dibalik supaya makin besar makin relevan
+            results = [(doc, -score) for doc, score in vectorstore.similarity_search_with_score_by_vector(vector, k=self.k)]
+        return [
+            (Document(page_content=doc.page_content, metadata={**doc.metadata, 'collection': collection}), score)
+            for doc, score in results
+        ]
+
+    def _hybrid_search(self, vectorstore: FAISS, keyword_index, vector: List[float], query: str):
+        """Ranking FAISS + BM25 per posisi vektor; docstore hanya dibaca untuk top-k hasil fusion"""
+        _, positions = vectorstore.index.search(np.array([vector], dtype=np.float32), self.fetch_k)
+        rankings = [[int(pos) for pos in positions[0] if pos != -1]]
+        # Index lama tanpa .bm25.db: tetap jalan dengan ranking vektor saja
+        if keyword_index is not None:
+            rankings.append([pos for pos, _ in keyword_index.search(query, self.fetch_k)])
+        fused = sorted(reciprocal_rank_fusion(rankings).items(), key=lambda item: item[1], reverse=True)
+        return [
+            (vectorstore.docstore.search(vectorstore.index_to_docstore_id[pos]), score)
+            for pos, score in fused[:self.k]
+        ]
+
+    @metrics.traced("qa.retrieve")
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        vector = self.embeddings.embed_query(query)
+        if len(self.collections) == 1:
+            results = self._search_shard(self.collections[0], vector, query)
+        else:
+            futures = [self.executor.submit(self._search_shard, collection, vector, query)
+                       for collection in self.collections]
+            results = [item for future in futures for item in future.result()]
+        results.sort(key=lambda item: item[1], reverse=True)
+        documents = [doc for doc, _ in results[:self.k]]
+        if self.packer is not None:
+            documents = self.packer.pack(query, documents)
+        return documents
+
+
+class StageTimingHandler(BaseCallbackHandler):
+    """Callback per pertanyaan yang mencatat durasi retrieve, prompt assembly, dan LLM call"""
+
+    def __init__(self):
+        self.marks = {'start': time.perf_counter()}
+        self.sizes = {}
+
+    def on_retriever_start(self, serialized, query, **kwargs):
+        self.marks.setdefault('retriever_start', time.perf_counter())
+
+    def on_retriever_end(self, documents, **kwargs):
+        self.marks['retriever_end'] = time.perf_counter()
+        self.sizes['context_chunks'] = len(documents)
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.marks.setdefault('llm_start', time.perf_counter())
+        self.record_prompt(prompts[0] if prompts else "", self.sizes.get('context_chunks'))
+
+    def record_prompt(self, prompt: str, context_chunks: int = None):
+        self.sizes['prompt_tokens'] = estimate_tokens(prompt)
+        if context_chunks is not None:
+            self.sizes['context_chunks'] = context_chunks
+
+    def on_llm_end(self, response, **kwargs):
+        self.marks['llm_end'] = time.perf_counter()
+
+    def timings(self) -> Dict:
+        marks = {**self.marks, 'end': time.perf_counter()}
+
+        def span(start, end):
+            if start in marks and end in marks:
+                return marks[end] - marks[start]
+            return None
+
+        return {
+            'retrieve': span('retriever_start', 'retriever_end'),
+            # Stuffing dokumen ke prompt terjadi di antara retriever selesai dan LLM dipanggil
+            'prompt': span('retriever_end', 'llm_start'),
+            'llm': span('llm_start', 'llm_end'),
+            # Time-to-first-token dihitung dari pertanyaan masuk (hanya jalur streaming)
+            'ttft': span('start', 'first_token'),
+            'total': span('start', 'end'),
+            'prompt_tokens': self.sizes.get('prompt_tokens'),
+            'context_chunks': self.sizes.get('context_chunks')
+        }
+
+
+class QAChainFactory:
+    """Cache RetrievalQA chain per (koleksi, k, prompt), dibagi semua session dalam satu proses.
+
+    Retriever me-resolve versi shard terbaru lewat VectorStoreCache di setiap query, jadi chain
+    tidak perlu dibangun ulang ketika index di S3 berubah.
+    """
+
+    STAGES = ('retrieve', 'prompt', 'llm', 'ttft', 'total')
+    SIZES = ('prompt_tokens', 'context_chunks')
+
+    def __init__(self, llm, embeddings, vector_cache, executor, max_chains: int = QA_CHAIN_CACHE_SIZE,
+                 bedrock_client=None):
+        self.llm = llm
+        self.bedrock_client = bedrock_client
+        self.embeddings = embeddings
+        self.vector_cache = vector_cache
+        self.executor = executor
+        self.max_chains = max_chains
+        self._chains = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.builds = 0
+        self.reuses = 0
+        self.calls = 0
+        self._stage_totals = dict.fromkeys(self.STAGES + self.SIZES, 0.0)
+        self._stage_counts = dict.fromkeys(self.STAGES + self.SIZES, 0)
+        self.last_timings = {}
+
+    def get(self, collections: List[str], k: int = RETRIEVAL_TOP_K, prompt: PromptTemplate = FINANCIAL_PROMPT):
+        key = (tuple(collections), k, prompt.template)
+        with self._lock:
+            chain = self._chains.get(key)
+            if chain is not None:
+                self._chains.move_to_end(key)
+                self.reuses += 1
+                return chain
+
+        chain = RetrievalQA.from_chain_type(
+            llm=self.llm,
+            chain_type="stuff",
+            retriever=ShardedRetriever(
+                cache=self.vector_cache,
+                embeddings=self.embeddings,
+                collections=list(collections),
+                executor=self.executor,
+                # Dengan packing, retrieval mengambil kandidat lebih banyak; budget token yang membatasi konteks
+                k=max(k, CONTEXT_CANDIDATES) if CONTEXT_PACKING else k,
+                packer=ContextPacker() if CONTEXT_PACKING else None
+            ),
+            return_source_documents=True,
+            chain_type_kwargs={"prompt": prompt}
+        )
+        with self._lock:
+            chain = self._chains.setdefault(key, chain)
+            self._chains.move_to_end(key)
+            self.builds += 1
+            while len(self._chains) > self.max_chains:
+                self._chains.popitem(last=False)
+        return chain
+
+    def run(self, collections: List[str], question: str, k: int = RETRIEVAL_TOP_K) -> Dict:
+        """Jalankan chain dan kembalikan hasil beserta durasi per tahap"""
+        chain = self.get(collections, k)
+        timing = StageTimingHandler()
+        result = chain({"query": question}, callbacks=[timing])
+        timings = timing.timings()
+        self.record(timings)
+        return {**result, 'timings': timings}
+
+    def stream(self, collections: List[str], question: str, k: int = RETRIEVAL_TOP_K, timing=None):
+        """Seperti run(), tapi jawaban LLM di-yield per potongan teks begitu diterima dari Bedrock"""
+        chain = self.get(collections, k)
+        timing = timing or StageTimingHandler()
+        marks = timing.marks
+
+        marks['retriever_start'] = time.perf_counter()
+        documents = chain.retriever.get_relevant_documents(question)
+        marks['retriever_end'] = time.perf_counter()
+
+        # Sama dengan StuffDocumentsChain: page_content digabung dengan "\n\n"
+        prompt = chain.combine_documents_chain.llm_chain.prompt.format(
+            context="\n\n".join(doc.page_content for doc in documents),
+            question=question
+        )
+        timing.record_prompt(prompt, len(documents))
+        marks['llm_start'] = time.perf_counter()
+        for text in stream_bedrock_completion(self.bedrock_client, prompt):
+            marks.setdefault('first_token', time.perf_counter())
+            yield text
+        marks['llm_end'] = time.perf_counter()
+        self.record(timing.timings())
+
+    def record(self, timings: Dict):
+        with self._lock:
+            self.calls += 1
+            self.last_timings = timings
+            for stage in self.STAGES + self.SIZES:
+                if timings.get(stage) is not None:
+                    self._stage_totals[stage] += timings[stage]
+                    self._stage_counts[stage] += 1
+        for stage in self.STAGES:
+            if timings.get(stage) is not None:
+                QA_STAGE_SECONDS.observe(timings[stage], stage=stage)
+        if timings.get('prompt_tokens') is not None:
+            QA_PROMPT_TOKENS.observe(timings['prompt_tokens'])
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'chains': len(self._chains),
+                'builds': self.builds,
+                'reuses': self.reuses,
+                'calls': self.calls,
+                'avg_seconds': {
+                    stage: self._stage_totals[stage] / self._stage_counts[stage] if self._stage_counts[stage] else None
+                    for stage in self.STAGES
+                },
+                'avg_sizes': {
+                    size: self._stage_totals[size] / self._stage_counts[size] if self._stage_counts[size] else None
+                    for size in self.SIZES
+                },
+                'last_timings': dict(self.last_timings)
+            }
+
+
+@st.cache_resource
+def init_qa_chain_factory():
+    return QAChainFactory(
+        init_llm(), init_embeddings(), init_vector_store_cache(), init_retrieval_executor(),
+        bedrock_client=init_aws_clients()['bedrock']
+    )
+
+
+def build_text_splitter() -> RecursiveTextSplitter:
+    """Output identik dengan RecursiveCharacterTextSplitter(1500, 300) + filter panjang 50-4000"""
+    return RecursiveTextSplitter(
+        chunk_size=1500,
+        chunk_overlap=300,
+        separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""],
+        min_length=50,
+        max_length=4000
+    )
+
+
+def iter_split_documents(documents: Iterable[Document], workers: int = None) -> Iterator[Document]:
+    """Split per dokumen (halaman) sehingga tidak perlu semua halaman di memori; chunk ekstrem dibuang"""
+    text_splitter = build_text_splitter()
+    workers = SPLIT_WORKERS if workers is None else workers
+    if workers <= 1:
+        for document in documents:
+            for chunk in text_splitter.split_text(document.page_content):
+                yield Document(page_content=chunk, metadata=dict(document.metadata))
+        return
+
+    # Paralel per batch dokumen; urutan chunk tetap sama dengan input
+    executor = get_executor(workers)
+    pending = deque()
+    batches = iter_batches(documents, SPLIT_DOCUMENTS_PER_TASK)
+    try:
+        while True:
+            while len(pending) < workers * 2:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                pending.append((batch, executor.submit(
+                    split_text_batch, text_splitter, [document.page_content for document in batch])))
+            if not pending:
+                return
+            batch, future = pending.popleft()
+            for document, chunks in zip(batch, future.result()):
+                for chunk in chunks:
+                    yield Document(page_content=chunk, metadata=dict(document.metadata))
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+
+class NearDuplicateFilter:
+    """Membuang chunk yang (hampir) sama dengan chunk sebelumnya dalam satu upload.
+
+    Duplikat persis dikenali lewat hash teks yang dinormalisasi; near-duplicate lewat
+    MinHash shingle kata + LSH banding, lalu kandidat diverifikasi dengan estimasi
+    Jaccard >= threshold. Angka ikut di shingle, jadi tabel yang hanya sama
+    judulnya tetap dianggap berbeda.
+    """
+
+    _PRIME = (1 << 61) - 1
+
+    def __init__(self, threshold: float = DEDUP_SIMILARITY_THRESHOLD, num_perm: int = DEDUP_NUM_PERM,
+                 bands: int = DEDUP_BANDS, shingle_words: int = DEDUP_SHINGLE_WORDS):
+        if num_perm % bands:
+            raise ValueError("DEDUP_NUM_PERM harus habis dibagi DEDUP_BANDS")
+        rng = np.random.default_rng(1)
+        # a, b < 2^32 dan hash shingle < 2^32: a * x + b tidak overflow uint64
+        self._a = rng.integers(1, 1 << 32, num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 32, num_perm, dtype=np.uint64)
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_words = shingle_words
+        self._exact = set()
+        self._buckets = {}
+        self._signatures = []
+        self.stats = {'chunks_in': 0, 'exact_duplicates': 0, 'near_duplicates': 0, 'tokens_saved': 0,
+                      'embedding_calls_saved': 0}
+
+    def signature(self, text: str) -> np.ndarray:
+        words = text.split()
+        size = self.shingle_words
+        shingles = {" ".join(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+        hashes = np.fromiter((zlib.crc32(shingle.encode()) for shingle in shingles), dtype=np.uint64,
+                             count=len(shingles))
+        return ((np.outer(hashes, self._a) + self._b) % np.uint64(self._PRIME)).min(axis=0)
+
+    def is_duplicate(self, text: str) -> bool:
+        """True jika text duplikat chunk yang sudah lolos; jika tidak, text didaftarkan"""
+        self.stats['chunks_in'] += 1
+        normalized = " ".join(text.lower().split())
+        digest = hashlib.sha1(normalized.encode()).digest()
+        if digest in self._exact:
+            self._record_skip(text, 'exact_duplicates')
+            return True
+
+        signature = self.signature(normalized)
+        band_keys = [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+                     for band in range(self.bands)]
+        candidates = {index for key in band_keys for index in self._buckets.get(key, ())}
+        for index in candidates:
+            if np.mean(self._signatures[index] == signature) >= self.threshold:
+                self._record_skip(text, 'near_duplicates')
+                return True
+
+        self._exact.add(digest)
+        for key in band_keys:
+            self._buckets.setdefault(key, []).append(len(self._signatures))
+        self._signatures.append(signature)
+        return False
+
+    def _record_skip(self, text: str, kind: str):
+        self.stats[kind] += 1
+        self.stats['tokens_saved'] += estimate_tokens(text)
+        if kind == 'near_duplicates':
+            # Duplikat persis sudah dilayani EmbeddingCache; near-duplicate akan memanggil Bedrock
+            self.stats['embedding_calls_saved'] += 1
+
+    def filter(self, documents: Iterable[Document]) -> Iterator[Document]:
+        for document in documents:
+            if not self.is_duplicate(document.page_content):
+                yield document
+
+
+def iter_pdf_documents(file_path: str, page_callback=None) -> Iterator[Document]:
+    """Halaman PDF sebagai Document, diekstrak paralel dan di-yield berurutan"""
+    total_pages = count_pdf_pages(file_path) if page_callback else None
+    for page_number, text in iter_pdf_pages(file_path, PDF_INGEST_WORKERS, PDF_PAGES_PER_TASK):
+        if page_callback:
+            page_callback(page_number + 1, total_pages)
+        yield Document(page_content=text, metadata={"source": file_path, "page": page_number})
+
+
+def detect_financial_columns(columns) -> List[str]:
+    columns = pd.Index(columns)
+    return list(columns[columns.astype(str).str.lower().str.contains(FINANCIAL_COLUMN_PATTERN)])
+
+
+def parse_money_series(series: pd.Series):
+    """Parse kolom teks uang (format Indonesia atau US) jadi float; None jika bukan kolom uang"""
+    if pd.api.types.is_numeric_dtype(series) or pd.api.types.is_datetime64_any_dtype(series):
+        return None
+    sample = series.dropna().astype(str).str.strip().str.lower().head(1000)
+    if sample.empty or sample.str.match(MONEY_VALUE_PATTERN).mean() < 0.9:
+        return None
+    if not sample.str.contains(MONEY_MARKER_PATTERN).any():
+        return None
+
+    text = series.astype("string")
+    negative = text.str.contains(r"^\s*\(|-", regex=True)
+    # Locale per kolom: "1.234.567" / "1.234,56" = Indonesia, "1,234,567" / "1,234.56" = US
+    sample_digits = sample.str.replace(r"[^\d.,]", "", regex=True)
+    if sample_digits.str.contains(r",\d{1,2}$|^\d{1,3}(?:\.\d{3})+$").mean() >= 0.5:
+        digits = text.str.replace(r"[^\d,]", "", regex=True).str.replace(",", ".", regex=False)
+    else:
+        digits = text.str.replace(r"[^\d.]", "", regex=True)
+    digits = digits.mask(digits == "")
+    try:
+        values = digits.astype("float64")
+    except (TypeError, ValueError):
+        # Ada nilai rusak (mis. "1.2.3"): parse satu per satu dengan coerce
+        values = pd.to_numeric(digits, errors="coerce").astype("float64")
+    return values.where(~negative.fillna(False).astype(bool), -values)
+
+
+class FinancialProfiler:
+    """Profil statistik kolom keuangan, di-update per blok baris (lihat iter_tabular_frames).
+
+    Setiap blok: kolom uang berformat teks di-parse vektor, lalu sum/count/min/max dihitung
+    sekali jalan dengan DataFrame.agg dan digabung. Kuantil dihitung dari sampel baris
+    proporsional (persis jika file muat dalam satu blok).
+    """
+
+    def __init__(self, sample_rows: int = PROFILE_SAMPLE_ROWS):
+        self.sample_rows = sample_rows
+        self.rows = 0
+        self.columns = None
+        self.financial_columns = []
+        self.money_columns = []
+        self.date_column = None
+        self._agg = None
+        self._sample = None
+        self._period_sums = None
+
+    def _financial_view(self, frame: pd.DataFrame) -> pd.DataFrame:
+        if self.columns is None:
+            self.columns = list(frame.columns)
+            by_name = set(detect_financial_columns(frame.columns))
+            for col in frame.columns:
+                if pd.api.types.is_numeric_dtype(frame[col]):
+                    if col in by_name:
+                        self.financial_columns.append(col)
+                elif parse_money_series(frame[col].head(1000)) is not None:
+                    # Kolom uang berformat teks ikut dianggap kolom keuangan walau namanya tidak cocok
+                    self.financial_columns.append(col)
+                    self.money_columns.append(col)
+            self.date_column = next(
+                (col for col in frame.columns if col not in self.financial_columns
+                 and classify_column(col, frame[col]) == "date"), None
+            )
+
+        view = {}
+        for col in self.financial_columns:
+            parsed = parse_money_series(frame[col]) if col in self.money_columns else None
+            view[col] = parsed if parsed is not None else pd.to_numeric(frame[col], errors="coerce")
+        return pd.DataFrame(view, index=frame.index)
+
+    def _periods(self, frame: pd.DataFrame) -> pd.Series:
+        """Kunci bulan per baris sebagai angka YYYYMM (year * 100 + month) untuk semua format tanggal.
+
+        strftime per baris jauh lebih lambat dari aritmetika year/month; label teks
+        dibuat setelah group by (lihat update).
+        """
+        dates = frame[self.date_column]
+        if not pd.api.types.is_datetime64_any_dtype(dates):
+            text = dates.astype("string")
+            if text.str.match(r"^\d{4}-\d{2}").mean() >= 0.9:
+                # Tanggal ISO: tahun dan bulan langsung dari teks, tanpa parsing tanggal penuh
+                year = pd.to_numeric(text.str[:4], errors="coerce")
+                month = pd.to_numeric(text.str[5:7], errors="coerce")
+                return year * 100 + month
+            dates = pd.to_datetime(dates, errors="coerce", format="mixed", dayfirst=detect_dayfirst(dates))
+        return dates.dt.year * 100 + dates.dt.month
+
+    def update(self, frame: pd.DataFrame):
+        values = self._financial_view(frame)
+        self.rows += len(frame)
+        if values.empty or not len(values.columns):
+            return
+
+        agg = values.agg(["sum", "count", "min", "max"])
+        if self._agg is None:
+            self._agg = agg
+        else:
+            self._agg = pd.DataFrame([
+                self._agg.loc["sum"] + agg.loc["sum"],
+                self._agg.loc["count"] + agg.loc["count"],
+                np.fmin(self._agg.loc["min"], agg.loc["min"]),
+                np.fmax(self._agg.loc["max"], agg.loc["max"]),
+            ], index=["sum", "count", "min", "max"])
+
+        # Sampel proporsional: blok baru mendapat jatah sebanding ukurannya
+        keep_new = min(len(values), max(1, round(self.sample_rows * len(values) / self.rows)))
+        block_sample = values.sample(keep_new, random_state=self.rows) if keep_new < len(values) else values
+        if self._sample is None:
+            self._sample = block_sample
+        else:
+            keep_old = min(len(self._sample), self.sample_rows - len(block_sample))
+            self._sample = pd.concat([self._sample.sample(keep_old, random_state=self.rows), block_sample])
+
+        if self.date_column is not None:
+            period_sums = values.groupby(self._periods(frame)).sum()
+            period_sums.index = [f"{int(key) // 100:04d}-{int(key) % 100:02d}" for key in period_sums.index]
+            self._period_sums = period_sums if self._period_sums is None else self._period_sums.add(period_sums, fill_value=0)
+
+    def result(self) -> Dict:
+        stats = {}
+        if self._agg is not None:
+            quantiles = self._sample.quantile([0.25, 0.5, 0.75])
+            for col in self._agg.columns:
+                total, count = self._agg.at["sum", col], self._agg.at["count", col]
+                stats[col] = {
+                    'sum': float(total),
+                    'count': int(count),
+                    'mean': float(total / count) if count else None,
+                    'min': float(self._agg.at["min", col]),
+                    'max': float(self._agg.at["max", col]),
+                    'p25': float(quantiles.at[0.25, col]),
+                    'median': float(quantiles.at[0.5, col]),
+                    'p75': float(quantiles.at[0.75, col]),
+                }
+
+        growth = {}
+        if self._period_sums is not None and len(self._period_sums) >= 2:
+            period_sums = self._period_sums.sort_index()
+            years = period_sums.groupby(period_sums.index.str[:4]).sum()
+            # Year-over-year jika ada >= 2 tahun, selain itu month-over-month
+            series, label = (years, "tahun") if len(years) >= 2 else (period_sums, "bulan")
+            previous, latest = series.iloc[-2], series.iloc[-1]
+            for col in series.columns:
+                growth[col] = {
+                    'period': label,
+                    'from': series.index[-2],
+                    'to': series.index[-1],
+                    'pct': float((latest[col] - previous[col]) / abs(previous[col]) * 100) if previous[col] else None
+                }
+
+        return {
+            'rows': self.rows,
+            'columns': [str(col) for col in self.columns or []],
+            'financial_columns': [str(col) for col in self.financial_columns],
+            'money_columns': [str(col) for col in self.money_columns],
+            'stats': {str(col): value for col, value in stats.items()},
+            'growth': {str(col): value for col, value in growth.items()}
+        }
+
+
+def format_financial_summary(profile: Dict) -> str:
+    """Ringkasan teks dari hasil FinancialProfiler.result()"""
+    summary = [
+        f"Total baris data: {profile['rows']}",
+        f"Kolom yang terdeteksi: {', '.join(profile['columns'])}"
+    ]
+    if profile['financial_columns']:
+        summary.append(f"Kolom keuangan utama: {', '.join(profile['financial_columns'])}")
+        for col, stats in profile['stats'].items():
+            if not stats['count']:
+                continue
+            summary.append(
+                f"{col}: Total = {stats['sum']:,.2f}, Rata-rata = {stats['mean']:,.2f}, "
+                f"Min = {stats['min']:,.2f}, Max = {stats['max']:,.2f}, Median = {stats['median']:,.2f}, "
+                f"Kuartil 1/3 = {stats['p25']:,.2f} / {stats['p75']:,.2f}"
+            )
+        for col, growth in profile['growth'].items():
+            if growth['pct'] is not None:
+                summary.append(
+                    f"Pertumbuhan {col} per {growth['period']} ({growth['from']} → {growth['to']}): {growth['pct']:+.1f}%"
+                )
+    return "\n".join(summary)
+
+
+def file_content_hash(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FinancialProfileCache:
+    """LRU profil keuangan per hash isi file: upload ulang file yang sama tidak dihitung ulang"""
+
+    def __init__(self, max_entries: int = PROFILE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, content_hash: str):
+        with self._lock:
+            profile = self._entries.get(content_hash)
+            if profile is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(content_hash)
+            self.hits += 1
+            return profile
+
+    def put(self, content_hash: str, profile: Dict):
+        with self._lock:
+            self._entries[content_hash] = profile
+            self._entries.move_to_end(content_hash)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+@st.cache_resource
+def init_profile_cache():
+    return FinancialProfileCache()
+
+
+def iter_tabular_frames(file_path: str, file_type: str, chunk_rows: int = TABULAR_READ_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    """Baca CSV/XLSX per blok baris sehingga file jutaan baris tidak dimuat sekaligus"""
+    if file_type == "csv":
+        yield from pd.read_csv(file_path, chunksize=chunk_rows)
+        return
+
+    # openpyxl read-only men-stream baris dari XML sheet (sheet pertama, sama seperti pd.read_excel)
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [str(col) if col is not None else f"Unnamed: {i}" for i, col in enumerate(header)]
+        for batch in iter_batches(rows, chunk_rows):
+            yield pd.DataFrame.from_records(batch, columns=columns).infer_objects()
+    finally:
+        workbook.close()
+
+
+def row_groups(lengths: np.ndarray, rows_per_document: int, max_chars: int) -> np.ndarray:
+    """Nomor kelompok per baris: kelompok ditutup jika sudah rows_per_document baris atau
+    baris berikutnya membuat panjangnya melebihi max_chars (minimal satu baris per kelompok)"""
+    groups = np.empty(len(lengths), dtype=np.int64)
+    group, rows, total = 0, 0, 0
+    for i, length in enumerate(lengths.tolist()):
+        if rows and (rows == rows_per_document or total + length > max_chars):
+            group, rows, total = group + 1, 0, 0
+        groups[i] = group
+        rows += 1
+        total += length
+    return groups
+
+
+def iter_tabular_documents(file_path: str, file_type: str,
+                           rows_per_document: int = TABULAR_ROWS_PER_DOCUMENT,
+                           frames: Iterable[pd.DataFrame] = None,
+                           max_chars: int = TABULAR_MAX_CHARS) -> Iterator[Document]:
+    """Dokumen ringkas per TABULAR_ROWS_PER_DOCUMENT baris (paling panjang max_chars karakter),
+    masing-masing membawa header kolom.
+
+    Profil keuangan (FinancialProfiler) dihitung inkremental dan di-yield terakhir,
+    dipecah per baris ringkasan jika melebihi max_chars; file yang isinya sama memakai
+    profil dari cache. Baris tunggal yang lebih panjang dari max_chars tetap satu dokumen
+    dan dipecah text splitter saat ingestion.
+    """
+    columns = None
+    row_offset = 0
+    profile_cache = init_profile_cache()
+    content_hash = file_content_hash(file_path)
+    profile = profile_cache.get(content_hash)
+    profiler = FinancialProfiler() if profile is None else None
+    for frame in frames if frames is not None else iter_tabular_frames(file_path, file_type):
+        if columns is None:
+            columns = list(frame.columns)
+            header = "Kolom: " + " | ".join(map(str, columns))
+
+        if profiler is not None:
+            profiler.update(frame)
+
+        # Baris -> "v1 | v2 | ..." secara vektor per kolom, lalu digabung per kelompok baris
+        cells = frame.astype("string").fillna("")
+        lines = cells.iloc[:, 0]
+        if cells.shape[1] > 1:
+            lines = lines.str.cat([cells.iloc[:, i] for i in range(1, cells.shape[1])], sep=" | ")
+        # +1 untuk newline pemisah baris; header ikut dihitung di setiap dokumen
+        groups = row_groups(lines.str.len().to_numpy() + 1, rows_per_document, max_chars - len(header))
+        starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+        ends = np.r_[starts[1:], len(frame)] - 1
+        for group, text in lines.groupby(groups).agg("\n".join).items():
+            row_start = row_offset + int(starts[group])
+            row_end = row_offset + int(ends[group])
+            yield Document(
+                page_content=f"{header}\n{text}",
+                metadata={"source": file_path, "type": "financial_data", "row_start": row_start, "row_end": row_end}
+            )
+        row_offset += len(frame)
+
+    if columns is not None:
+        if profile is None:
+            profile = profiler.result()
+            profile_cache.put(content_hash, profile)
+        title = "RINGKASAN KEUANGAN:"
+        summary_lines = format_financial_summary(profile).split("\n")
+        groups = row_groups(np.array([len(line) + 1 for line in summary_lines]), len(summary_lines),
+                            max_chars - len(title))
+        for group in range(int(groups[-1]) + 1):
+            text = "\n".join(line for line, line_group in zip(summary_lines, groups) if line_group == group)
+            yield Document(
+                page_content=f"{title}\n{text}",
+                metadata={"source": file_path, "type": "financial_summary"}
+            )
 
-class ChatManager:
-    """Mengelola chat sessions dan persistensi dengan S3 sync"""
 
-    def __init__(self):
-        self.s3_client = boto3.client("s3")
-        self.sync_from_s3()
-        self.init_database()
+def iter_batches(items: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def normalize_question(question: str) -> str:
+    return re.sub(r"\s+", " ", question.lower()).strip(" ?!.")
+
+
+def question_numbers(question: str) -> frozenset:
+    """Angka, tahun, dan kuartal di pertanyaan ("q3 2023" -> {"q3", "2023"}); pemisah ribuan diabaikan"""
+    text = normalize_question(question)
+    quarters = {f"q{number}" for number in re.findall(r"\b(?:q|kuartal|quarter|triwulan)\s*-?\s*([1-4])\b", text)}
+    text = re.sub(r"\b(?:q|kuartal|quarter|triwulan)\s*-?\s*[1-4]\b", " ", text)
+    numbers = {re.sub(r"[.,](?=\d{3}\b)", "", number) for number in re.findall(r"\d+(?:[.,]\d+)*", text)}
+    return frozenset(quarters | numbers)
+
+
+class AnswerCache:
+    """Cache jawaban LLM per (versi index, pertanyaan ternormalisasi), dibagi semua session.
+
+    Pertanyaan yang redaksinya berbeda tapi maknanya sama bisa ditemukan lewat
+    cosine similarity embedding pertanyaan (hanya dalam versi index yang sama, dan hanya
+    jika angka/tahun/kuartal kedua pertanyaan sama persis).
+    """
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES, ttl: float = ANSWER_CACHE_TTL,
+                 semantic: bool = ANSWER_CACHE_SEMANTIC,
+                 similarity_threshold: float = ANSWER_CACHE_SIMILARITY_THRESHOLD):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.semantic = semantic
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _expired(self, entry: Dict) -> bool:
+        return time.monotonic() - entry['created_at'] > self.ttl
+
+    def get(self, version_key: tuple, question: str, embed_func=None):
+        """Jawaban yang di-cache atau None; embed_func dipanggil hanya jika lookup exact gagal"""
+        key = (version_key, normalize_question(question))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and self._expired(entry):
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return entry['answer']
+
+        embedding = None
+        if self.semantic and embed_func is not None:
+            embedding = self._unit(embed_func(question))
+            numbers = question_numbers(question)
+            with self._lock:
+                candidates = [
+                    (candidate_key, entry) for candidate_key, entry in self._entries.items()
+                    if candidate_key[0] == version_key and entry['embedding'] is not None
+                    and entry['numbers'] == numbers and not self._expired(entry)
+                ]
+                if candidates:
+                    similarities = np.stack([entry['embedding'] for _, entry in candidates]) @ embedding
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.similarity_threshold:
+                        best_key, best_entry = candidates[best]
+                        self._entries.move_to_end(best_key)
+                        self.semantic_hits += 1
+                        return best_entry['answer']
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, version_key: tuple, question: str, answer: str, embedding=None):
+        key = (version_key, normalize_question(question))
+        with self._lock:
+            self._entries[key] = {
+                'answer': answer,
+                'embedding': self._unit(embedding) if embedding is not None else None,
+                'numbers': question_numbers(question),
+                'created_at': time.monotonic()
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, index_name: str = None):
+        """Hapus jawaban yang bergantung pada index tertentu (atau semuanya)"""
+        with self._lock:
+            stale = [
+                key for key in self._entries
+                if index_name is None or any(name == index_name for name, _ in key[0])
+            ]
+            for key in stale:
+                del self._entries[key]
+
+    @staticmethod
+    def _unit(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def stats(self) -> Dict:
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'exact_hits': self.exact_hits,
+            'semantic_hits': self.semantic_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_ratio': (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0
+        }
 
-    def sync_from_s3(self):
-        """Download database dari S3 jika ada"""
-        try:
-            self.s3_client.download_file(BUCKET_NAME, CHAT_DB_S3_KEY, DB_PATH)
-            print("✅ Database downloaded from S3")
-        except Exception as e:
-            print(f"ℹ️ No existing database in S3 or error: {e}")
 
-    def sync_to_s3(self):
-        """Upload database ke S3"""
-        try:
-            self.s3_client.upload_file(DB_PATH, BUCKET_NAME, CHAT_DB_S3_KEY)
-            print("✅ Database synced to S3")
-            return True
-        except Exception as e:
-            print(f"❌ Failed to sync to S3: {e}")
-            return False
+@st.cache_resource
+def init_answer_cache():
+    return AnswerCache()
 
-    def init_database(self):
-        """Inisialisasi database SQLite"""
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-
-        cursor.execute('''
-                       CREATE TABLE IF NOT EXISTS chat_sessions
-                       (
-                           id
-                           TEXT
-                           PRIMARY
-                           KEY,
-                           title
-                           TEXT
-                           NOT
-                           NULL,
-                           created_at
-                           TIMESTAMP
-                           DEFAULT
-                           CURRENT_TIMESTAMP,
-                           updated_at
-                           TIMESTAMP
-                           DEFAULT
-                           CURRENT_TIMESTAMP,
-                           user_id
-                           TEXT
-                           DEFAULT
-                           'default'
-                       )
-                       ''')
-
-        cursor.execute('''
-                       CREATE TABLE IF NOT EXISTS chat_messages
-                       (
-                           id
-                           INTEGER
-                           PRIMARY
-                           KEY
-                           AUTOINCREMENT,
-                           session_id
-                           TEXT
-                           NOT
-                           NULL,
-                           role
-                           TEXT
-                           NOT
-                           NULL,
-                           content
-                           TEXT
-                           NOT
-                           NULL,
-                           timestamp
-                           TIMESTAMP
-                           DEFAULT
-                           CURRENT_TIMESTAMP,
-                           FOREIGN
-                           KEY
-                       (
-                           session_id
-                       ) REFERENCES chat_sessions
-                       (
-                           id
-                       )
-                           )
-                       ''')
 
-        # Index untuk performa
-        cursor.execute('''
-                       CREATE INDEX IF NOT EXISTS idx_session_messages
-                           ON chat_messages(session_id, timestamp)
-                       ''')
+def table_name_for(doc_id: str) -> str:
+    # Suffix hash: "report-2023.csv" dan "report_2023.csv" tidak boleh berbagi tabel
+    slug = re.sub(r"[^a-z0-9]+", "_", doc_id.lower()).strip("_")
+    return f"t_{slug}_{hashlib.sha1(doc_id.encode()).hexdigest()[:8]}"
 
-        conn.commit()
-        conn.close()
 
-    def create_new_session(self, title: str = None, user_id: str = "default") -> str:
-        """Membuat session chat baru"""
-        session_id = str(uuid.uuid4())
-        if not title:
-            title = f"Chat {datetime.now().strftime('%d/%m %H:%M')}"
+def quote_identifier(name: str) -> str:
+    return '"' + str(name).replace('"', '""') + '"'
 
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO chat_sessions (id, title, user_id) VALUES (?, ?, ?)",
-            (session_id, title, user_id)
-        )
-        conn.commit()
-        conn.close()
 
-        # Sync ke S3 setelah perubahan
-        self.sync_to_s3()
-        return session_id
+def classify_column(name: str, series: pd.Series) -> str:
+    """numeric | date | text; kolom tanggal dikenali dari nama atau isi yang bisa di-parse"""
+    if pd.api.types.is_numeric_dtype(series):
+        return "numeric"
+    if pd.api.types.is_datetime64_any_dtype(series) or DATE_COLUMN_PATTERN.search(str(name).lower()):
+        return "date"
+    sample = series.dropna().astype(str).head(200)
+    if len(sample) and pd.to_datetime(sample, errors="coerce", format="mixed").notna().mean() >= 0.9:
+        return "date"
+    return "text"
 
-    def get_all_sessions(self, user_id: str = "default") -> List[Dict]:
-        """Mendapatkan semua chat sessions untuk user tertentu"""
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT id, title, created_at, updated_at FROM chat_sessions WHERE user_id = ? ORDER BY updated_at DESC",
-            (user_id,)
-        )
-        sessions = []
-        for row in cursor.fetchall():
-            sessions.append({
-                'id': row[0],
-                'title': row[1],
-                'created_at': row[2],
-                'updated_at': row[3]
-            })
-        conn.close()
-        return sessions
 
-    def get_session_messages(self, session_id: str) -> List[Dict]:
-        """Mendapatkan pesan dalam session"""
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT role, content, timestamp FROM chat_messages WHERE session_id = ? ORDER BY timestamp",
-            (session_id,)
-        )
-        messages = []
-        for row in cursor.fetchall():
-            messages.append({
-                'role': row[0],
-                'content': row[1],
-                'timestamp': row[2]
-            })
-        conn.close()
-        return messages
+def detect_dayfirst(series: pd.Series) -> bool:
+    """Urutan tanggal teks per kolom: "13/01/2023" = hari dulu, "01/13/2023" = bulan dulu.
 
-    def add_message(self, session_id: str, role: str, content: str):
-        """Menambah pesan ke session"""
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO chat_messages (session_id, role, content) VALUES (?, ?, ?)",
-            (session_id, role, content)
-        )
-        # Update session timestamp
-        cursor.execute(
-            "UPDATE chat_sessions SET updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-            (session_id,)
-        )
-        conn.commit()
-        conn.close()
+    Jika tidak bisa dibedakan (semua komponen <= 12) dipakai format Indonesia (hari dulu).
+    """
+    sample = series.dropna().astype(str).head(1000)
+    parts = sample.str.extract(r"^\s*(\d{1,2})[/.\-](\d{1,2})[/.\-]\d{2,4}")
+    first = pd.to_numeric(parts[0], errors="coerce")
+    second = pd.to_numeric(parts[1], errors="coerce")
+    return not ((second > 12).any() and not (first > 12).any())
 
-        # Sync ke S3 setelah setiap pesan (optional, bisa dibatasi)
-        if len(content) > 100:  # Sync hanya untuk pesan panjang
-            self.sync_to_s3()
 
-    def delete_session(self, session_id: str):
-        """Menghapus session dan semua pesannya"""
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM chat_messages WHERE session_id = ?", (session_id,))
-        cursor.execute("DELETE FROM chat_sessions WHERE id = ?", (session_id,))
-        conn.commit()
-        conn.close()
+def normalize_date_series(series: pd.Series, dayfirst: bool = True) -> pd.Series:
+    """Tanggal apa pun formatnya jadi teks ISO "YYYY-MM-DD" supaya filter substr(kolom, 1, 4) benar"""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        parsed = series
+    else:
+        parsed = pd.to_datetime(series, errors="coerce", format="mixed", dayfirst=dayfirst)
+    return parsed.dt.strftime("%Y-%m-%d").astype(object).where(parsed.notna(), None)
 
-        # Sync ke S3 setelah delete
-        self.sync_to_s3()
 
-    def update_session_title(self, session_id: str, title: str):
-        """Update judul session"""
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE chat_sessions SET title = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-            (title, session_id)
-        )
-        conn.commit()
-        conn.close()
+class TableStore:
+    """Tabel CSV/XLSX yang di-upload, disimpan per koleksi sebagai SQLite untuk query numerik lokal.
 
-        # Sync ke S3 setelah update
-        self.sync_to_s3()
+    File `<index>.tables.db` di-upload ke S3 di samping index vektor koleksinya dan
+    diunduh ulang hanya jika ETag-nya berubah.
+    """
 
-    def force_sync(self):
-        """Paksa sync database ke S3"""
-        return self.sync_to_s3()
+    def __init__(self, s3_client, bucket: str = BUCKET_NAME, local_dir: str = TABLE_STORE_DIR,
+                 check_interval: float = VECTOR_VERSION_CHECK_INTERVAL):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.local_dir = local_dir
+        self.check_interval = check_interval
+        self._versions = {}
+        self._checked_at = {}
+        self._lock = threading.Lock()
+        os.makedirs(local_dir, exist_ok=True)
 
-    def export_chat_history(self, session_id: str = None) -> Dict:
-        """Export chat history untuk backup"""
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-
-        if session_id:
-            # Export session tertentu
-            cursor.execute("SELECT * FROM chat_sessions WHERE id = ?", (session_id,))
-            sessions = cursor.fetchall()
-            cursor.execute("SELECT * FROM chat_messages WHERE session_id = ?", (session_id,))
-            messages = cursor.fetchall()
-        else:
-            # Export semua
-            cursor.execute("SELECT * FROM chat_sessions")
-            sessions = cursor.fetchall()
-            cursor.execute("SELECT * FROM chat_messages")
-            messages = cursor.fetchall()
+        # Metrics
+        self.queries = 0
+        self.query_seconds = 0.0
 
-        conn.close()
+    def _key(self, collection: str) -> str:
+        return f"{collection_index_name(collection)}.tables.db"
 
-        return {
-            'sessions': sessions,
-            'messages': messages,
-            'exported_at': datetime.now().isoformat()
-        }
+    def _local_path(self, collection: str) -> str:
+        return os.path.join(self.local_dir, self._key(collection))
 
-    def get_chat_statistics(self, user_id: str = "default") -> Dict:
-        """Statistik penggunaan chat"""
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-
-        # Total sessions
-        cursor.execute("SELECT COUNT(*) FROM chat_sessions WHERE user_id = ?", (user_id,))
-        total_sessions = cursor.fetchone()[0]
-
-        # Total messages
-        cursor.execute("""
-                       SELECT COUNT(*)
-                       FROM chat_messages cm
-                                JOIN chat_sessions cs ON cm.session_id = cs.id
-                       WHERE cs.user_id = ?
-                       """, (user_id,))
-        total_messages = cursor.fetchone()[0]
-
-        # Messages by role
-        cursor.execute("""
-                       SELECT role, COUNT(*)
-                       FROM chat_messages cm
-                                JOIN chat_sessions cs ON cm.session_id = cs.id
-                       WHERE cs.user_id = ?
-                       GROUP BY role
-                       """, (user_id,))
-        messages_by_role = dict(cursor.fetchall())
+    def _sync_down(self, collection: str, force: bool = False) -> bool:
+        """Pastikan salinan lokal sama dengan S3; False jika koleksi belum punya tabel"""
+        key = self._key(collection)
+        local_path = self._local_path(collection)
+        if not force and time.monotonic() - self._checked_at.get(key, float("-inf")) < self.check_interval:
+            return os.path.exists(local_path)
 
-        conn.close()
+        try:
+            etag = self.s3_client.head_object(Bucket=self.bucket, Key=key)["ETag"].strip('"')
+        except Exception as e:
+            if not is_missing_object_error(e):
+                raise
+            etag = None
+        if etag and (etag != self._versions.get(key) or not os.path.exists(local_path)):
+            self.s3_client.download_file(self.bucket, key, local_path + ".part")
+            os.replace(local_path + ".part", local_path)
+        self._versions[key] = etag
+        self._checked_at[key] = time.monotonic()
+        return etag is not None and os.path.exists(local_path)
+
+    def _upload(self, collection: str):
+        key = self._key(collection)
+        self.s3_client.upload_file(self._local_path(collection), self.bucket, key)
+        self._versions[key] = self.s3_client.head_object(Bucket=self.bucket, Key=key)["ETag"].strip('"')
+        self._checked_at[key] = time.monotonic()
+
+    def _connect(self, collection: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(self._local_path(collection))
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS _tables (
+                table_name TEXT PRIMARY KEY,
+                doc_id TEXT NOT NULL,
+                columns TEXT NOT NULL,
+                row_count INTEGER NOT NULL,
+                created_at TEXT NOT NULL
+            )
+        """)
+        return conn
+
+    def record_frames(self, collection: str, doc_id: str, frames: Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        """Teruskan frame apa adanya sambil menulisnya ke tabel staging; dipublish saat frame habis.
+
+        Yang ditulis ke SQLite sudah dinormalisasi: tanggal jadi teks ISO dan kolom uang
+        berformat teks ("Rp 1.234.567") jadi angka, supaya filter/agregasi SQL benar.
+        """
+        staging_dir = tempfile.mkdtemp(prefix="financial_ai_table_")
+        staging_path = os.path.join(staging_dir, "staging.db")
+        conn = sqlite3.connect(staging_path)
+        columns = None
+        row_count = 0
+        try:
+            for frame in frames:
+                if columns is None:
+                    columns = [self._classify(col, frame[col]) for col in frame.columns]
+                self._normalize(frame, columns).to_sql("data", conn, if_exists="append", index=False)
+                row_count += len(frame)
+                yield frame
+            conn.commit()
+            if columns is not None:
+                self._attach(collection, doc_id, staging_path, columns, row_count)
+        finally:
+            conn.close()
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    @staticmethod
+    def _classify(name, series: pd.Series) -> Dict:
+        if parse_money_series(series) is not None:
+            return {'name': str(name), 'kind': "numeric", 'money': True}
+        kind = classify_column(name, series)
+        if kind != "date":
+            return {'name': str(name), 'kind': kind}
+        dayfirst = detect_dayfirst(series)
+        # Kolom bernama "periode"/"tanggal" yang isinya tidak bisa di-parse tetap diperlakukan sebagai teks
+        if normalize_date_series(series.head(1000), dayfirst).notna().mean() < 0.9 * series.head(1000).notna().mean():
+            return {'name': str(name), 'kind': "text"}
+        return {'name': str(name), 'kind': "date", 'dayfirst': dayfirst}
+
+    @staticmethod
+    def _normalize(frame: pd.DataFrame, columns: List[Dict]) -> pd.DataFrame:
+        # Salinan dangkal: frame asli tetap diteruskan apa adanya ke chunking dan profiler
+        normalized = frame.copy(deep=False)
+        for column, col in zip(columns, frame.columns):
+            if column.get('money'):
+                values = parse_money_series(frame[col])
+                normalized[col] = values if values is not None else pd.to_numeric(frame[col], errors="coerce")
+            elif column['kind'] == "date":
+                normalized[col] = normalize_date_series(frame[col], column['dayfirst'])
+        return normalized
+
+    def _attach(self, collection: str, doc_id: str, staging_path: str, columns: List[Dict], row_count: int):
+        table = table_name_for(doc_id)
+        with self._lock:
+            self._sync_down(collection, force=True)
+            conn = self._connect(collection)
+            try:
+                conn.execute("ATTACH DATABASE ? AS staging", (staging_path,))
+                self._drop_document_tables(conn, doc_id)
+                conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(table)}")
+                conn.execute(f"CREATE TABLE {quote_identifier(table)} AS SELECT * FROM staging.data")
+                conn.commit()
+                conn.execute("DETACH DATABASE staging")
+
+                # Nilai kolom teks berkardinalitas rendah dipakai untuk mengenali filter di pertanyaan
+                for column in columns:
+                    if column['kind'] != "text":
+                        continue
+                    values = conn.execute(
+                        f"SELECT DISTINCT {quote_identifier(column['name'])} FROM {quote_identifier(table)} "
+                        f"WHERE {quote_identifier(column['name'])} IS NOT NULL LIMIT ?",
+                        (TABLE_FILTER_MAX_VALUES + 1,)
+                    ).fetchall()
+                    if len(values) <= TABLE_FILTER_MAX_VALUES:
+                        column['values'] = [str(value) for value, in values]
+
+                conn.execute(
+                    "INSERT OR REPLACE INTO _tables (table_name, doc_id, columns, row_count, created_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (table, doc_id, json.dumps(columns), row_count, datetime.now().isoformat())
+                )
+                conn.commit()
+            finally:
+                conn.close()
+            self._upload(collection)
+
+    @staticmethod
+    def _drop_document_tables(conn: sqlite3.Connection, doc_id: str):
+        """Hapus tabel dokumen lewat registry _tables (termasuk nama tabel format lama tanpa hash)"""
+        tables = [row[0] for row in conn.execute("SELECT table_name FROM _tables WHERE doc_id = ?", (doc_id,))]
+        for table in tables:
+            conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(table)}")
+        conn.execute("DELETE FROM _tables WHERE doc_id = ?", (doc_id,))
+
+    def drop_table(self, collection: str, doc_id: str):
+        table = table_name_for(doc_id)
+        with self._lock:
+            if not self._sync_down(collection, force=True):
+                return
+            conn = self._connect(collection)
+            try:
+                self._drop_document_tables(conn, doc_id)
+                conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(table)}")
+                conn.commit()
+            finally:
+                conn.close()
+            self._upload(collection)
+
+    def tables(self, collections: List[str]) -> List[Dict]:
+        """Metadata semua tabel di koleksi yang dipilih"""
+        result = []
+        for collection in collections:
+            with self._lock:
+                if not self._sync_down(collection):
+                    continue
+            conn = sqlite3.connect(f"file:{self._local_path(collection)}?mode=ro", uri=True)
+            try:
+                rows = conn.execute("SELECT table_name, doc_id, columns, row_count FROM _tables").fetchall()
+            finally:
+                conn.close()
+            result.extend(
+                {'collection': collection, 'table_name': table, 'doc_id': doc_id,
+                 'columns': json.loads(columns), 'row_count': row_count}
+                for table, doc_id, columns, row_count in rows
+            )
+        return result
 
+    def query(self, collection: str, sql: str, params: List) -> pd.DataFrame:
+        start = time.perf_counter()
+        conn = sqlite3.connect(f"file:{self._local_path(collection)}?mode=ro", uri=True)
+        try:
+            return pd.read_sql_query(sql, conn, params=params)
+        finally:
+            conn.close()
+            with self._lock:
+                self.queries += 1
+                self.query_seconds += time.perf_counter() - start
+
+    def stats(self) -> Dict:
         return {
-            'total_sessions': total_sessions,
-            'total_messages': total_messages,
-            'messages_by_role': messages_by_role,
-            'user_id': user_id
+            'queries': self.queries,
+            'avg_query_ms': self.query_seconds / self.queries * 1000 if self.queries else None
         }
 
 
-# Initialize AWS clients
 @st.cache_resource
-def init_aws_clients():
-    return {
-        's3': boto3.client("s3"),
-        'bedrock': boto3.client(service_name="bedrock-runtime", region_name=AWS_REGION)
+def init_table_store():
+    return TableStore(init_aws_clients()['s3'])
+
+
+class NumericQueryPlanner:
+    """Terjemahkan pertanyaan numerik sederhana ("total biaya per region Q3 2023") ke SQL agregasi.
+
+    Berbasis aturan: butuh kata agregasi + kolom numerik yang disebut di pertanyaan;
+    selain itu pertanyaan dikembalikan ke jalur RAG biasa. Rencana hanya dipakai jika
+    semua batasan di pertanyaan (tahun, kuartal, nama entitas) terikat ke kolom tabel:
+    batasan yang tidak bisa diterapkan berarti jawaban angka yang salah, bukan sekadar kurang tepat.
+    """
+
+    AGGREGATIONS = [
+        ('AVG', 'Rata-rata', ['rata-rata', 'rata rata', 'average', 'mean', 'avg']),
+        ('MAX', 'Tertinggi', ['tertinggi', 'terbesar', 'maksimum', 'highest', 'largest', 'max']),
+        ('MIN', 'Terendah', ['terendah', 'terkecil', 'minimum', 'lowest', 'smallest', 'min']),
+        ('COUNT', 'Jumlah data', ['berapa banyak', 'jumlah transaksi', 'how many', 'banyaknya', 'count']),
+        ('SUM', 'Total', ['total', 'jumlah', 'sum', 'berapa', 'how much']),
+    ]
+    SYNONYMS = [
+        {'biaya', 'beban', 'pengeluaran', 'expense', 'expenses', 'cost', 'costs', 'spend', 'spending'},
+        {'pendapatan', 'penjualan', 'omzet', 'revenue', 'revenues', 'income', 'sales'},
+        {'laba', 'keuntungan', 'profit', 'profits', 'earnings'},
+        {'jumlah', 'nilai', 'nominal', 'amount', 'value'},
+        {'wilayah', 'daerah', 'region', 'area'},
+        {'cabang', 'branch'},
+        {'akun', 'account'},
+        {'kategori', 'category'},
+    ]
+    PERIODS = {
+        'bulan': 'month', 'month': 'month', 'monthly': 'month', 'bulanan': 'month',
+        'kuartal': 'quarter', 'quarter': 'quarter', 'triwulan': 'quarter', 'quarterly': 'quarter',
+        'tahun': 'year', 'year': 'year', 'yearly': 'year', 'tahunan': 'year',
+    }
+    GROUP_WORDS = {'per', 'by', 'berdasarkan', 'tiap', 'setiap', 'each', 'menurut'}
+    # Kata yang tidak membatasi hasil; kata lain yang tidak terikat ke kolom/nilai dianggap entitas
+    STOPWORDS = {
+        'apa', 'apakah', 'berapakah', 'yang', 'di', 'dari', 'untuk', 'pada', 'ke', 'dan', 'dengan', 'dalam',
+        'adalah', 'itu', 'ini', 'semua', 'seluruh', 'keseluruhan', 'kita', 'saya', 'kami', 'tolong', 'mohon',
+        'hitung', 'hitungkan', 'tampilkan', 'tunjukkan', 'berikan', 'sebutkan', 'ada', 'data', 'tabel', 'secara',
+        'sebesar', 'rupiah', 'rp', 'idr', 'usd', 'nilai', 'what', 'is', 'are', 'was', 'were', 'the', 'a', 'an',
+        'of', 'for', 'in', 'on', 'at', 'and', 'with', 'all', 'overall', 'show', 'me', 'give', 'please',
+        'calculate', 'compute', 'tell', 'our', 'my', 'we', 'i', 'do', 'does', 'did', 'value', 'table',
     }
 
+    def _terms(self, column: str) -> set:
+        name = re.sub(r"[_\-]+", " ", column.lower()).strip()
+        terms = {name}
+        for token in name.split():
+            terms.add(token)
+            for group in self.SYNONYMS:
+                if token in group:
+                    terms |= group
+        return terms
+
+    @staticmethod
+    def _words(terms: Iterable[str]) -> set:
+        return {word for term in terms for word in re.findall(r"\w+", term)}
+
+    @staticmethod
+    def _mentions(text: str, term: str) -> bool:
+        return re.search(rf"(?<!\w){re.escape(term)}(?!\w)", text) is not None
+
+    def _aggregation(self, text: str):
+        for func, label, keywords in self.AGGREGATIONS:
+            if any(self._mentions(text, keyword) for keyword in keywords):
+                return func, label
+        return None
+
+    @staticmethod
+    def _period_expr(column: str, period: str) -> str:
+        col = quote_identifier(column)
+        if period == "year":
+            return f"substr({col}, 1, 4)"
+        if period == "month":
+            return f"substr({col}, 1, 7)"
+        return f"substr({col}, 1, 4) || '-Q' || ((CAST(substr({col}, 6, 2) AS INTEGER) + 2) / 3)"
+
+    def plan(self, question: str, table: Dict):
+        """(skor, rencana) untuk satu tabel, atau None jika pertanyaan tidak cocok"""
+        text = question.lower()
+        aggregation = self._aggregation(text)
+        if not aggregation:
+            return None
+
+        columns = table['columns']
+        numeric = [c['name'] for c in columns if c['kind'] == 'numeric']
+        dates = [c['name'] for c in columns if c['kind'] == 'date']
+
+        measures = [name for name in numeric if any(self._mentions(text, term) for term in self._terms(name))]
+        func, label = aggregation
+        if not measures and func != 'COUNT':
+            return None
+        # Nama kolom terpanjang yang cocok paling spesifik ("biaya operasional" > "biaya")
+        measure = max(measures, key=len) if measures else None
+        score = 2 if measure else 1
+
+        group_expr = group_label = None
+        bound = {word for _, _, keywords in self.AGGREGATIONS for keyword in keywords for word in re.findall(r"\w+", keyword)}
+        bound |= self.GROUP_WORDS | set(self.PERIODS) | self.STOPWORDS
+        if measure:
+            bound |= self._words(self._terms(measure))
+        group_match = re.search(r"\b(?:per|by|berdasarkan|tiap|setiap|each|menurut)\s+([\w\s\-]+)", text)
+        if group_match:
+            target = group_match.group(1)
+            period = next((self.PERIODS[word] for word in target.split()[:1] if word in self.PERIODS), None)
+            if period and dates:
+                group_expr, group_label = self._period_expr(dates[0], period), period
+            else:
+                for column in columns:
+                    if column['kind'] != 'numeric' and any(self._mentions(target, term) for term in self._terms(column['name'])):
+                        group_expr, group_label = quote_identifier(column['name']), column['name']
+                        break
+            if group_expr is None:
+                return None
+            if period and dates:
+                bound |= self._words(self._terms(dates[0]))
+            else:
+                bound |= self._words(self._terms(group_label))
+            score += 1
+
+        where, params, filters = [], [], []
+        years = set(re.findall(r"\b((?:19|20)\d{2})\b", text))
+        quarter = re.search(r"\b(?:q|kuartal|quarter|triwulan)\s*-?\s*([1-4])\b", text)
+        if years or quarter:
+            # Tahun/kuartal tanpa kolom tanggal, atau rentang beberapa tahun, tidak bisa difilter dengan benar
+            if not dates or len(years) > 1:
+                return None
+            date_col = quote_identifier(dates[0])
+            bound |= self._words(self._terms(dates[0]))
+            if years:
+                year = years.pop()
+                where.append(f"substr({date_col}, 1, 4) = ?")
+                params.append(year)
+                filters.append(year)
+                bound.add(year)
+            if quarter:
+                where.append(f"(CAST(substr({date_col}, 6, 2) AS INTEGER) + 2) / 3 = ?")
+                params.append(int(quarter.group(1)))
+                filters.append(f"Q{quarter.group(1)}")
+                bound |= set(re.findall(r"\w+", quarter.group(0)))
+        for column in columns:
+            if column['kind'] != 'text' or column['name'] == group_label:
+                continue
+            for value in column.get('values', []):
+                if len(value) >= 3 and self._mentions(text, value.lower()):
+                    where.append(f"{quote_identifier(column['name'])} = ?")
+                    params.append(value)
+                    filters.append(f"{column['name']} = {value}")
+                    bound |= self._words({value.lower()}) | self._words(self._terms(column['name']))
+                    break
+        # Sisa kata = entitas/batasan yang tidak terikat (mis. nama customer di kolom berkardinalitas
+        # tinggi, nama bulan, kolom lain): serahkan ke RAG daripada menjawab angka tanpa filter itu
+        if set(re.findall(r"\w+", text)) - bound:
+            return None
+        score += len(filters)
+
+        value_expr = f"{func}({quote_identifier(measure)})" if measure else "COUNT(*)"
+        value_label = f"{label} {measure}" if measure else label
+        sql = f"SELECT {value_expr} AS {quote_identifier(value_label)} FROM {quote_identifier(table['table_name'])}"
+        if group_expr:
+            sql = (f"SELECT {group_expr} AS {quote_identifier(group_label)}, {value_expr} AS {quote_identifier(value_label)} "
+                   f"FROM {quote_identifier(table['table_name'])}")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if group_expr:
+            order = "1" if group_label in self.PERIODS.values() else "2 DESC"
+            sql += f" GROUP BY 1 ORDER BY {order} LIMIT {NUMERIC_QUERY_MAX_GROUPS}"
+
+        return score, {
+            'collection': table['collection'],
+            'doc_id': table['doc_id'],
+            'sql': sql,
+            'params': params,
+            'filters': filters,
+            'value_label': value_label
+        }
 
-@st.cache_resource
-def init_embeddings():
-    clients = init_aws_clients()
-    return BedrockEmbeddings(
-        model_id="amazon.titan-embed-text-v1",
-        client=clients['bedrock']
-    )
+    def best_plan(self, question: str, tables: List[Dict]):
+        plans = [plan for plan in (self.plan(question, table) for table in tables) if plan]
+        return max(plans, key=lambda item: item[0])[1] if plans else None
 
 
-@st.cache_resource
-def init_llm():
-    clients = init_aws_clients()
-    return Bedrock(
-        model_id="anthropic.claude-v2:1",
-        client=clients['bedrock'],
-        model_kwargs={'max_tokens_to_sample': 1024}
-    )
+def format_number(value) -> str:
+    if value is None or pd.isna(value):
+        return "-"
+    if float(value).is_integer():
+        return f"{int(value):,}"
+    return f"{value:,.2f}"
+
+
+def format_numeric_result(plan: Dict, result: pd.DataFrame) -> str:
+    """Hasil query sebagai teks ringkas (jawaban langsung atau konteks untuk LLM)"""
+    scope = f" ({', '.join(plan['filters'])})" if plan['filters'] else ""
+    if result.shape[1] == 1:
+        body = f"**{plan['value_label']}{scope}: {format_number(result.iloc[0, 0])}**"
+    else:
+        formatted = pd.DataFrame({
+            result.columns[0]: result.iloc[:, 0],
+            result.columns[1]: result.iloc[:, 1].map(format_number)
+        })
+        body = f"**{plan['value_label']}{scope}:**\n\n{formatted.to_markdown(index=False)}"
+    return f"{body}\n\n_Dihitung langsung dari tabel `{plan['doc_id']}`._"
 
 
 class FinancialAI:
@@ -333,7 +4181,10 @@ class FinancialAI:
         self.clients = init_aws_clients()
         self.embeddings = init_embeddings()
         self.llm = init_llm()
-        self.vectorstore = None
+        # Session hanya menyimpan nama koleksi; index-nya tinggal di VectorStoreCache (LRU)
+        self.collections = []
+        self.vectorstore_versions = {}
+        self.last_timings = {}
 
     def get_unique_id(self):
         return str(uuid.uuid4())
@@ -360,26 +4211,14 @@ class FinancialAI:
 
         if file_type == "pdf":
             try:
-                loader = PyPDFLoader(file_path)
-                documents = loader.load_and_split()
+                documents = list(iter_pdf_documents(file_path))
             except Exception as e:
                 st.error(f"❌ Gagal membaca PDF: {e}")
                 return []
 
         elif file_type in ["csv", "xlsx"]:
             try:
-                if file_type == "csv":
-                    df = pd.read_csv(file_path)
-                else:
-                    df = pd.read_excel(file_path)
-
-                financial_summary = self.create_financial_summary(df)
-                full_text = df.to_string(index=False)
-                documents.append(Document(
-                    page_content=f"RINGKASAN KEUANGAN:\n{financial_summary}\n\nDATA LENGKAP:\n{full_text}",
-                    metadata={"source": file_path, "type": "financial_data"}
-                ))
-
+                documents = list(iter_tabular_documents(file_path, file_type))
             except Exception as e:
                 st.error(f"❌ Gagal membaca file {file_type}: {e}")
                 return []
@@ -388,145 +4227,454 @@ class FinancialAI:
 
     def create_financial_summary(self, df: pd.DataFrame) -> str:
         """Membuat ringkasan otomatis dari data keuangan"""
-        summary = []
-        financial_columns = []
-
-        for col in df.columns:
-            col_lower = col.lower()
-            if any(keyword in col_lower for keyword in
-                   ['revenue', 'income', 'profit', 'expense', 'cost', 'sales', 'pendapatan', 'laba', 'biaya',
-                    'penjualan']):
-                financial_columns.append(col)
+        profiler = FinancialProfiler()
+        profiler.update(df)
+        return format_financial_summary(profiler.result())
+
+    def stream_financial_document(self, file_path: str, file_type: str, page_callback=None,
+                                  stats: Dict = None, doc_id: str = None,
+                                  collection: str = DEFAULT_COLLECTION) -> Iterator[Document]:
+        """Pipeline streaming: chunk di-yield begitu halamannya selesai diekstrak dan di-split
+
+        Untuk CSV/XLSX dengan doc_id, baris yang sama juga disimpan ke TableStore
+        supaya pertanyaan numerik bisa dihitung langsung.
+        """
+        stats = stats if stats is not None else {}
+        stats.update(pages=0, chunks=0)
+        chunks = self._iter_document_chunks(file_path, file_type, page_callback, stats, doc_id, collection)
+        if not DEDUP_ENABLED:
+            yield from chunks
+            return
 
-        summary.append(f"Total baris data: {len(df)}")
-        summary.append(f"Kolom yang terdeteksi: {', '.join(df.columns)}")
+        # Boilerplate yang berulang tiap halaman tidak perlu di-embed dan disimpan berkali-kali
+        dedup = NearDuplicateFilter()
+        try:
+            yield from dedup.filter(chunks)
+        finally:
+            stats.update(dedup.stats)
+
+    def _iter_document_chunks(self, file_path: str, file_type: str, page_callback, stats: Dict,
+                              doc_id: str, collection: str) -> Iterator[Document]:
+        if file_type in ["csv", "xlsx"]:
+            frames = iter_tabular_frames(file_path, file_type)
+            if doc_id:
+                frames = init_table_store().record_frames(collection, doc_id, frames)
+            # Dokumen tabular sudah dibatasi TABULAR_MAX_CHARS dan membawa header sendiri; splitter
+            # hanya memecah baris tunggal yang terlalu panjang dan menerapkan filter panjang yang sama
+            for document in iter_tabular_documents(file_path, file_type, frames=frames):
+                stats['pages'] += 1
+                for chunk in iter_split_documents([document], workers=1):
+                    stats['chunks'] += 1
+                    yield chunk
+            return
 
-        if financial_columns:
-            summary.append(f"Kolom keuangan utama: {', '.join(financial_columns)}")
-            for col in financial_columns:
-                if pd.api.types.is_numeric_dtype(df[col]):
-                    total = df[col].sum()
-                    avg = df[col].mean()
-                    summary.append(f"{col}: Total = {total:,.2f}, Rata-rata = {avg:,.2f}")
+        def pages():
+            for document in iter_pdf_documents(file_path, page_callback):
+                stats['pages'] += 1
+                yield document
 
-        return "\n".join(summary)
+        # Semua halaman lewat satu iter_split_documents: dengan SPLIT_WORKERS > 1 setiap task worker
+        # berisi SPLIT_DOCUMENTS_PER_TASK halaman, bukan satu halaman per panggilan
+        for chunk in iter_split_documents(pages()):
+            stats['chunks'] += 1
+            yield chunk
 
     def split_documents(self, documents: List[Document]) -> List[Document]:
         """Memecah dokumen menjadi chunk yang optimal"""
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1500,
-            chunk_overlap=300,
-            separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""]
-        )
-
-        split_docs = text_splitter.split_documents(documents)
-        filtered_docs = []
-        for doc in split_docs:
-            content_length = len(doc.page_content)
-            if 50 <= content_length <= 4000:
-                filtered_docs.append(doc)
-
-        return filtered_docs
-
-    def create_vector_store(self, documents: List[Document]) -> bool:
-        """Membuat dan menyimpan vector store"""
+        return list(iter_split_documents(documents))
+
+    def list_collections(self) -> List[str]:
+        """Koleksi yang punya index di S3"""
+        collections = set()
+        paginator = self.clients['s3'].get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=VECTOR_INDEX_NAME):
+            for obj in page.get('Contents', []):
+                key = obj['Key']
+                # Manifest versi (format baru) atau file .faiss di root (format lama)
+                suffix = next((s for s in (".version.json", ".faiss") if key.endswith(s)), None)
+                if suffix is None or key.endswith(".flat.faiss"):
+                    continue
+                name = key[:-len(suffix)]
+                if name == VECTOR_INDEX_NAME:
+                    collections.add(DEFAULT_COLLECTION)
+                elif name.startswith(f"{VECTOR_INDEX_NAME}__"):
+                    collections.add(name[len(f"{VECTOR_INDEX_NAME}__"):])
+        return sorted(collections)
+
+    def load_document_registry(self, index_name: str = VECTOR_INDEX_NAME, manifest: Dict = None) -> Dict:
+        """Daftar dokumen di index: doc_id -> chunk ids dan info upload (dari versi manifest yang sama)"""
+        if manifest is None:
+            manifest, _ = read_index_manifest(self.clients['s3'], index_name)
+        key = index_manifest_files(manifest, index_name).get(registry_file(index_name))
+        if key is None:
+            return {}
         try:
-            vectorstore = FAISS.from_documents(documents, self.embeddings)
-            temp_path = "/tmp/"
-            index_name = "financial_ai_index"
-            vectorstore.save_local(folder_path=temp_path, index_name=index_name)
-
-            faiss_file = f"{temp_path}{index_name}.faiss"
-            pkl_file = f"{temp_path}{index_name}.pkl"
+            body = self.clients['s3'].get_object(Bucket=BUCKET_NAME, Key=key)["Body"]
+            return json.loads(body.read())
+        except Exception as e:
+            if is_missing_object_error(e):
+                return {}
+            raise
+
+    def _load_writable_vector_store(self, index_name: str, work_dir: str):
+        """Salinan index terbaru yang bisa diubah: (vector store flat atau None jika index belum ada, base).
+
+        base berisi manifest + ETag-nya (untuk compare-and-swap saat publish), folder file versi ini
+        (index ANN dan BM25 untuk update inkremental), dan index ANN-nya. Salinan lokal hasil publish
+        terakhir di pod ini (INDEX_WORK_DIR) dipakai tanpa download selama manifest belum berubah.
+        """
+        manifest, etag = read_index_manifest(self.clients['s3'], index_name)
+        files = index_manifest_files(manifest, index_name)
+        version = manifest.get('version') if manifest and 'files' in manifest else None
+        cache_dir = os.path.join(INDEX_WORK_DIR, index_name)
+        base = {'version': etag, 'manifest': manifest, 'dir': work_dir, 'search_index': None}
+        if version and read_text_file(os.path.join(cache_dir, "VERSION")) == version:
+            base['dir'] = cache_dir
+        else:
+            for file_name in vector_store_files(index_name):
+                if file_name not in files:
+                    return None, base
+                try:
+                    self.clients['s3'].download_file(BUCKET_NAME, files[file_name], os.path.join(work_dir, file_name))
+                except Exception as e:
+                    if is_missing_object_error(e):
+                        return None, base
+                    raise
+            keyword_file = keyword_index_file(index_name)
+            if keyword_file in files:
+                try:
+                    self.clients['s3'].download_file(BUCKET_NAME, files[keyword_file],
+                                                     os.path.join(work_dir, keyword_file))
+                except Exception as e:
+                    if not is_missing_object_error(e):
+                        raise
+
+        vectorstore = load_vector_store_files(base['dir'], index_name, self.embeddings, writable=True)
+        if not is_flat_index(vectorstore.index):
+            # Index ANN tidak bisa di-merge/delete (dan PQ lossy): pakai salinan flat-nya,
+            # index ANN diperbarui dari flat saat publish
+            base['search_index'] = vectorstore.index
+            flat_path = os.path.join(base['dir'], flat_index_file(index_name))
+            if not os.path.exists(flat_path):
+                self.clients['s3'].download_file(BUCKET_NAME, files[flat_index_file(index_name)], flat_path)
+            vectorstore.index = faiss.read_index(flat_path)
+        return vectorstore, base
+
+    def _put_index_manifest(self, index_name: str, base: Dict, version: str, files: Dict[str, str]):
+        """Langkah terakhir publish: compare-and-swap manifest ke versi baru.
+
+        IndexVersionConflict jika index sudah dipublish proses lain sejak dibaca. File versi
+        sebelumnya dicatat di 'previous' dan baru dihapus publish berikutnya, sehingga pembaca
+        yang sedang men-download versi itu tidak kehilangan file-nya.
+        """
+        manifest = {
+            'version': version,
+            'files': files,
+            'previous': sorted(set(index_manifest_files(base['manifest'], index_name).values())),
+            'pod': POD_ID,
+            'published_at': time.time()
+        }
+        condition = {'IfMatch': base['version']} if base['version'] else {'IfNoneMatch': "*"}
+        try:
+            self.clients['s3'].put_object(Bucket=BUCKET_NAME, Key=index_version_key(index_name),
+                                          Body=json.dumps(manifest).encode(), **condition)
+        except Exception as e:
+            if is_precondition_error(e):
+                raise IndexVersionConflict(index_name) from e
+            raise
 
-            success = (
-                    self.upload_to_s3(faiss_file, "financial_ai_index.faiss") and
-                    self.upload_to_s3(pkl_file, "financial_ai_index.pkl")
+    def _delete_index_objects(self, keys: List[str]):
+        """Hapus file versi index yang tidak dipakai lagi (best effort)"""
+        for start in range(0, len(keys), 1000):
+            try:
+                self.clients['s3'].delete_objects(
+                    Bucket=BUCKET_NAME, Delete={'Objects': [{'Key': key} for key in keys[start:start + 1000]]}
+                )
+            except Exception as e:
+                print(f"❌ Gagal menghapus file index lama di S3: {e}")
+
+    @metrics.traced("vector_store.publish")
+    def _publish_vector_store(self, vectorstore: FAISS, registry: Dict, index_name: str,
+                              base: Dict, unchanged: int = 0) -> bool:
+        """Upload index + registry dokumen ke S3 lalu invalidasi cache proses
+
+        Semua file di-upload ke prefix versi baru (INDEX_VERSIONS_S3_PREFIX), lalu manifest diganti
+        sebagai langkah terakhir: upload yang gagal meninggalkan manifest lama tetap aktif dan utuh.
+        base: hasil _load_writable_vector_store (manifest yang dibaca + file versi sebelumnya).
+        File yang dipublish disimpan sebagai salinan lokal untuk read-modify-write berikutnya.
+        """
+        version = uuid.uuid4().hex
+        prefix = f"{INDEX_VERSIONS_S3_PREFIX}{index_name}/{version}/"
+        temp_path = tempfile.mkdtemp(prefix="financial_ai_index_")
+        uploaded = []
+        published = False
+        try:
+            file_paths = save_vector_store(
+                vectorstore, temp_path, index_name, previous_index=base['search_index'], unchanged=unchanged,
+                previous_keyword_index=os.path.join(base['dir'], keyword_index_file(index_name)) if base['dir'] else None
             )
+            registry_path = os.path.join(temp_path, registry_file(index_name))
+            with open(registry_path, "w") as f:
+                json.dump(registry, f)
+
+            files = {os.path.basename(path): prefix + os.path.basename(path) for path in [*file_paths, registry_path]}
+            for path in [*file_paths, registry_path]:
+                if not self.upload_to_s3(path, files[os.path.basename(path)]):
+                    break
+                uploaded.append(files[os.path.basename(path)])
+            else:
+                self._put_index_manifest(index_name, base, version, files)
+                published = True
+                cache_dir = os.path.join(INDEX_WORK_DIR, index_name)
+                shutil.rmtree(cache_dir, ignore_errors=True)
+                os.makedirs(INDEX_WORK_DIR, exist_ok=True)
+                shutil.move(temp_path, cache_dir)
+                # VERSION ditulis terakhir: salinan yang belum lengkap tidak pernah dianggap valid
+                with open(os.path.join(cache_dir, "VERSION"), "w") as f:
+                    f.write(version)
+        finally:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            if not published:
+                # Versi yang gagal dipublish tidak pernah terlihat pembaca: buang file-nya
+                self._delete_index_objects(uploaded)
+
+        if published:
+            # Versi dua publish sebelumnya: tidak lagi direferensikan manifest mana pun
+            self._delete_index_objects((base['manifest'] or {}).get('previous', []))
+            init_vector_store_cache().invalidate(index_name)
+            init_answer_cache().invalidate(index_name)
+        return published
+
+    def _update_index(self, index_name: str, apply, load: bool = True) -> bool:
+        """Read-modify-write satu index di bawah lock lintas pod.
+
+        apply(vectorstore, registry) -> (vectorstore, registry, unchanged), atau None jika tidak ada
+        yang diubah; vectorstore None jika index belum ada (atau load=False). Jika index ternyata
+        sudah dipublish proses lain sejak dibaca (mis. lease lock sempat habis), diulang dari awal.
+        """
+        with index_write_lock(index_name) as lock:
+            for attempt in range(INDEX_PUBLISH_ATTEMPTS):
+                with tempfile.TemporaryDirectory(prefix="financial_ai_index_") as work_dir:
+                    if load:
+                        vectorstore, base = self._load_writable_vector_store(index_name, work_dir)
+                        registry = self.load_document_registry(index_name, base['manifest']) if vectorstore else {}
+                    else:
+                        registry, vectorstore = {}, None
+                        manifest, etag = read_index_manifest(self.clients['s3'], index_name)
+                        base = {'version': etag, 'manifest': manifest, 'dir': None, 'search_index': None}
+                    result = apply(vectorstore, registry)
+                    if result is None:
+                        return False
+                    vectorstore, registry, unchanged = result
+                    lock.check()
+                    try:
+                        return self._publish_vector_store(vectorstore, registry, index_name, base, unchanged)
+                    except IndexVersionConflict:
+                        if attempt == INDEX_PUBLISH_ATTEMPTS - 1:
+                            raise
+        return False
+
+    @staticmethod
+    def _delete_chunks(vectorstore: FAISS, chunk_ids: List[str]) -> int:
+        """Hapus chunk dari vector store; mengembalikan jumlah vektor awal yang posisinya tidak bergeser"""
+        stale = set(chunk_ids)
+        positions = [pos for pos, chunk_id in vectorstore.index_to_docstore_id.items() if chunk_id in stale]
+        if positions:
+            vectorstore.delete([vectorstore.index_to_docstore_id[pos] for pos in positions])
+        return min(positions, default=vectorstore.index.ntotal)
+
+    @metrics.traced("ingest.create_vector_store")
+    def create_vector_store(self, documents: Iterable[Document], progress_callback=None, doc_id: str = None,
+                            collection: str = DEFAULT_COLLECTION) -> bool:
+        """Menambahkan dokumen ke shard koleksi (atau membangun ulang jika INGESTION_MODE=replace)
+
+        documents boleh berupa generator (lihat stream_financial_document): chunk di-embed per
+        batch sambil halaman berikutnya masih diekstrak. Upload ulang dengan doc_id yang sama
+        mengganti chunk versi sebelumnya.
+        """
+        try:
+            index_name = collection_index_name(collection)
+            doc_id = doc_id or self.get_unique_id()
+            total = len(documents) if isinstance(documents, list) else None
+
+            # Embedding (bagian paling mahal) dilakukan sebelum mengambil lock index,
+            # ke index sementara khusus dokumen ini
+            new_store = None
+            chunk_ids = []
+            for batch in iter_batches(documents, INGEST_EMBED_BATCH_SIZE):
+                texts = [doc.page_content for doc in batch]
+                metadatas = [{**doc.metadata, 'doc_id': doc_id} for doc in batch]
+                ids = [f"{doc_id}:{self.get_unique_id()}" for _ in batch]
+                done = len(chunk_ids)
+                vectors = self.embeddings.embed_documents(
+                    texts,
+                    progress_callback=(lambda batch_done, _: progress_callback(done + batch_done, total))
+                    if progress_callback else None
+                )
+                if new_store is None:
+                    new_store = FAISS.from_embeddings(
+                        list(zip(texts, vectors)), self.embeddings, metadatas=metadatas, ids=ids
+                    )
+                else:
+                    new_store.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas, ids=ids)
+                chunk_ids.extend(ids)
 
-            for file_path in [faiss_file, pkl_file]:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
+            if new_store is None:
+                st.error("❌ Dokumen tidak berisi teks yang bisa diindeks")
+                return False
 
-            return success
+            def add(vectorstore: FAISS, registry: Dict):
+                entry = {'chunk_ids': chunk_ids, 'chunks': len(chunk_ids), 'added_at': datetime.now().isoformat()}
+                if vectorstore is None:
+                    return new_store, {doc_id: entry}, 0
+                unchanged = vectorstore.index.ntotal
+                if doc_id in registry:
+                    unchanged = self._delete_chunks(vectorstore, registry[doc_id]['chunk_ids'])
+                # merge_from faiss mengosongkan index sumber; new_store harus tetap utuh jika publish diulang
+                source = copy.copy(new_store)
+                source.index = faiss.clone_index(new_store.index)
+                vectorstore.merge_from(source)
+                registry[doc_id] = entry
+                return vectorstore, registry, unchanged
+
+            return self._update_index(index_name, add, load=INGESTION_MODE == "append")
 
         except Exception as e:
             st.error(f"❌ Gagal membuat vector store: {e}")
             return False
 
-    def load_vector_store(self) -> bool:
-        """Memuat vector store dari S3"""
+    @metrics.traced("ingest.delete_document")
+    def delete_document(self, doc_id: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        """Menghapus semua chunk satu dokumen dari shard koleksi"""
         try:
-            temp_path = "/tmp/"
-            index_name = "financial_ai_index"
-            faiss_file = f"{temp_path}{index_name}.faiss"
-            pkl_file = f"{temp_path}{index_name}.pkl"
+            def remove(vectorstore: FAISS, registry: Dict):
+                if vectorstore is None or doc_id not in registry:
+                    return None
+                unchanged = self._delete_chunks(vectorstore, registry.pop(doc_id)['chunk_ids'])
+                init_table_store().drop_table(collection, doc_id)
+                return vectorstore, registry, unchanged
 
-            if not (self.download_from_s3("financial_ai_index.faiss", faiss_file) and
-                    self.download_from_s3("financial_ai_index.pkl", pkl_file)):
-                return False
+            return self._update_index(collection_index_name(collection), remove)
 
-            self.vectorstore = FAISS.load_local(
-                folder_path=temp_path,
-                index_name=index_name,
-                embeddings=self.embeddings,
-                allow_dangerous_deserialization=True
-            )
+        except Exception as e:
+            st.error(f"❌ Gagal menghapus dokumen: {e}")
+            return False
 
+    @metrics.traced("vector_store.select")
+    def load_vector_store(self, collections: List[str] = None) -> bool:
+        """Memilih koleksi yang di-query; index dimuat dari cache proses (download hanya jika versinya berubah)"""
+        try:
+            collections = [normalize_collection_name(c) for c in (collections or [DEFAULT_COLLECTION])]
+            cache = init_vector_store_cache()
+            self.vectorstore_versions = {
+                collection: cache.get(collection_index_name(collection))['version'] for collection in collections
+            }
+            self.collections = collections
             return True
 
         except Exception as e:
             st.error(f"❌ Gagal memuat vector store: {e}")
             return False
 
+    @metrics.traced("qa.answer")
     def get_financial_response(self, question: str) -> str:
         """Mendapatkan respons untuk pertanyaan keuangan"""
-        if not self.vectorstore:
+        if not self.collections:
             return "❌ Vector store belum dimuat. Silakan upload dokumen terlebih dahulu."
 
         if not question.strip():
             return "Silakan masukkan pertanyaan yang valid."
 
-        prompt_template = """
-        Human: Anda adalah asisten AI yang ahli dalam analisis keuangan. Gunakan konteks yang diberikan untuk menjawab pertanyaan tentang laporan keuangan dengan akurat dan profesional.
-
-        Jika pertanyaan meminta:
-        - Angka/nilai: Berikan nilai yang tepat dengan format yang jelas
-        - Analisis: Berikan interpretasi yang mendalam
-        - Perbandingan: Tunjukkan perbedaan dan tren
-        - Rekomendasi: Berikan saran berdasarkan data
-
-        Jika tidak tahu jawabannya, katakan dengan jujur bahwa informasi tidak tersedia dalam dokumen.
+        try:
+            numeric = self.answer_numeric_question(question)
+            if numeric is not None:
+                if NUMERIC_ANSWER_MODE == "llm":
+                    return self.llm.invoke(numeric['prompt'])
+                return numeric['answer']
+
+            version_key = self._index_version_key()
+            cached = init_answer_cache().get(version_key, question, self.embeddings.embed_query)
+            if cached is not None:
+                return cached
+
+            result = init_qa_chain_factory().run(self.collections, question)
+            self.last_timings = result['timings']
+            self._cache_answer(version_key, question, result["result"])
+            return result["result"]
+        except Exception as e:
+            return f"❌ Error saat memproses pertanyaan: {e}"
 
-        <context>
-        {context}
-        </context>
+    @metrics.traced("qa.stream")
+    def stream_financial_response(self, question: str):
+        """Generator jawaban per potongan teks (untuk st.write_stream)"""
+        if not self.collections:
+            yield "❌ Vector store belum dimuat. Silakan upload dokumen terlebih dahulu."
+            return
 
-        Pertanyaan: {question}
+        if not question.strip():
+            yield "Silakan masukkan pertanyaan yang valid."
+            return
 
-        Assistant:"""
+        timing = StageTimingHandler()
+        try:
+            numeric = self.answer_numeric_question(question)
+            if numeric is not None:
+                if NUMERIC_ANSWER_MODE == "llm":
+                    yield from stream_bedrock_completion(self.clients['bedrock'], numeric['prompt'])
+                else:
+                    yield numeric['answer']
+                return
+
+            version_key = self._index_version_key()
+            cached = init_answer_cache().get(version_key, question, self.embeddings.embed_query)
+            if cached is not None:
+                yield cached
+                return
+
+            chunks = []
+            for text in init_qa_chain_factory().stream(self.collections, question, timing=timing):
+                chunks.append(text)
+                yield text
+            self._cache_answer(version_key, question, "".join(chunks))
+        except Exception as e:
+            yield f"❌ Error saat memproses pertanyaan: {e}"
+        finally:
+            self.last_timings = timing.timings()
 
-        PROMPT = PromptTemplate(
-            template=prompt_template,
-            input_variables=["context", "question"]
-        )
+    def answer_numeric_question(self, question: str):
+        """Jawab pertanyaan agregasi dari tabel terstruktur; None jika bukan pertanyaan numerik"""
+        table_store = init_table_store()
+        try:
+            plan = NumericQueryPlanner().best_plan(question, table_store.tables(self.collections))
+            if plan is None:
+                return None
+            result = table_store.query(plan['collection'], plan['sql'], plan['params'])
+        except Exception:
+            # Tabel tidak terbaca / SQL gagal: kembali ke jalur RAG biasa
+            return None
+
+        answer = format_numeric_result(plan, result)
+        return {
+            'answer': answer,
+            'sql': plan['sql'],
+            'result': result,
+            # Hanya hasil agregasi kecil yang dikirim ke LLM, bukan potongan tabel mentah
+            'prompt': FINANCIAL_PROMPT.format(context=answer, question=question)
+        }
 
-        qa = RetrievalQA.from_chain_type(
-            llm=self.llm,
-            chain_type="stuff",
-            retriever=self.vectorstore.as_retriever(
-                search_type="similarity",
-                search_kwargs={"k": 7}
-            ),
-            return_source_documents=True,
-            chain_type_kwargs={"prompt": PROMPT}
-        )
+    def _index_version_key(self) -> tuple:
+        """Versi shard yang sedang aktif; jawaban cache otomatis basi saat index berubah"""
+        cache = init_vector_store_cache()
+        return tuple(sorted(
+            (collection_index_name(collection), cache.get(collection_index_name(collection))['version'])
+            for collection in self.collections
+        ))
 
-        try:
-            result = qa({"query": question})
-            return result["result"]
-        except Exception as e:
-            return f"❌ Error saat memproses pertanyaan: {e}"
+    def _cache_answer(self, version_key: tuple, question: str, answer: str):
+        answer_cache = init_answer_cache()
+        # Embedding pertanyaan sudah ada di cache embedding (dipakai retriever), jadi murah
+        embedding = self.embeddings.embed_query(question) if answer_cache.semantic else None
+        answer_cache.put(version_key, question, answer, embedding)
 
     def create_pdf_report(self, content: str, title: str = "Financial Analysis Report") -> BytesIO:
         """Membuat laporan PDF"""
@@ -572,6 +4720,489 @@ class FinancialAI:
         return buffer
 
 
+class IngestionJobQueue:
+    """Antrian job ingestion di SQLite, dipakai bersama oleh UI dan worker process.
+
+    Job yang sedang jalan memperbarui heartbeat; job dengan heartbeat lebih tua dari
+    lease dianggap yatim (worker mati / pod restart) dan diambil ulang. Mengulang job
+    aman: doc_id yang sama mengganti chunk lama, dan embedding yang sudah dihitung
+    dilayani EmbeddingCache.
+
+    Manifest S3 setiap job mencatat pod pemiliknya; semua perubahan manifest memakai
+    compare-and-swap (IfMatch ETag) sehingga satu job hanya dimiliki satu pod, dan hanya
+    pemilik yang boleh menghapus manifest + file upload-nya.
+    """
+
+    ACTIVE = ("queued", "running")
+
+    def __init__(self, db_pool: SQLiteConnectionPool, s3_client, bucket: str = BUCKET_NAME,
+                 spool_dir: str = INGEST_SPOOL_DIR, lease_seconds: float = INGEST_JOB_LEASE_SECONDS,
+                 max_attempts: int = INGEST_JOB_MAX_ATTEMPTS):
+        self.db = db_pool
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.spool_dir = spool_dir
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._manifest_lock = threading.Lock()
+        self._manifest_refreshed = {}
+        self._backlog = (0, 0.0)
+        os.makedirs(spool_dir, exist_ok=True)
+        with self.db.connection() as conn:
+            conn.execute('''
+                         CREATE TABLE IF NOT EXISTS ingestion_jobs
+                         (
+                             job_id       TEXT PRIMARY KEY,
+                             doc_id       TEXT    NOT NULL,
+                             collection   TEXT    NOT NULL,
+                             file_type    TEXT    NOT NULL,
+                             status       TEXT    NOT NULL,
+                             stage        TEXT,
+                             progress     REAL    NOT NULL DEFAULT 0,
+                             message      TEXT,
+                             stats        TEXT,
+                             attempts     INTEGER NOT NULL DEFAULT 0,
+                             worker       TEXT,
+                             created_at   REAL    NOT NULL,
+                             updated_at   REAL    NOT NULL,
+                             heartbeat_at REAL
+                         )
+                         ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_ingestion_jobs_status ON ingestion_jobs (status, created_at)")
+
+    def spool_path(self, job: Dict) -> str:
+        return os.path.join(self.spool_dir, f"{job['job_id']}.{job['file_type']}")
+
+    @staticmethod
+    def _spool_key(job_id: str) -> str:
+        return f"{INGEST_JOBS_S3_PREFIX}{job_id}/upload"
+
+    @staticmethod
+    def _manifest_key(job_id: str) -> str:
+        return f"{INGEST_JOBS_S3_PREFIX}{job_id}.json"
+
+    @staticmethod
+    def _pod_key(pod: str) -> str:
+        return f"{INGEST_PODS_S3_PREFIX}{pod}.json"
+
+    def _read_manifest(self, job_id: str):
+        """(manifest, ETag); (None, None) jika manifest sudah tidak ada"""
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self._manifest_key(job_id))
+        except Exception as e:
+            if is_missing_object_error(e):
+                return None, None
+            raise
+        return json.loads(response['Body'].read()), response['ETag']
+
+    def _update_manifest(self, job_id: str, fields: Dict, attempts: int = 5) -> bool:
+        """Compare-and-swap manifest milik pod ini; False jika job sudah diambil alih pod lain"""
+        for _ in range(attempts):
+            manifest, etag = self._read_manifest(job_id)
+            if manifest is None or manifest.get('owner') != POD_ID:
+                return False
+            try:
+                self.s3_client.put_object(Bucket=self.bucket, Key=self._manifest_key(job_id),
+                                          Body=json.dumps({**manifest, **fields}).encode(), IfMatch=etag)
+                return True
+            except Exception as e:
+                # Proses lain di pod ini menulis manifest yang sama lebih dulu: baca ulang
+                if not is_precondition_error(e):
+                    raise
+        return False
+
+    def _mark_taken_over(self, job_id: str):
+        with self.db.connection() as conn:
+            conn.execute(
+                "UPDATE ingestion_jobs SET status = 'failed', stage = NULL, message = ?, updated_at = ? "
+                "WHERE job_id = ?",
+                ("Job diambil alih pod lain", time.time(), job_id)
+            )
+
+    def enqueue(self, doc_id: str, data: bytes, file_type: str, collection: str = DEFAULT_COLLECTION) -> str:
+        """Simpan file ke spool (lokal + S3) lalu daftarkan job; dipanggil dari thread UI"""
+        now = time.time()
+        job = {
+            'job_id': uuid.uuid4().hex, 'doc_id': doc_id, 'collection': normalize_collection_name(collection),
+            'file_type': file_type, 'status': "queued", 'stage': None, 'progress': 0.0, 'message': None,
+            'stats': None, 'attempts': 0, 'worker': None, 'created_at': now, 'updated_at': now, 'heartbeat_at': None
+        }
+        with open(self.spool_path(job), "wb") as f:
+            f.write(data)
+        self.s3_client.upload_file(self.spool_path(job), self.bucket, self._spool_key(job['job_id']))
+        self.s3_client.put_object(Bucket=self.bucket, Key=self._manifest_key(job['job_id']),
+                                  Body=json.dumps({**job, 'owner': POD_ID}).encode(), IfNoneMatch="*")
+        self._insert(job)
+        return job['job_id']
+
+    def _insert(self, job: Dict):
+        columns = list(job)
+        with self.db.connection() as conn:
+            conn.execute(
+                f"INSERT OR IGNORE INTO ingestion_jobs ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                [job[column] for column in columns]
+            )
+
+    def _row(self, conn, job_id: str):
+        conn.row_factory = sqlite3.Row
+        try:
+            row = conn.execute("SELECT * FROM ingestion_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        finally:
+            conn.row_factory = None
+        return dict(row) if row else None
+
+    def get(self, job_id: str):
+        with self.db.connection() as conn:
+            return self._row(conn, job_id)
+
+    def claim(self, worker: str):
+        """Ambil satu job (antrian atau yatim) secara atomik; None jika tidak ada"""
+        while True:
+            job = self._claim_local(worker)
+            if job is None:
+                return None
+            fields = {key: job[key] for key in ('status', 'stage', 'worker', 'attempts', 'heartbeat_at', 'updated_at')}
+            with self._manifest_lock:
+                owned = self._update_manifest(job['job_id'], fields)
+                self._manifest_refreshed[job['job_id']] = time.monotonic()
+            if owned:
+                return job
+            # Pod lain sudah mengambil alih job ini (lease sempat habis): lepas salinan lokalnya
+            self._mark_taken_over(job['job_id'])
+
+    def _claim_local(self, worker: str):
+        now = time.time()
+        stale = now - self.lease_seconds
+        with self.db.connection() as conn:
+            # Job yatim yang sudah terlalu sering gagal tidak diambil lagi
+            conn.execute('''
+                         UPDATE ingestion_jobs
+                         SET status = 'failed', message = 'Worker berhenti terlalu sering', updated_at = ?
+                         WHERE status = 'running' AND heartbeat_at < ? AND attempts >= ?
+                         ''', (now, stale, self.max_attempts))
+            row = conn.execute('''
+                               UPDATE ingestion_jobs
+                               SET status = 'running', worker = ?, attempts = attempts + 1,
+                                   heartbeat_at = ?, updated_at = ?, stage = 'starting'
+                               WHERE job_id = (SELECT job_id FROM ingestion_jobs
+                                               WHERE status = 'queued' OR (status = 'running' AND heartbeat_at < ?)
+                                               ORDER BY created_at
+                                               LIMIT 1)
+                               RETURNING job_id
+                               ''', (worker, now, now, stale)).fetchone()
+        return self.get(row[0]) if row else None
+
+    def heartbeat(self, job_id: str, **fields) -> bool:
+        """Perbarui heartbeat (dan progress/stage opsional) job yang sedang berjalan.
+
+        Manifest S3 ikut diperbarui (paling sering tiap lease/4) supaya pod lain melihat job
+        masih hidup; False jika job ternyata sudah diambil alih pod lain.
+        """
+        fields = {**fields, 'heartbeat_at': time.time(), 'updated_at': time.time()}
+        with self.db.connection() as conn:
+            conn.execute(
+                f"UPDATE ingestion_jobs SET {', '.join(f'{key} = ?' for key in fields)} "
+                f"WHERE job_id = ? AND status = 'running'",
+                [*fields.values(), job_id]
+            )
+        with self._manifest_lock:
+            if time.monotonic() - self._manifest_refreshed.get(job_id, float("-inf")) < self.lease_seconds / 4:
+                return True
+            self._manifest_refreshed[job_id] = time.monotonic()
+            return self._update_manifest(job_id, fields)
+
+    def beat_pod(self):
+        """Tanda pod ini masih hidup; dipanggil berkala oleh supervisor worker"""
+        self.s3_client.put_object(Bucket=self.bucket, Key=self._pod_key(POD_ID),
+                                  Body=json.dumps({'pod': POD_ID, 'heartbeat_at': time.time()}).encode())
+
+    def remove_pod(self):
+        """Pod berhenti: job miliknya boleh langsung diambil alih tanpa menunggu lease"""
+        self.s3_client.delete_object(Bucket=self.bucket, Key=self._pod_key(POD_ID))
+
+    def _pod_alive(self, pod: str, stale: float) -> bool:
+        try:
+            body = self.s3_client.get_object(Bucket=self.bucket, Key=self._pod_key(pod))['Body'].read()
+        except Exception as e:
+            if is_missing_object_error(e):
+                return False
+            raise
+        return json.loads(body)['heartbeat_at'] >= stale
+
+    def finish(self, job_id: str, success: bool, message: str = None, stats: Dict = None):
+        with self.db.connection() as conn:
+            conn.execute('''
+                         UPDATE ingestion_jobs
+                         SET status = ?, stage = NULL, progress = CASE WHEN ? THEN 1.0 ELSE progress END,
+                             message = ?, stats = ?, updated_at = ?
+                         WHERE job_id = ?
+                         ''', ("done" if success else "failed", success, message,
+                               json.dumps(stats) if stats is not None else None, time.time(), job_id))
+            job = self._row(conn, job_id)
+        with self._manifest_lock:
+            self._manifest_refreshed.pop(job_id, None)
+        if os.path.exists(self.spool_path(job)):
+            os.remove(self.spool_path(job))
+        # Manifest hanya dibutuhkan untuk memulihkan job aktif. Manifest + file upload job yang sudah
+        # diambil alih pod lain dibiarkan karena masih dipakai pemilik barunya
+        for _ in range(5):
+            manifest, etag = self._read_manifest(job_id)
+            if manifest is None or manifest.get('owner') != POD_ID:
+                return
+            try:
+                self.s3_client.delete_object(Bucket=self.bucket, Key=self._manifest_key(job_id), IfMatch=etag)
+                break
+            except Exception as e:
+                if not is_precondition_error(e):
+                    raise
+        else:
+            return
+        self.s3_client.delete_object(Bucket=self.bucket, Key=self._spool_key(job_id))
+
+    def fetch_spool(self, job: Dict) -> str:
+        """Path file upload lokal; di-download dari S3 jika job dilanjutkan di pod lain"""
+        path = self.spool_path(job)
+        if not os.path.exists(path):
+            self.s3_client.download_file(self.bucket, self._spool_key(job['job_id']), path + ".part")
+            os.replace(path + ".part", path)
+        return path
+
+    def requeue_local(self):
+        """Saat proses UI start belum ada worker hidup: job 'running' lokal pasti yatim"""
+        with self.db.connection() as conn:
+            conn.execute("UPDATE ingestion_jobs SET status = 'queued', stage = NULL WHERE status = 'running'")
+
+    def recover_from_s3(self) -> int:
+        """Ambil alih job aktif dari manifest S3 yang pemiliknya sudah hilang (mis. pod dihapus / restart).
+
+        Job pod lain hanya diimpor jika heartbeat pod pemiliknya basi, atau job 'running' yang
+        lease-nya habis. Kepemilikan dipindah dengan put IfMatch ETag manifest yang dibaca,
+        sehingga dari beberapa pod yang mencoba bersamaan hanya satu yang menang.
+        """
+        recovered = 0
+        now = time.time()
+        stale = now - self.lease_seconds
+        pods = {}
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=INGEST_JOBS_S3_PREFIX):
+            for obj in page.get('Contents', []):
+                if not obj['Key'].endswith(".json"):
+                    continue
+                job_id = obj['Key'][len(INGEST_JOBS_S3_PREFIX):-len(".json")]
+                if self.get(job_id):
+                    continue
+                job, etag = self._read_manifest(job_id)
+                if job is None or job['status'] not in self.ACTIVE:
+                    continue
+                owner = job.pop('owner', None)
+                if owner and owner != POD_ID:
+                    if owner not in pods:
+                        pods[owner] = self._pod_alive(owner, stale)
+                    lease_expired = job['status'] == "running" and (job['heartbeat_at'] or 0) < stale
+                    if pods[owner] and not lease_expired:
+                        continue
+                job = {**job, 'status': "queued", 'stage': None, 'updated_at': now}
+                try:
+                    self.s3_client.put_object(Bucket=self.bucket, Key=obj['Key'], IfMatch=etag,
+                                              Body=json.dumps({**job, 'owner': POD_ID}).encode())
+                except Exception as e:
+                    # Pemilik masih memperbarui manifest, atau pod lain lebih dulu mengambil alih
+                    if is_precondition_error(e) or is_missing_object_error(e):
+                        continue
+                    raise
+                self._insert(job)
+                recovered += 1
+        return recovered
+
+    def list_jobs(self, limit: int = 10) -> List[Dict]:
+        with self.db.connection() as conn:
+            conn.row_factory = sqlite3.Row
+            try:
+                rows = conn.execute("SELECT * FROM ingestion_jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+            finally:
+                conn.row_factory = None
+        return [dict(row) for row in rows]
+
+    def stats(self) -> Dict:
+        with self.db.connection() as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM ingestion_jobs GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in ("queued", "running", "done", "failed")}
+
+    def shared_backlog(self) -> int:
+        """Job aktif (queued + running) di semua pod: manifest S3 dihapus saat job selesai,
+        jadi cukup dihitung dari list key. Di-cache INGEST_BACKLOG_REFRESH detik."""
+        count, fetched_at = self._backlog
+        if time.time() - fetched_at < INGEST_BACKLOG_REFRESH:
+            return count
+        count = 0
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=INGEST_JOBS_S3_PREFIX):
+            count += sum(1 for obj in page.get('Contents', []) if obj['Key'].endswith(".json"))
+        self._backlog = (count, time.time())
+        return count
+
+
+@st.cache_resource
+def init_ingest_queue():
+    return IngestionJobQueue(SQLiteConnectionPool(INGEST_JOBS_DB), init_aws_clients()['s3'])
+
+
+@metrics.traced("ingest.job")
+def run_ingest_job(ai: "FinancialAI", jobs: IngestionJobQueue, job: Dict) -> bool:
+    """Proses satu job di worker process; heartbeat jalan di thread terpisah selama job berlangsung"""
+    job_id = job['job_id']
+    done = threading.Event()
+
+    def beat():
+        while not done.wait(jobs.lease_seconds / 4):
+            jobs.heartbeat(job_id)
+
+    heartbeat_thread = threading.Thread(target=beat, daemon=True, name="ingest-heartbeat")
+    heartbeat_thread.start()
+    last_update = [0.0]
+
+    def on_page(page: int, total: int):
+        # Dibatasi ~1 update/detik supaya database job tidak dibanjiri write
+        if time.monotonic() - last_update[0] >= 1 or page == total:
+            last_update[0] = time.monotonic()
+            jobs.heartbeat(job_id, stage=f"pages {page}/{total}", progress=page / max(total, 1))
+
+    stats = {}
+    try:
+        file_path = jobs.fetch_spool(job)
+        jobs.heartbeat(job_id, stage="processing")
+        chunks = ai.stream_financial_document(file_path, job['file_type'], page_callback=on_page, stats=stats,
+                                              doc_id=job['doc_id'], collection=job['collection'])
+        success = ai.create_vector_store(chunks, doc_id=job['doc_id'], collection=job['collection'])
+        jobs.finish(job_id, success, None if success else "Gagal membuat vector store", stats)
+        return success
+    except Exception as e:
+        jobs.finish(job_id, False, str(e), stats)
+        return False
+    finally:
+        done.set()
+
+
+def run_ingest_worker():
+    """Loop worker process: ambil job dari antrian sampai proses dihentikan"""
+    if INGEST_WORKER_NICE and hasattr(os, "nice"):
+        os.nice(INGEST_WORKER_NICE)
+    # Worker tidak membuka endpoint /metrics; durasi tahap ingestion tercatat lewat span di TRACE_FILE
+    metrics.configure_tracing(TRACE_FILE)
+    jobs = init_ingest_queue()
+    ai = FinancialAI()
+    worker = f"{POD_ID}:{os.getpid()}"
+    while True:
+        job = jobs.claim(worker)
+        if job is None:
+            time.sleep(INGEST_POLL_INTERVAL)
+            continue
+        run_ingest_job(ai, jobs, job)
+
+
+class IngestWorkerPool:
+    """Menjalankan dan mengawasi worker process ingestion dari proses Streamlit"""
+
+    def __init__(self, jobs: IngestionJobQueue, workers: int = INGEST_WORKERS, check_interval: float = 5):
+        self.jobs = jobs
+        self.workers = workers
+        self.check_interval = check_interval
+        self.restarts = 0
+        self._processes = []
+        self._stop = threading.Event()
+        self._last_beat = 0.0
+        self._last_recover = 0.0
+
+        jobs.requeue_local()
+        self._beat()
+        self._recover()
+        self._processes = [self._spawn() for _ in range(workers)]
+        self._thread = threading.Thread(target=self._monitor, daemon=True, name="ingest-supervisor")
+        self._thread.start()
+        atexit.register(self.shutdown)
+
+    @staticmethod
+    def _spawn() -> subprocess.Popen:
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__), "--ingest-worker"],
+                                stdout=subprocess.DEVNULL)
+
+    def _beat(self):
+        self._last_beat = time.monotonic()
+        try:
+            self.jobs.beat_pod()
+        except Exception as e:
+            print(f"Ingest pod heartbeat error: {e}")
+
+    def _recover(self):
+        self._last_recover = time.monotonic()
+        try:
+            self.jobs.recover_from_s3()
+        except Exception as e:
+            print(f"Ingest recovery error: {e}")
+
+    def _monitor(self):
+        while not self._stop.wait(self.check_interval):
+            for i, process in enumerate(self._processes):
+                if process.poll() is not None:
+                    # Job yang sedang diproses worker ini diambil ulang setelah lease habis
+                    self._processes[i] = self._spawn()
+                    self.restarts += 1
+            if time.monotonic() - self._last_beat >= self.jobs.lease_seconds / 4:
+                self._beat()
+            if time.monotonic() - self._last_recover >= self.jobs.lease_seconds:
+                self._recover()
+
+    def shutdown(self):
+        self._stop.set()
+        for process in self._processes:
+            if process.poll() is None:
+                process.terminate()
+        try:
+            self.jobs.remove_pod()
+        except Exception as e:
+            print(f"Ingest pod heartbeat error: {e}")
+
+    def stats(self) -> Dict:
+        return {
+            'workers': self.workers,
+            'alive': sum(process.poll() is None for process in self._processes),
+            'restarts': self.restarts,
+            **self.jobs.stats()
+        }
+
+
+@st.cache_resource
+def init_ingest_workers():
+    return IngestWorkerPool(init_ingest_queue())
+
+
+@st.fragment(run_every=INGEST_POLL_INTERVAL)
+def render_ingest_jobs():
+    """Status job ingestion (di-poll); index dimuat ulang begitu job milik session ini selesai"""
+    enqueued = set(st.session_state.get('enqueued_uploads', {}).values())
+    if not enqueued:
+        return
+    jobs = [job for job in init_ingest_queue().list_jobs(limit=50) if job['job_id'] in enqueued]
+    reported = st.session_state.setdefault('reported_jobs', set())
+    for job in jobs[:5]:
+        if job['status'] in ("queued", "running"):
+            st.progress(job['progress'] or 0.0, text=f"{job['doc_id']}: {job['stage'] or job['status']}")
+        elif job['status'] == "failed":
+            st.error(f"❌ {job['doc_id']}: {job['message'] or 'Failed to process document'}")
+        else:
+            stats = json.loads(job['stats'] or "{}")
+            skipped = stats.get('exact_duplicates', 0) + stats.get('near_duplicates', 0)
+            st.success(
+                f"✅ {job['doc_id']}: {stats.get('pages', 0)} pages, {stats.get('chunks', 0)} chunks"
+                + (f", {skipped} duplicates skipped (~{stats.get('tokens_saved', 0):,} tokens, "
+                   f"{stats.get('embedding_calls_saved', 0)} embedding calls saved)" if skipped else "")
+            )
+            if job['job_id'] not in reported:
+                reported.add(job['job_id'])
+                st.session_state.vectorstore_loaded = True
+                st.session_state.ai.load_vector_store(sorted({*st.session_state.ai.collections, job['collection']}))
+
+
 def render_sidebar():
     """Render sidebar dengan chat sessions dan document upload"""
     st.sidebar.title("💰 Financial AI")
@@ -597,20 +5228,84 @@ def render_sidebar():
     with col2:
         if st.button("📊 Stats", help="Show chat statistics"):
             stats = st.session_state.chat_manager.get_chat_statistics()
+            sync = st.session_state.chat_manager.get_sync_status()
+            vector_cache = init_vector_store_cache().stats()
+            embedding_cache = init_embedding_cache().stats()
+            qa_latency = init_qa_chain_factory().stats()
+            answer_cache = init_answer_cache().stats()
+            numeric_queries = init_table_store().stats()
+            ingest = init_ingest_workers().stats()
+            bedrock = init_aws_clients()['bedrock'].stats()
+            avg_wait = {
+                name: f"{wait['avg_seconds'] * 1000:,.0f} ms (max {wait['max_seconds'] * 1000:,.0f} ms)"
+                if wait['avg_seconds'] is not None else "-"
+                for name, wait in bedrock['wait'].items()
+            }
+            avg_ms = {
+                stage: f"{seconds * 1000:,.0f} ms" if seconds is not None else "-"
+                for stage, seconds in qa_latency['avg_seconds'].items()
+            }
+            avg_sizes = qa_latency['avg_sizes']
             st.sidebar.info(f"""
             **Chat Statistics:**
             - Sessions: {stats['total_sessions']}
             - Messages: {stats['total_messages']}
             - User: {stats['messages_by_role'].get('user', 0)}
             - AI: {stats['messages_by_role'].get('assistant', 0)}
+
+            **S3 Sync:**
+            - Pending changes: {sync.get('queue_depth', 0)}
+            - Last sync: {sync.get('last_success_at') or '-'}
+            - Uploaded: {sync.get('bytes_uploaded', 0):,} bytes
+
+            **Vector Index Cache:**
+            - Resident shards: {len(vector_cache['indexes'])}/{vector_cache['max_resident']} (evicted: {vector_cache['evictions']})
+            - Memory: {vector_cache['total_bytes'] / 1024 / 1024:,.1f} MB (+{vector_cache['mmap_bytes'] / 1024 / 1024:,.1f} MB mmap)
+            - Hits/Misses: {vector_cache['hits']}/{vector_cache['misses']}
+            - Index types: {", ".join(f"{info['ntotal']:,} {info['index']['type']}" for info in vector_cache['indexes'].values()) or "-"}
+
+            **Embedding Cache:**
+            - Entries: {embedding_cache['entries']:,}
+            - Hit ratio: {embedding_cache['hit_ratio']:.0%}
+
+            **QA Latency (avg of {qa_latency['calls']}):**
+            - Retrieve ({RETRIEVAL_MODE}, k={RETRIEVAL_TOP_K}): {avg_ms['retrieve']}
+            - Prompt: {avg_ms['prompt']}
+            - LLM: {avg_ms['llm']}
+            - Time to first token: {avg_ms['ttft']}
+            - Total: {avg_ms['total']}
+            - Context: {f"~{avg_sizes['prompt_tokens']:,.0f} prompt tokens, {avg_sizes['context_chunks']:.1f} chunks" if avg_sizes['prompt_tokens'] is not None else "-"} ({f"packed ≤{CONTEXT_TOKEN_BUDGET:,} tokens" if CONTEXT_PACKING else "no packing"})
+            - Chains built/reused: {qa_latency['builds']}/{qa_latency['reuses']}
+            - Numeric queries: {numeric_queries['queries']} (avg {f"{numeric_queries['avg_query_ms']:,.1f} ms" if numeric_queries['avg_query_ms'] is not None else "-"})
+
+            **Answer Cache:**
+            - Entries: {answer_cache['entries']:,}
+            - Hits (exact/semantic): {answer_cache['exact_hits']}/{answer_cache['semantic_hits']}
+            - Hit ratio: {answer_cache['hit_ratio']:.0%}
+
+            **Ingestion Jobs:**
+            - Workers alive: {ingest['alive']}/{ingest['workers']} (restarts: {ingest['restarts']})
+            - Queued/Running: {ingest['queued']}/{ingest['running']}
+            - Done/Failed: {ingest['done']}/{ingest['failed']}
+
+            **Bedrock Scheduler:**
+            - Requests: {bedrock['requests']:,} (coalesced: {bedrock['coalesced']}, throttled: {bedrock['throttled']})
+            - In flight/Queued: {bedrock['in_flight']}/{BEDROCK_MAX_IN_FLIGHT} · {bedrock['queued']}
+            - Queue wait chat: {avg_wait['interactive']}
+            - Queue wait ingestion: {avg_wait['bulk']}
             """)
 
-    # List existing sessions
-    sessions = st.session_state.chat_manager.get_all_sessions()
+    # List existing sessions (satu halaman per rerun, cursor disimpan di session_state)
+    if 'session_page_cursors' not in st.session_state:
+        st.session_state.session_page_cursors = [None]
+    page = st.session_state.chat_manager.get_sessions_page(
+        cursor=st.session_state.session_page_cursors[-1]
+    )
+    sessions = page['sessions']
 
     if sessions:
         st.sidebar.markdown("**Recent Chats:**")
-        for session in sessions[:10]:  # Show only recent 10
+        for session in sessions:
             session_title = session['title']
             session_id = session['id']
 
@@ -633,6 +5328,16 @@ def render_sidebar():
                         st.session_state.current_session_id = None
                     st.rerun()
 
+    col1, col2 = st.sidebar.columns(2)
+    with col1:
+        if len(st.session_state.session_page_cursors) > 1 and st.button("⬅️ Newer", key="sessions_newer"):
+            st.session_state.session_page_cursors.pop()
+            st.rerun()
+    with col2:
+        if page['next_cursor'] and st.button("Older ➡️", key="sessions_older"):
+            st.session_state.session_page_cursors.append(page['next_cursor'])
+            st.rerun()
+
     st.sidebar.divider()
 
     # Export/Import Section
@@ -650,6 +5355,26 @@ def render_sidebar():
 
     st.sidebar.divider()
 
+    # Collections Section
+    st.sidebar.subheader("🗂️ Collections")
+
+    available_collections = st.session_state.ai.list_collections()
+    st.session_state.upload_collection = normalize_collection_name(st.sidebar.text_input(
+        "Upload to collection",
+        value=st.session_state.get('upload_collection', DEFAULT_COLLECTION),
+        help="e.g. a user, company or fiscal year (acme-2023)"
+    ))
+    query_collections = st.sidebar.multiselect(
+        "Search in collections",
+        options=available_collections,
+        default=[c for c in st.session_state.ai.collections if c in available_collections]
+    )
+    if query_collections and query_collections != st.session_state.ai.collections:
+        if st.session_state.ai.load_vector_store(query_collections):
+            st.session_state.vectorstore_loaded = True
+
+    st.sidebar.divider()
+
     # Document Upload Section
     st.sidebar.subheader("📄 Upload Document")
 
@@ -659,35 +5384,43 @@ def render_sidebar():
         help="Supported: PDF, CSV, Excel"
     )
 
+    # Upload hanya didaftarkan ke antrian; worker process terpisah yang memproses
     if uploaded_file is not None:
-        with st.spinner("Processing document..."):
-            file_ext = uploaded_file.name.split(".")[-1].lower()
-            temp_file_path = f"/tmp/{st.session_state.ai.get_unique_id()}.{file_ext}"
-
-            with open(temp_file_path, "wb") as f:
-                f.write(uploaded_file.getvalue())
-
-            documents = st.session_state.ai.process_financial_document(temp_file_path, file_ext)
-
-            if documents:
-                st.sidebar.success(f"✅ Loaded {len(documents)} documents")
-                split_docs = st.session_state.ai.split_documents(documents)
-                st.sidebar.info(f"📝 Split into {len(split_docs)} chunks")
-
-                if st.session_state.ai.create_vector_store(split_docs):
-                    st.sidebar.success("✅ Document processed and saved!")
-                    st.session_state.vectorstore_loaded = True
-                    st.session_state.ai.load_vector_store()
-                else:
-                    st.sidebar.error("❌ Failed to process document")
-
-            if os.path.exists(temp_file_path):
-                os.remove(temp_file_path)
+        enqueued = st.session_state.setdefault('enqueued_uploads', {})
+        if uploaded_file.file_id not in enqueued:
+            init_ingest_workers()
+            enqueued[uploaded_file.file_id] = init_ingest_queue().enqueue(
+                doc_id=uploaded_file.name,
+                data=uploaded_file.getvalue(),
+                file_type=uploaded_file.name.split(".")[-1].lower(),
+                collection=st.session_state.upload_collection
+            )
+            st.sidebar.info(f"⏳ {uploaded_file.name} queued for processing")
+
+    with st.sidebar:
+        render_ingest_jobs()
+
+    # Daftar dokumen di index (dimuat dari S3 hanya saat dibuka)
+    if st.sidebar.toggle("📚 Manage indexed documents", key="show_documents"):
+        manage_collection = st.session_state.upload_collection
+        registry = st.session_state.ai.load_document_registry(collection_index_name(manage_collection))
+        if not registry:
+            st.sidebar.caption("No indexed documents yet")
+        for doc_id, info in sorted(registry.items(), key=lambda item: item[1]['added_at'], reverse=True):
+            col1, col2 = st.sidebar.columns([3, 1])
+            with col1:
+                st.caption(f"{doc_id} ({info['chunks']} chunks)")
+            with col2:
+                if st.button("🗑️", key=f"delete_doc_{doc_id}"):
+                    with st.spinner("Removing document..."):
+                        if st.session_state.ai.delete_document(doc_id, manage_collection):
+                            st.session_state.ai.load_vector_store(st.session_state.ai.collections)
+                    st.rerun()
 
     # Load existing documents
     if st.sidebar.button("🔄 Load Saved Documents"):
         with st.spinner("Loading documents..."):
-            if st.session_state.ai.load_vector_store():
+            if st.session_state.ai.load_vector_store(query_collections or [st.session_state.upload_collection]):
                 st.sidebar.success("✅ Documents loaded!")
                 st.session_state.vectorstore_loaded = True
             else:
@@ -712,8 +5445,32 @@ def render_chat_interface():
         """, unsafe_allow_html=True)
         return
 
-    # Get current session messages
-    messages = st.session_state.chat_manager.get_session_messages(st.session_state.current_session_id)
+    # Get current session messages (halaman terakhir + halaman lama yang sudah dimuat)
+    chat_manager = st.session_state.chat_manager
+    session_id = st.session_state.current_session_id
+    history = st.session_state.get('message_history')
+    if not history or history['session_id'] != session_id:
+        history = st.session_state.message_history = {
+            'session_id': session_id, 'older': [], 'before_id': None, 'anchor_id': None
+        }
+
+    if history['anchor_id'] is None:
+        page = chat_manager.get_messages_page(session_id)
+        messages, before_id = page['messages'], page['next_before_id']
+    else:
+        # Halaman lama tetap dari session_state; bagian bawah = semua pesan sejak anchor
+        # (termasuk pesan baru), jadi tidak ada celah antara halaman lama dan pesan terbaru
+        messages = history['older'] + chat_manager.get_messages_since(session_id, history['anchor_id'])
+        before_id = history['before_id']
+
+    if before_id is not None:
+        if st.button("⬆️ Load older messages"):
+            if history['anchor_id'] is None:
+                history['anchor_id'] = messages[0]['id']
+            older = chat_manager.get_messages_page(session_id, before_id=before_id)
+            history['older'] = older['messages'] + history['older']
+            history['before_id'] = older['next_before_id']
+            st.rerun()
 
     # Display chat messages
     for message in messages:
@@ -725,7 +5482,7 @@ def render_chat_interface():
                 st.write(message['content'])
 
                 # Add download button for AI responses
-                if st.button(f"📥 Download PDF", key=f"download_{message['timestamp']}"):
+                if st.button(f"📥 Download PDF", key=f"download_{message['id']}"):
                     pdf_buffer = st.session_state.ai.create_pdf_report(
                         message['content'],
                         f"Financial Analysis - {datetime.now().strftime('%Y%m%d_%H%M%S')}"
@@ -752,11 +5509,9 @@ def render_chat_interface():
             st.session_state.current_session_id, 'user', prompt
         )
 
-        # Generate and display AI response
+        # Stream AI response; teks lengkap disimpan setelah stream selesai
         with st.chat_message("assistant"):
-            with st.spinner("Analyzing..."):
-                response = st.session_state.ai.get_financial_response(prompt)
-                st.write(response)
+            response = st.write_stream(st.session_state.ai.stream_financial_response(prompt))
 
         # Save AI response
         st.session_state.chat_manager.add_message(
@@ -773,6 +5528,118 @@ def render_chat_interface():
         st.rerun()
 
 
+def process_rss_bytes() -> int:
+    """RSS proses saat ini (bukan puncak seperti ru_maxrss)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+def register_app_metrics(chat_manager: "ChatManager"):
+    """Gauge dari stats() komponen bersama, dibaca saat endpoint /metrics di-scrape"""
+    vector_cache = init_vector_store_cache()
+    embedding_cache = init_embedding_cache()
+    answer_cache = init_answer_cache()
+    ingest_workers = init_ingest_workers()
+    ingest_queue = init_ingest_queue()
+    bedrock = init_aws_clients()['bedrock']
+
+    def family(name, kind, help_text, samples):
+        return name, kind, help_text, [(name, labels, value) for labels, value in samples]
+
+    def collect():
+        index = vector_cache.stats()
+        embedding = embedding_cache.stats()
+        answers = answer_cache.stats()
+        ingest = ingest_workers.stats()
+        scheduler = bedrock.stats()
+        sync = chat_manager.get_sync_status()
+        families = [
+            family("financial_ai_process_resident_bytes", "gauge", "RSS proses Streamlit",
+                   [({}, process_rss_bytes())]),
+            family("financial_ai_vector_index_bytes", "gauge", "Ukuran index FAISS yang di-cache",
+                   [({'memory': "heap"}, index['total_bytes']), ({'memory': "mmap"}, index['mmap_bytes'])]),
+            family("financial_ai_vector_index_vectors", "gauge", "Jumlah vektor per shard yang di-cache",
+                   [({'index': name, 'type': info['index']['type']}, info['ntotal'])
+                    for name, info in index['indexes'].items()]),
+            family("financial_ai_cache_requests_total", "counter", "Lookup cache per hasil",
+                   [({'cache': "vector_index", 'result': "hit"}, index['hits']),
+                    ({'cache': "vector_index", 'result': "miss"}, index['misses']),
+                    ({'cache': "embedding", 'result': "hit"}, embedding['hits']),
+                    ({'cache': "embedding", 'result': "s3_hit"}, embedding['s3_hits']),
+                    ({'cache': "embedding", 'result': "miss"}, embedding['misses']),
+                    ({'cache': "answer", 'result': "exact_hit"}, answers['exact_hits']),
+                    ({'cache': "answer", 'result': "semantic_hit"}, answers['semantic_hits']),
+                    ({'cache': "answer", 'result': "miss"}, answers['misses'])]),
+            family("financial_ai_cache_hit_ratio", "gauge", "Rasio hit cache sejak proses start",
+                   [({'cache': "embedding"}, embedding['hit_ratio']), ({'cache': "answer"}, answers['hit_ratio'])]),
+            family("financial_ai_cache_entries", "gauge", "Jumlah entri cache",
+                   [({'cache': "vector_index"}, len(index['indexes'])), ({'cache': "embedding"}, embedding['entries']),
+                    ({'cache': "answer"}, answers['entries'])]),
+            family("financial_ai_ingest_jobs", "gauge", "Job ingestion per status (antrian SQLite pod ini)",
+                   [({'status': status}, ingest[status]) for status in ("queued", "running", "done", "failed")]),
+            # Sama di semua pod: dipakai HPA sebagai External metric (dibagi jumlah replika)
+            family("financial_ai_ingest_backlog_jobs", "gauge", "Job ingestion aktif semua pod (manifest S3)",
+                   [({}, ingest_queue.shared_backlog())]),
+            family("financial_ai_ingest_workers_alive", "gauge", "Worker process ingestion yang hidup",
+                   [({}, ingest['alive'])]),
+            family("financial_ai_bedrock_in_flight", "gauge", "Request Bedrock yang sedang berjalan",
+                   [({}, scheduler['in_flight'])]),
+            family("financial_ai_bedrock_queued", "gauge", "Request Bedrock yang menunggu di scheduler",
+                   [({}, scheduler['queued'])]),
+            family("financial_ai_bedrock_requests_total", "counter", "Request Bedrock lewat scheduler",
+                   [({'result': "sent"}, scheduler['requests']), ({'result': "coalesced"}, scheduler['coalesced']),
+                    ({'result': "throttled"}, scheduler['throttled']), ({'result': "error"}, scheduler['errors'])]),
+            ("financial_ai_bedrock_queue_wait_seconds", "histogram", "Waktu tunggu antrian scheduler Bedrock",
+             [sample for priority, wait in scheduler['wait'].items()
+              for sample in metrics.histogram_samples("financial_ai_bedrock_queue_wait_seconds",
+                                                      {'priority': priority}, QUEUE_WAIT_BUCKETS, wait['buckets'],
+                                                      wait['sum_seconds'], wait['count'])]),
+            # p95 dari jendela jawaban terakhir: metric siap pakai untuk HPA tanpa histogram_quantile
+            family("financial_ai_qa_latency_p95_seconds", "gauge", "p95 latensi total jawaban (1.000 terakhir)",
+                   [({}, QA_STAGE_SECONDS.quantile(0.95, stage="total") or 0.0)]),
+        ]
+        if sync:
+            families.append(family("financial_ai_chat_sync_pending", "gauge", "Perubahan chat yang belum di-sync ke S3",
+                                   [({}, sync.get('queue_depth', 0))]))
+        return families
+
+    metrics.register_collector("app", collect)
+
+
+@st.cache_resource
+def init_metrics_server():
+    """Collector + endpoint /metrics, sekali per proses.
+
+    Dipanggil dari entrypoint `python main.py --serve` sebelum server Streamlit start, sehingga
+    metric (dan worker ingestion) sudah jalan walau belum ada session browser yang membuka app.
+    """
+    metrics.configure_tracing(TRACE_FILE)
+    if not METRICS_PORT:
+        return None
+    register_app_metrics(ChatManager())
+    try:
+        return metrics.start_http_server(METRICS_PORT)
+    except OSError as e:
+        print(f"❌ Metrics endpoint tidak bisa dibuka di port {METRICS_PORT}: {e}")
+        return None
+
+
+def serve():
+    """Entrypoint container: start metrics lalu jalankan server Streamlit di proses yang sama.
+
+    Argumen setelah --serve diteruskan ke `streamlit run`. Script yang dijalankan Streamlit
+    juga bernama __main__, jadi singleton init_* (st.cache_resource) dipakai bersama.
+    """
+    from streamlit.web import cli as streamlit_cli
+    init_metrics_server()
+    args = sys.argv[sys.argv.index("--serve") + 1:]
+    sys.argv = ["streamlit", "run", os.path.abspath(__file__), *args]
+    sys.exit(streamlit_cli.main())
+
+
 def main():
     st.set_page_config(
         page_title="Magnus AI Assistant",
@@ -816,13 +5683,21 @@ def main():
     if 'vectorstore_loaded' not in st.session_state:
         st.session_state.vectorstore_loaded = False
 
+    # No-op jika sudah dijalankan entrypoint --serve; tetap dipanggil untuk `streamlit run main.py` langsung
+    init_metrics_server()
+
     # Render UI
     render_sidebar()
     render_chat_interface()
 
 
 if __name__ == "__main__":
-    main()
+    if "--ingest-worker" in sys.argv:
+        run_ingest_worker()
+    elif "--serve" in sys.argv:
+        serve()
+    else:
+        main()
 
 
 from tabulate import tabulate
@@ -0,0 +1,309 @@
+"""Metrics gaya Prometheus dan trace span untuk jalur panas Financial AI.
+
+Dipisah dari main.py karena Streamlit mengeksekusi ulang main.py setiap rerun:
+registry, server HTTP, dan file trace di modul ini dibuat sekali per proses.
+Tanpa dependensi tambahan; output mengikuti text exposition format Prometheus.
+"""
+import bisect
+import contextvars
+import functools
+import inspect
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+QUANTILE_WINDOW = 1000  # observasi terakhir per label untuk kuantil (p95) tanpa menyimpan semua data
+
+
+def _format_labels(labels: Dict) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for key, value in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return "NaN"
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> Iterable[Tuple[str, Dict, float]]:
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {
+                    'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0,
+                    'window': deque(maxlen=QUANTILE_WINDOW)
+                }
+            state['buckets'][bisect.bisect_left(self.buckets, value)] += 1
+            state['sum'] += value
+            state['count'] += 1
+            state['window'].append(value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def quantile(self, q: float, **labels):
+        """Kuantil dari QUANTILE_WINDOW observasi terakhir; None jika belum ada data"""
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            window = sorted(state['window']) if state else []
+        if not window:
+            return None
+        return window[min(len(window) - 1, int(q * len(window)))]
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(state['buckets']), state['sum'], state['count'])
+                     for key, state in self._values.items()]
+        for key, buckets, total, count in items:
+            yield from histogram_samples(self.name, dict(zip(self.labelnames, key)), self.buckets, buckets, total, count)
+
+
+def histogram_samples(name: str, labels: Dict, bounds: Tuple[float, ...], buckets, total: float, count: int):
+    """Sampel _bucket/_sum/_count dari hitungan per bucket (non-kumulatif, elemen terakhir = +Inf)"""
+    cumulative = 0
+    for bound, hits in zip((*bounds, math.inf), buckets):
+        cumulative += hits
+        yield f"{name}_bucket", {**labels, 'le': _format_value(float(bound))}, cumulative
+    yield f"{name}_sum", labels, total
+    yield f"{name}_count", labels, count
+
+
+class Registry:
+    """Metric milik proses + collector yang dibaca saat scrape (stats() komponen yang sudah ada)"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, help_text: str, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name: str, help_text: str, labelnames=()) -> Counter:
+        return self._get_or_create(Counter, name, help_text, labelnames)
+
+    def gauge(self, name: str, help_text: str, labelnames=()) -> Gauge:
+        return self._get_or_create(Gauge, name, help_text, labelnames)
+
+    def histogram(self, name: str, help_text: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help_text, labelnames, buckets=buckets)
+
+    def register_collector(self, name: str, collect: Callable[[], Iterable[Tuple]]):
+        """collect() -> [(nama metric, tipe, help, [(nama sampel, labels, nilai), ...]), ...].
+
+        Didaftarkan ulang dengan nama yang sama (rerun Streamlit) menggantikan collector lama.
+        """
+        with self._lock:
+            self._collectors[name] = collect
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors.items())
+        families = [(metric.name, metric.kind, metric.help, metric.samples()) for metric in metrics]
+        errors = []
+        for name, collect in collectors:
+            try:
+                families.extend(collect())
+            except Exception as e:
+                # Satu komponen gagal dibaca tidak boleh mematikan seluruh scrape
+                errors.append(("financial_ai_collector_errors", {'collector': name, 'error': type(e).__name__}, 1))
+        if errors:
+            families.append(("financial_ai_collector_errors", "gauge", "Collector yang gagal dibaca saat scrape", errors))
+        lines = []
+        for name, kind, help_text, samples in families:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in samples:
+                lines.append(f"{sample_name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+register_collector = REGISTRY.register_collector
+
+STAGE_SECONDS = histogram("financial_ai_stage_seconds", "Durasi tahap pipeline (span)", ("stage",))
+STAGE_ERRORS = counter("financial_ai_stage_errors_total", "Tahap pipeline yang berakhir dengan exception",
+                       ("stage",))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_http_server(port: int, host: str = "0.0.0.0"):
+    """Endpoint /metrics di thread daemon; aman dipanggil berulang (hanya start sekali per proses)"""
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, daemon=True, name="metrics-http").start()
+        return _server
+
+
+# Trace span: satu baris JSON per span, ditulis append (worker ingestion bisa menulis ke file yang sama)
+_trace_fd = None
+_trace_path = None
+_current_span = contextvars.ContextVar("financial_ai_span", default=None)
+
+
+def configure_tracing(path: str):
+    """Aktifkan penulisan span ke path (JSON lines); string kosong = nonaktif"""
+    global _trace_fd, _trace_path
+    with _server_lock:
+        if path == _trace_path:
+            return
+        if _trace_fd is not None:
+            os.close(_trace_fd)
+        _trace_fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644) if path else None
+        _trace_path = path
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Ukur satu tahap: histogram financial_ai_stage_seconds{stage=name} + span ke file trace (jika aktif).
+
+    Atribut tambahan bisa diisi selama span berjalan lewat dict yang di-yield.
+    """
+    parent = _current_span.get()
+    record = {
+        'trace_id': parent['trace_id'] if parent else uuid.uuid4().hex,
+        'span_id': uuid.uuid4().hex[:16],
+        'parent_id': parent['span_id'] if parent else None,
+        'name': name,
+        'start': time.time(),
+        'pid': os.getpid(),
+        'attributes': attributes
+    }
+    token = _current_span.set(record)
+    start = time.perf_counter()
+    error = None
+    try:
+        yield record['attributes']
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            # Generator dilanjutkan di context lain (mis. thread berbeda): cukup kosongkan
+            _current_span.set(parent)
+        # GeneratorExit = konsumen berhenti membaca, bukan kegagalan tahap
+        if error is not None and error != "GeneratorExit":
+            STAGE_ERRORS.inc(stage=name)
+            record['error'] = error
+        STAGE_SECONDS.observe(duration, stage=name)
+        if _trace_fd is not None:
+            record['duration_ms'] = round(duration * 1000, 3)
+            line = json.dumps(record, default=str) + "\n"
+            # Satu write per baris dengan O_APPEND: baris dari proses berbeda tidak bercampur
+            os.write(_trace_fd, line.encode("utf-8"))
+
+
+def traced(name: str):
+    """Decorator span(name) untuk fungsi biasa maupun generator (span selesai saat generator habis)"""
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                with span(name):
+                    yield from func(*args, **kwargs)
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,92 @@
+"""Ekstraksi teks PDF paralel per rentang halaman.
+
+Dipisah dari main.py supaya worker process cukup meng-import pypdf,
+tanpa Streamlit/LangChain, dan fungsi worker tetap bisa di-pickle ketika
+main.py dijalankan lewat `streamlit run`.
+"""
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import Iterator, List, Tuple
+
+from pypdf import PdfReader
+
+
+# Pool dibagi semua upload dalam satu proses: biaya start worker hanya dibayar sekali
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+
+def get_executor(workers: int) -> ProcessPoolExecutor:
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            # forkserver: aman dipakai dari proses Streamlit yang multi-thread; worker
+            # di-fork dari server yang sudah meng-import modul utama
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver"))
+            _executor_workers = workers
+        return _executor
+
+
+def _reset_executor():
+    global _executor
+    with _executor_lock:
+        _executor = None
+
+
+def count_pdf_pages(file_path: str) -> int:
+    return len(PdfReader(file_path).pages)
+
+
+@lru_cache(maxsize=1)
+def _worker_reader(file_path: str, mtime: float) -> PdfReader:
+    # Satu reader per worker process: membuka ulang PDF per task membuat page tree
+    # di-parse ulang terus (O(halaman^2) untuk dokumen besar)
+    return PdfReader(file_path)
+
+
+def extract_page_range(file_path: str, start: int, stop: int, reader: PdfReader = None) -> List[Tuple[int, str]]:
+    """Ekstrak teks halaman [start, stop); di worker, reader dibuka sekali per proses"""
+    reader = reader or _worker_reader(file_path, os.path.getmtime(file_path))
+    return [(page_number, reader.pages[page_number].extract_text() or "") for page_number in range(start, stop)]
+
+
+def iter_pdf_pages(file_path: str, workers: int, pages_per_task: int,
+                   max_in_flight: int = None) -> Iterator[Tuple[int, str]]:
+    """Yield (nomor halaman, teks) berurutan sambil halaman berikutnya diekstrak paralel.
+
+    Jumlah task yang sedang berjalan dibatasi max_in_flight sehingga memori
+    tidak tumbuh mengikuti jumlah halaman ketika konsumen (embedding) lebih lambat.
+    """
+    total_pages = count_pdf_pages(file_path)
+    ranges = deque((start, min(start + pages_per_task, total_pages))
+                   for start in range(0, total_pages, pages_per_task))
+    max_in_flight = max_in_flight or workers * 2
+
+    if workers <= 1 or len(ranges) <= 1:
+        reader = PdfReader(file_path)
+        for start, stop in ranges:
+            yield from extract_page_range(file_path, start, stop, reader)
+        return
+
+    executor = get_executor(workers)
+    pending = deque()
+    try:
+        while ranges or pending:
+            while ranges and len(pending) < max_in_flight:
+                pending.append(executor.submit(extract_page_range, file_path, *ranges.popleft()))
+            yield from pending.popleft().result()
+    except BrokenProcessPool:
+        _reset_executor()
+        raise
+    finally:
+        # Konsumen berhenti di tengah jalan: jangan biarkan task sisa menumpuk di pool
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,179 @@
+"""Replikasi chat history antar pod lewat S3 (ChatReplicator) dengan bucket moto in-process."""
+import os
+import threading
+
+import pytest
+
+pytest.importorskip("moto")
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import boto3  # noqa: E402
+from moto import mock_aws  # noqa: E402
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def s3():
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=main.BUCKET_NAME)
+        yield client
+
+
+class CountingS3:
+    """Client S3 yang mencatat key changelog yang dibaca"""
+
+    def __init__(self, client):
+        self._client = client
+        self.segment_reads = []
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def get_object(self, **kwargs):
+        if kwargs["Key"].startswith(main.CHAT_CHANGELOG_PREFIX):
+            self.segment_reads.append(kwargs["Key"])
+        return self._client.get_object(**kwargs)
+
+
+def start_pod(tmp_path, s3_client, pod_id, bootstrap=False):
+    pool = main.SQLiteConnectionPool(str(tmp_path / f"{pod_id}.db"))
+    replicator = main.ChatReplicator(pool, s3_client, pod_id=pod_id)
+    # Sama dengan ChatManager.sync_from_s3: snapshot di-download sebelum koneksi pertama dibuka
+    watermark = replicator.bootstrap() if bootstrap else None
+    chat = main.ChatManager(pool, enable_s3_sync=False)
+    chat.replicator = replicator
+    if watermark is not None:
+        replicator.reset_local_state(watermark)
+    return chat, replicator
+
+
+def chat_state(chat):
+    with chat.db.connection() as conn:
+        sessions = conn.execute("SELECT id, title FROM chat_sessions ORDER BY id").fetchall()
+        messages = conn.execute(
+            "SELECT session_id, role, content FROM chat_messages ORDER BY session_id, content"
+        ).fetchall()
+    return sessions, messages
+
+
+def last_segment_key(chat, pod_id):
+    with chat.db.connection() as conn:
+        return conn.execute("SELECT segment_key FROM chat_pod_watermarks WHERE pod_id = ?", (pod_id,)).fetchone()[0]
+
+
+def write_concurrently(*writers):
+    barrier = threading.Barrier(len(writers))
+    errors = []
+
+    def run(writer):
+        try:
+            barrier.wait()
+            writer()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(writer,)) for writer in writers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+
+
+def test_two_pods_writing_concurrently_converge(tmp_path, s3):
+    pod_a, replicator_a = start_pod(tmp_path, s3, "A")
+    pod_b, replicator_b = start_pod(tmp_path, s3, "B")
+
+    def writer(chat, replicator, name):
+        def write():
+            for i in range(5):
+                session_id = chat.create_new_session(f"{name}-{i}")
+                chat.add_message(session_id, "user", f"{name} pertanyaan {i}")
+                chat.add_message(session_id, "assistant", f"{name} jawaban {i}")
+                replicator.push_segment()
+        return write
+
+    write_concurrently(writer(pod_a, replicator_a, "A"), writer(pod_b, replicator_b, "B"))
+
+    assert replicator_a.pull_segments() == 5
+    assert replicator_b.pull_segments() == 5
+    sessions, messages = chat_state(pod_a)
+    assert len(sessions) == 10 and len(messages) == 20
+    assert chat_state(pod_b) == (sessions, messages)
+    # Segment yang sudah diterapkan tidak diterapkan ulang
+    assert replicator_a.pull_segments() == 0
+
+
+def test_third_pod_bootstraps_from_snapshot(tmp_path, s3):
+    pod_a, replicator_a = start_pod(tmp_path, s3, "A")
+    pod_b, replicator_b = start_pod(tmp_path, s3, "B")
+    session_a = pod_a.create_new_session("dari A")
+    pod_a.add_message(session_a, "user", "halo dari A")
+    replicator_a.push_segment()
+    session_b = pod_b.create_new_session("dari B")
+    pod_b.add_message(session_b, "user", "halo dari B")
+    replicator_b.push_segment()
+    replicator_a.pull_segments()
+    replicator_a.write_snapshot()
+
+    # Ditulis setelah snapshot: harus di-replay oleh pod baru
+    pod_b.add_message(session_b, "assistant", "setelah snapshot")
+    replicator_b.push_segment()
+    replicator_a.pull_segments()
+
+    counting = CountingS3(s3)
+    pod_c, replicator_c = start_pod(tmp_path, counting, "C", bootstrap=True)
+    assert replicator_c.pull_segments() == 1
+    assert counting.segment_reads == [last_segment_key(pod_b, "B")]
+    assert chat_state(pod_c) == chat_state(pod_a)
+
+
+def test_bootstrap_without_later_writes_pulls_no_segments(tmp_path, s3):
+    pod_a, replicator_a = start_pod(tmp_path, s3, "A")
+    pod_b, replicator_b = start_pod(tmp_path, s3, "B")
+    for chat, replicator in ((pod_a, replicator_a), (pod_b, replicator_b)):
+        for i in range(3):
+            chat.add_message(chat.create_new_session(f"sesi {i}"), "user", "isi")
+            replicator.push_segment()
+    replicator_a.pull_segments()
+    replicator_a.write_snapshot()
+
+    counting = CountingS3(s3)
+    pod_c, replicator_c = start_pod(tmp_path, counting, "C", bootstrap=True)
+    # Watermark per pod dari snapshot: semua segment A dan B dilewati tanpa di-download
+    assert replicator_c.pull_segments() == 0
+    assert counting.segment_reads == []
+    assert chat_state(pod_c) == chat_state(pod_a)
+
+
+def test_deleted_session_stays_deleted_after_replay(tmp_path, s3):
+    pod_a, replicator_a = start_pod(tmp_path, s3, "A")
+    pod_b, replicator_b = start_pod(tmp_path, s3, "B")
+    session_id = pod_a.create_new_session("akan dihapus")
+    pod_a.add_message(session_id, "user", "pesan awal")
+    replicator_a.push_segment()
+    replicator_b.pull_segments()
+
+    # A menghapus sementara B (belum melihat delete) masih menulis ke session yang sama
+    pod_a.delete_session(session_id)
+    replicator_a.push_segment()
+    pod_b.add_message(session_id, "user", "pesan terlambat")
+    pod_b.update_session_title(session_id, "judul baru")
+    replicator_b.push_segment()
+
+    replicator_a.pull_segments()
+    replicator_b.pull_segments()
+    replicator_a.write_snapshot()
+    pod_c, replicator_c = start_pod(tmp_path, s3, "C", bootstrap=True)
+    replicator_c.pull_segments()
+    # Pod baru yang me-replay semua segment dari awal (tanpa snapshot) juga tidak menghidupkannya lagi
+    pod_d, replicator_d = start_pod(tmp_path, s3, "D")
+    replicator_d.pull_segments()
+
+    for chat in (pod_a, pod_b, pod_c, pod_d):
+        sessions, messages = chat_state(chat)
+        assert session_id not in {sid for sid, _ in sessions}
+        assert session_id not in {sid for sid, _, _ in messages}
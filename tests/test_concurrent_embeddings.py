@@ -0,0 +1,99 @@
+"""AIMD backoff dan recovery ConcurrentBedrockEmbeddings terhadap Bedrock palsu."""
+import json
+import threading
+import time
+from io import BytesIO
+
+import pytest
+from botocore.exceptions import ClientError
+
+import main
+
+
+class FakeBedrock:
+    """Bedrock palsu dengan latency dan kuota request paralel: di atas kuota ThrottlingException"""
+
+    def __init__(self, quota: int, latency: float):
+        self.quota = quota
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = 0
+        self.throttled = 0
+        self.priorities = []
+        self._lock = threading.Lock()
+
+    def invoke_model(self, priority=None, body=None, **kwargs):
+        with self._lock:
+            self.calls += 1
+            self.priorities.append(priority)
+            if self.in_flight >= self.quota:
+                self.throttled += 1
+                raise ClientError({"Error": {"Code": "ThrottlingException"}}, "InvokeModel")
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency)
+            text = json.loads(body)["inputText"]
+            return {"body": BytesIO(json.dumps({"embedding": [float(len(text)), 1.0]}).encode())}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+def make_embeddings(client, concurrency=16):
+    return main.ConcurrentBedrockEmbeddings(
+        client=client, concurrency=concurrency, max_retries=20, backoff_base=0.001, backoff_max=0.01
+    )
+
+
+def texts(count, prefix="chunk"):
+    return [f"{prefix} {i}" + "x" * (i % 7) for i in range(count)]
+
+
+def test_throttling_halves_limit_and_keeps_results():
+    fake = FakeBedrock(quota=3, latency=0.005)
+    embeddings = make_embeddings(fake)
+
+    batch = texts(150)
+    vectors = embeddings.embed_documents(batch)
+
+    assert vectors == [[float(len(text)), 1.0] for text in batch]
+    assert fake.throttled > 0 and embeddings.throttled == fake.throttled
+    # Multiplicative decrease: batas turun jauh di bawah concurrency awal mendekati kuota
+    assert embeddings.limiter.limit < 16
+    assert embeddings.limiter.in_flight == 0
+
+
+def test_limit_recovers_after_throttling_stops():
+    fake = FakeBedrock(quota=2, latency=0.002)
+    embeddings = make_embeddings(fake)
+    embeddings.embed_documents(texts(80))
+    backed_off = embeddings.limiter.limit
+    assert backed_off < 16
+
+    # Kapasitas pulih: additive increase sampai kembali ke concurrency penuh
+    fake.quota = 64
+    throttled = fake.throttled
+    embeddings.embed_documents(texts(400, prefix="pulih"))
+    assert fake.throttled == throttled
+    assert embeddings.limiter.limit == 16
+    assert fake.max_in_flight <= 16
+
+
+def test_interactive_requests_do_not_drive_limiter():
+    fake = FakeBedrock(quota=0, latency=0.001)
+    embeddings = make_embeddings(fake)
+    embeddings.limiter.limit = 4.0
+
+    # Pertanyaan chat tidak memegang slot limiter: throttling-nya tidak boleh menurunkan batas ingestion
+    with pytest.raises(ClientError):
+        embeddings.embed_query("pertanyaan")
+    assert embeddings.limiter.limit == 4.0
+
+    # ... dan suksesnya tidak boleh menaikkan batas
+    fake.quota = 8
+    for i in range(20):
+        embeddings.embed_query(f"pertanyaan {i}")
+    assert embeddings.limiter.limit == 4.0
+    assert set(fake.priorities) == {main.PRIORITY_INTERACTIVE}
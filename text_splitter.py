@@ -0,0 +1,88 @@
+"""Recursive character splitter berbasis generator.
+
+Menghasilkan chunk yang identik dengan RecursiveCharacterTextSplitter
+LangChain (keep_separator=True, separator literal, strip whitespace) tapi
+tanpa list perantara: chunk di-yield langsung dan filter panjang dilakukan
+saat itu juga. Dipisah dari main.py supaya bisa dijalankan di worker
+process (pool yang sama dengan ekstraksi PDF) tanpa import Streamlit/LangChain.
+"""
+from collections import deque
+from typing import Iterable, Iterator, List, Sequence, Tuple
+
+
+class RecursiveTextSplitter:
+    def __init__(self, chunk_size: int, chunk_overlap: int, separators: Sequence[str],
+                 min_length: int = 0, max_length: int = None):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separators = tuple(separators)
+        self.min_length = min_length
+        self.max_length = max_length
+
+    def split_text(self, text: str) -> Iterator[str]:
+        """Yield chunk berurutan; chunk di luar [min_length, max_length] dibuang"""
+        min_length, max_length = self.min_length, self.max_length
+        for chunk in self._split(text, self.separators):
+            if len(chunk) >= min_length and (max_length is None or len(chunk) <= max_length):
+                yield chunk
+
+    def _split(self, text: str, separators: Sequence[str]) -> Iterator[str]:
+        # Separator pertama yang muncul di teks; sisanya dipakai untuk potongan yang masih terlalu besar
+        separator, remaining = separators[-1], ()
+        for i, candidate in enumerate(separators):
+            if candidate == "":
+                separator = candidate
+                break
+            if candidate in text:
+                separator, remaining = candidate, separators[i + 1:]
+                break
+
+        chunk_size = self.chunk_size
+        good_splits = []
+        for piece in _split_keep_separator(text, separator):
+            if len(piece) < chunk_size:
+                good_splits.append(piece)
+                continue
+            if good_splits:
+                yield from self._merge(good_splits)
+                good_splits = []
+            if remaining:
+                yield from self._split(piece, remaining)
+            else:
+                yield piece
+        if good_splits:
+            yield from self._merge(good_splits)
+
+    def _merge(self, splits: List[str]) -> Iterator[str]:
+        # Separator sudah menempel di awal potongan (keep_separator), jadi digabung tanpa pemisah
+        chunk_size, chunk_overlap = self.chunk_size, self.chunk_overlap
+        current = deque()
+        total = 0
+        for piece in splits:
+            length = len(piece)
+            if total + length > chunk_size and current:
+                chunk = "".join(current).strip()
+                if chunk:
+                    yield chunk
+                # Buang potongan terdepan sampai sisa overlap muat bersama potongan baru
+                while current and (total > chunk_overlap or total + length > chunk_size):
+                    total -= len(current.popleft())
+            current.append(piece)
+            total += length
+        chunk = "".join(current).strip()
+        if chunk:
+            yield chunk
+
+
+def _split_keep_separator(text: str, separator: str) -> List[str]:
+    if not separator:
+        return list(text)
+    parts = text.split(separator)
+    splits = [parts[0]] if parts[0] else []
+    splits.extend(separator + part for part in parts[1:])
+    return splits
+
+
+def split_text_batch(splitter: RecursiveTextSplitter, texts: Iterable[str]) -> List[Tuple[str, ...]]:
+    """Dipanggil di worker process: chunk per teks, urutan sama dengan input"""
+    return [tuple(splitter.split_text(text)) for text in texts]